@@ -1,18 +1,421 @@
 import json
 import os
+import threading
+import time
+import bisect
 import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, connection as PgConnection
+from psycopg2.extras import execute_values
+from collections import OrderedDict
+import base64
 import hashlib
+import hmac
 import secrets
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Tuple
 
-def escape_sql_string(value: str) -> str:
-    """Экранирует строку для SQL запроса"""
-    return value.replace("'", "''")
+DB_POOL_MAX_IDLE = int(os.environ.get('DB_POOL_MAX_IDLE', '4'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+_pool_lock = threading.Lock()
+_pool_idle: List[Tuple[Any, float]] = []
+_pool_stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'reconnects': 0}
+
+class PooledConnection(PgConnection):
+    """Соединение пула; помнит, какие запросы уже подготовлены в его сессии"""
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared_statements: set = set()
+
+def _close_quietly(conn: Any) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+def _connection_alive(conn: Any, released_at: float) -> bool:
+    """Проверяет, что соединение из пула ещё живо (пингуем только давно простаивающие)"""
+    if conn.closed:
+        return False
+    if time.monotonic() - released_at < DB_POOL_PING_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_connection() -> Any:
+    """Берёт соединение из пула прогретого контейнера или открывает новое"""
+    while True:
+        with _pool_lock:
+            if not _pool_idle:
+                _pool_stats['misses'] += 1
+                break
+            conn, released_at = _pool_idle.pop()
+        if _connection_alive(conn, released_at):
+            with _pool_lock:
+                _pool_stats['hits'] += 1
+            return conn
+        with _pool_lock:
+            _pool_stats['reconnects'] += 1
+        _close_quietly(conn)
+    return psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=PooledConnection)
+
+def release_connection(conn: Any) -> None:
+    """Возвращает соединение в пул; битые и лишние соединения закрываются"""
+    if conn.closed:
+        return
+    try:
+        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        _close_quietly(conn)
+        return
+    with _pool_lock:
+        if len(_pool_idle) < DB_POOL_MAX_IDLE:
+            _pool_idle.append((conn, time.monotonic()))
+            return
+    _close_quietly(conn)
+
+def get_pool_stats() -> Dict[str, int]:
+    """Счётчики пула: hits — переиспользованные соединения, misses — новые, reconnects — выброшенные битые"""
+    with _pool_lock:
+        return dict(_pool_stats, idle=len(_pool_idle))
+
+SCHEMA = 't_p85141447_matrix_destiny_proje'
+
+# Горячие запросы: готовятся на сервере один раз на соединение пула
+STATEMENTS: Dict[str, str] = {
+    'access_check': f"""
+        SELECT plan_type, expires_at, downloads_left, granted_at, max_devices, session_epoch,
+               is_expired, active_devices, session_token, limit_exceeded
+        FROM {SCHEMA}.access_check($1, $2, $3, $4)
+    """,
+    'select_entitlement': f"""
+        SELECT a.plan_type, a.expires_at, a.downloads_left, a.granted_at, COALESCE(a.max_devices, 2), a.session_epoch,
+               (SELECT COUNT(DISTINCT s.ip_address)
+                FROM {SCHEMA}.user_sessions s
+                WHERE s.email = a.email AND s.last_activity > CURRENT_TIMESTAMP - INTERVAL '24 hours'),
+               a.revoked_devices
+        FROM {SCHEMA}.active_access a
+        WHERE a.email = $1
+    """,
+    'select_devices': f"""
+        SELECT ip_address, user_agent, last_activity, created_at
+        FROM {SCHEMA}.user_sessions
+        WHERE email = $1 AND last_activity > $2
+        ORDER BY last_activity DESC
+    """,
+    'select_device_limit': f"""
+        SELECT max_devices, expires_at
+        FROM {SCHEMA}.active_access
+        WHERE email = $1
+    """,
+    'delete_device_sessions': f"""
+        DELETE FROM {SCHEMA}.user_sessions
+        WHERE email = $1 AND ip_address = $2
+    """,
+    'revoke_device': f"""
+        UPDATE {SCHEMA}.active_access
+        SET revoked_devices = COALESCE(
+                (SELECT jsonb_object_agg(r.key, r.value)
+                 FROM jsonb_each(revoked_devices) r
+                 WHERE r.value::NUMERIC > EXTRACT(EPOCH FROM CURRENT_TIMESTAMP) - 86400),
+                '{{}}'::JSONB
+            ) || jsonb_build_object($2::TEXT, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP))
+        WHERE email = $1
+    """
+}
+
+TIMING_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+_statement_timings: Dict[str, List[int]] = {}
+_statement_timings_lock = threading.Lock()
+
+def execute_prepared(cur: Any, name: str, params: Tuple = ()) -> None:
+    """Выполняет запрос из реестра STATEMENTS: PREPARE один раз на соединение, дальше только EXECUTE"""
+    conn = cur.connection
+    try:
+        if name not in conn.prepared_statements:
+            cur.execute(f'PREPARE {name} AS {STATEMENTS[name]}')
+            conn.prepared_statements.add(name)
+        started = time.perf_counter()
+        if params:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            cur.execute(f'EXECUTE {name}')
+    except psycopg2.Error:
+        # Устаревший план или сбой сессии: соединение вместе с его PREPARE больше не используем
+        _close_quietly(conn)
+        raise
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    bucket = bisect.bisect_left(TIMING_BUCKETS_MS, elapsed_ms)
+    with _statement_timings_lock:
+        histogram = _statement_timings.setdefault(name, [0] * (len(TIMING_BUCKETS_MS) + 1))
+        histogram[bucket] += 1
+
+def get_statement_stats() -> Dict[str, Dict[str, int]]:
+    """Гистограммы времени выполнения подготовленных запросов"""
+    labels = [f'<={bound}ms' for bound in TIMING_BUCKETS_MS] + [f'>{TIMING_BUCKETS_MS[-1]}ms']
+    with _statement_timings_lock:
+        return {name: dict(zip(labels, counts)) for name, counts in _statement_timings.items()}
+
+ENTITLEMENT_CACHE_TTL = float(os.environ.get('ENTITLEMENT_CACHE_TTL', '60'))
+ENTITLEMENT_CACHE_SIZE = int(os.environ.get('ENTITLEMENT_CACHE_SIZE', '1024'))
+ENTITLEMENT_CHANNEL = 'active_access_changed'
+
+_MISSING = object()
+_entitlements: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+_entitlements_lock = threading.Lock()
+_listen_conn: Any = None
+_listen_lock = threading.Lock()
+
+def _drain_entitlement_notifications() -> None:
+    """Сбрасывает из кэша записи, о смене которых сообщил NOTIFY триггера active_access"""
+    global _listen_conn
+    # Соединение LISTEN одно на контейнер: poll() из нескольких потоков сразу зависает
+    with _listen_lock:
+        try:
+            if _listen_conn is None or _listen_conn.closed:
+                _listen_conn = psycopg2.connect(os.environ['DATABASE_URL'])
+                _listen_conn.autocommit = True
+                with _listen_conn.cursor() as cur:
+                    cur.execute(f'LISTEN {ENTITLEMENT_CHANNEL}')
+                # Пока слушателя не было, изменения могли пройти мимо
+                with _entitlements_lock:
+                    _entitlements.clear()
+                return
+            _listen_conn.poll()
+        except psycopg2.Error:
+            if _listen_conn is not None:
+                _close_quietly(_listen_conn)
+            _listen_conn = None
+            with _entitlements_lock:
+                _entitlements.clear()
+            return
+        while _listen_conn.notifies:
+            notify = _listen_conn.notifies.pop(0)
+            with _entitlements_lock:
+                _entitlements.pop(notify.payload, None)
+
+def lookup_entitlement(email: str) -> Any:
+    """Возвращает закэшированную строку active_access (None — доступа нет) или _MISSING"""
+    if ENTITLEMENT_CACHE_TTL <= 0:
+        return _MISSING
+    _drain_entitlement_notifications()
+    with _entitlements_lock:
+        cached = _entitlements.get(email)
+        if cached is None:
+            return _MISSING
+        stored_at, row = cached
+        if time.monotonic() - stored_at > ENTITLEMENT_CACHE_TTL:
+            del _entitlements[email]
+            return _MISSING
+        _entitlements.move_to_end(email)
+        return row
+
+def remember_entitlement(email: str, row: Any) -> None:
+    """Кладёт строку active_access в LRU-кэш, вытесняя самые старые записи"""
+    if ENTITLEMENT_CACHE_TTL <= 0:
+        return
+    with _entitlements_lock:
+        _entitlements[email] = (time.monotonic(), row)
+        _entitlements.move_to_end(email)
+        while len(_entitlements) > ENTITLEMENT_CACHE_SIZE:
+            _entitlements.popitem(last=False)
+
+def forget_entitlement(email: str) -> None:
+    with _entitlements_lock:
+        _entitlements.pop(email, None)
+
+# Интервал сброса должен быть много меньше 24-часового окна устройств
+HEARTBEAT_FLUSH_INTERVAL = float(os.environ.get('HEARTBEAT_FLUSH_INTERVAL', '60'))
+HEARTBEAT_FLUSH_SIZE = int(os.environ.get('HEARTBEAT_FLUSH_SIZE', '200'))
+
+_heartbeats: Dict[Tuple[str, str], datetime] = {}
+_heartbeats_lock = threading.Lock()
+_heartbeats_flushed_at = time.monotonic()
+
+def record_heartbeat(email: str, ip_address: str) -> None:
+    """Запоминает активность устройства; повторные отметки схлопываются до последней"""
+    with _heartbeats_lock:
+        _heartbeats[(email, ip_address)] = datetime.now()
+
+def flush_heartbeats(force: bool = False) -> None:
+    """Пишет накопленные last_activity одним UPDATE ... FROM (VALUES ...), если пора"""
+    global _heartbeats_flushed_at
+    with _heartbeats_lock:
+        due = (force or len(_heartbeats) >= HEARTBEAT_FLUSH_SIZE or
+               time.monotonic() - _heartbeats_flushed_at >= HEARTBEAT_FLUSH_INTERVAL)
+        if not due or not _heartbeats:
+            return
+        batch = list(_heartbeats.items())
+        _heartbeats.clear()
+        _heartbeats_flushed_at = time.monotonic()
+    
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        execute_values(cur, f"""
+            UPDATE {SCHEMA}.user_sessions s
+            SET last_activity = v.last_activity
+            FROM (VALUES %s) AS v(email, ip_address, last_activity)
+            WHERE s.email = v.email AND s.ip_address = v.ip_address AND s.last_activity < v.last_activity
+        """, [(email, ip, seen_at) for (email, ip), seen_at in batch])
+        conn.commit()
+        cur.close()
+    except psycopg2.Error as e:
+        print(f"WARNING: heartbeat flush failed, will retry: {str(e)}")
+        with _heartbeats_lock:
+            for key, seen_at in batch:
+                _heartbeats.setdefault(key, seen_at)
+    finally:
+        release_connection(conn)
+
+SECURITY_LOG_FLUSH_INTERVAL = float(os.environ.get('SECURITY_LOG_FLUSH_INTERVAL', '10'))
+SECURITY_LOG_FLUSH_SIZE = int(os.environ.get('SECURITY_LOG_FLUSH_SIZE', '100'))
+SECURITY_LOG_BUFFER_MAX = int(os.environ.get('SECURITY_LOG_BUFFER_MAX', '1000'))
+
+SECURITY_EVENT_MESSAGES = {
+    'expired_access': 'Попытка доступа с истёкшей подпиской',
+    'device_limit_exceeded': 'Попытка входа с нового устройства при превышении лимита'
+}
+
+# (email, event_type, ip) -> [user_agent, число повторов, время первого события]
+_security_events: Dict[Tuple[str, str, str], List[Any]] = {}
+_security_events_lock = threading.Lock()
+_security_events_flushed_at = time.monotonic()
+_security_log_stats: Dict[str, int] = {'queued': 0, 'coalesced': 0, 'dropped': 0, 'written': 0}
+
+def log_security_event(email: str, event_type: str, ip_address: str, user_agent: str) -> None:
+    """Ставит событие в буфер; повторы с того же IP схлопываются в счётчик, при переполнении событие отбрасывается"""
+    key = (email, event_type, ip_address)
+    with _security_events_lock:
+        pending = _security_events.get(key)
+        if pending:
+            pending[1] += 1
+            _security_log_stats['coalesced'] += 1
+        elif len(_security_events) >= SECURITY_LOG_BUFFER_MAX:
+            _security_log_stats['dropped'] += 1
+        else:
+            _security_events[key] = [user_agent, 1, datetime.now()]
+            _security_log_stats['queued'] += 1
+
+def flush_security_events(force: bool = False) -> None:
+    """Вставляет накопленные события одним многострочным INSERT, если пора"""
+    global _security_events_flushed_at
+    with _security_events_lock:
+        due = (force or len(_security_events) >= SECURITY_LOG_FLUSH_SIZE or
+               time.monotonic() - _security_events_flushed_at >= SECURITY_LOG_FLUSH_INTERVAL)
+        if not due or not _security_events:
+            return
+        batch = list(_security_events.items())
+        _security_events.clear()
+        _security_events_flushed_at = time.monotonic()
+    
+    rows = [
+        (email, event_type, ip, user_agent,
+         json.dumps({'message': SECURITY_EVENT_MESSAGES.get(event_type, event_type), 'count': count}, ensure_ascii=False),
+         created_at)
+        for (email, event_type, ip), (user_agent, count, created_at) in batch
+    ]
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        execute_values(cur, f"""
+            INSERT INTO {SCHEMA}.security_logs
+            (email, event_type, ip_address, user_agent, details, created_at)
+            VALUES %s
+        """, rows)
+        conn.commit()
+        cur.close()
+        with _security_events_lock:
+            _security_log_stats['written'] += len(rows)
+    except psycopg2.Error as e:
+        # Журнал не должен ронять проверку доступа: пачка теряется и попадает в счётчик
+        print(f"WARNING: security log flush failed: {str(e)}")
+        with _security_events_lock:
+            _security_log_stats['dropped'] += sum(count for _, (_, count, _) in batch)
+    finally:
+        release_connection(conn)
+    
+    # Счётчики с начала жизни контейнера: рост dropped — повод увеличить буфер или чинить БД
+    print('SECURITY_LOG: ' + ', '.join(f'{name}={value}' for name, value in get_security_log_stats().items()))
+
+def get_security_log_stats() -> Dict[str, int]:
+    with _security_events_lock:
+        return dict(_security_log_stats, pending=len(_security_events))
+
+SESSIONS_RETENTION_DAYS = int(os.environ.get('SESSIONS_RETENTION_DAYS', '90'))
+SECURITY_LOGS_RETENTION_DAYS = int(os.environ.get('SECURITY_LOGS_RETENTION_DAYS', '365'))
+PARTITION_ARCHIVE_ONLY = os.environ.get('PARTITION_ARCHIVE_ONLY', '').lower() == 'true'
+
+def maintain_partitions() -> int:
+    """
+    Создаёт секции наперёд и убирает секции старше срока хранения.
+    Вызывается по таймеру (GET ?action=maintain_partitions), а не из проверки доступа:
+    DDL берёт блокировки на секционированные таблицы
+    """
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT {SCHEMA}.maintain_time_partitions(
+                make_interval(days => %s), make_interval(days => %s), %s
+            )
+        """, (SESSIONS_RETENTION_DAYS, SECURITY_LOGS_RETENTION_DAYS, PARTITION_ARCHIVE_ONLY))
+        pruned = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+        if pruned:
+            print(f"Partition maintenance: {pruned} old partitions removed")
+        return pruned
+    finally:
+        release_connection(conn)
+
+SESSION_TOKEN_SECRET = os.environ.get('SESSION_TOKEN_SECRET', '')
+# Токен не должен жить дольше 24-часового окна устройств: пока он действует,
+# строка user_sessions с last_activity не старше выдачи токена ещё учитывается в лимите
+SESSION_TOKEN_TTL = min(int(os.environ.get('SESSION_TOKEN_TTL', str(6 * 3600))), 24 * 3600)
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def _sign(payload: str) -> str:
+    return _b64url(hmac.new(SESSION_TOKEN_SECRET.encode(), payload.encode(), hashlib.sha256).digest())
+
+def device_id(ip_address: str) -> str:
+    """Идентификатор устройства в токене (хэш IP, сам адрес в токен не попадает)"""
+    return hashlib.sha256(ip_address.encode()).hexdigest()[:16]
+
+def issue_session_token(email: str, ip_address: str, session_epoch: int) -> str:
+    """Подписанный токен: email, устройство, время выдачи и поколение сессий"""
+    claims = {'e': email, 'd': device_id(ip_address), 't': int(time.time()), 'g': session_epoch}
+    payload = _b64url(json.dumps(claims, separators=(',', ':')).encode())
+    return f'{payload}.{_sign(payload)}'
+
+def verify_session_token(token: str, email: str, ip_address: str) -> Optional[Tuple[int, int]]:
+    """Проверяет токен без БД; возвращает (поколение сессий, время выдачи) или None, если токен не годится"""
+    try:
+        payload, signature = token.split('.')
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if claims.get('e') != email or claims.get('d') != device_id(ip_address):
+        return None
+    if time.time() - claims.get('t', 0) > SESSION_TOKEN_TTL:
+        return None
+    return claims.get('g'), claims.get('t', 0)
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
-    Проверяет доступ пользователя к функционалу по email
+    Проверяет доступ пользователя к функционалу по email;
+    GET ?action=maintain_partitions обслуживает секции журналов (вызывается по таймеру)
     """
     
     method: str = event.get('httpMethod', 'GET')
@@ -67,21 +470,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_connection()
             cur = conn.cursor()
             
-            email_esc = escape_sql_string(email)
-            ip_esc = escape_sql_string(source_ip)
-            
-            cur.execute(f"""
-                DELETE FROM t_p85141447_matrix_destiny_proje.user_sessions
-                WHERE email = '{email_esc}' AND ip_address = '{ip_esc}'
-            """)
+            execute_prepared(cur, 'delete_device_sessions', (email, source_ip))
             
             deleted_count = cur.rowcount
+            
+            # Отзываем токены только этого устройства: выданные раньше момента выхода
+            execute_prepared(cur, 'revoke_device', (email, device_id(source_ip)))
             conn.commit()
+            forget_entitlement(email)
             cur.close()
-            conn.close()
+            release_connection(conn)
             
             return {
                 'statusCode': 200,
@@ -107,33 +508,24 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
-            cur = conn.cursor()
+            flush_heartbeats(force=True)
             
-            email_esc = escape_sql_string(email)
-            threshold_time = (datetime.now() - timedelta(hours=24)).isoformat()
+            conn = get_connection()
+            cur = conn.cursor()
             
-            cur.execute(f"""
-                SELECT ip_address, user_agent, last_activity, created_at
-                FROM t_p85141447_matrix_destiny_proje.user_sessions
-                WHERE email = '{email_esc}' AND last_activity > '{threshold_time}'
-                ORDER BY last_activity DESC
-            """)
+            threshold_time = datetime.now() - timedelta(hours=24)
+            execute_prepared(cur, 'select_devices', (email, threshold_time))
             
             sessions = cur.fetchall()
             
-            cur.execute(f"""
-                SELECT max_devices, expires_at
-                FROM t_p85141447_matrix_destiny_proje.active_access
-                WHERE email = '{email_esc}'
-            """)
+            execute_prepared(cur, 'select_device_limit', (email,))
             
             access_info = cur.fetchone()
             max_devices = access_info[0] if access_info else 2
             expires_at = access_info[1] if access_info else None
             
             cur.close()
-            conn.close()
+            release_connection(conn)
             
             devices = []
             for session in sessions:
@@ -170,8 +562,18 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
+        params = event.get('queryStringParameters') or {}
+        
+        # GET ?action=maintain_partitions: обслуживание секций по таймеру
+        if params.get('action') == 'maintain_partitions':
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'pruned': maintain_partitions()}),
+                'isBase64Encoded': False
+            }
+        
         # GET: Проверка доступа
-        params = event.get('queryStringParameters', {})
         email = params.get('email')
         
         if not email:
@@ -182,135 +584,119 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cur = conn.cursor()
-        
-        email_esc = escape_sql_string(email)
+        flush_security_events()
         
-        cur.execute(f"""
-            SELECT plan_type, expires_at, downloads_left, granted_at, max_devices
-            FROM t_p85141447_matrix_destiny_proje.active_access
-            WHERE email = '{email_esc}'
-        """)
-        
-        result = cur.fetchone()
+        not_found_response = {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({
+                'has_access': False,
+                'message': 'Доступ не найден. Возможно, заявка ещё не одобрена.'
+            }),
+            'isBase64Encoded': False
+        }
         
-        if not result:
-            cur.close()
-            conn.close()
+        def expired_response(expires_at: datetime) -> Dict[str, Any]:
+            log_security_event(email, 'expired_access', source_ip, user_agent)
+            flush_security_events()
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({
                     'has_access': False,
-                    'message': 'Доступ не найден. Возможно, заявка ещё не одобрена.'
+                    'message': 'Срок действия подписки истёк',
+                    'expires_at': expires_at.isoformat()
                 }),
                 'isBase64Encoded': False
             }
         
-        plan_type, expires_at, downloads_left, granted_at, max_devices = result
+        # Отсутствие доступа и истёкшую подписку отвечаем из кэша, не трогая БД
+        entitlement = lookup_entitlement(email)
+        if entitlement is None:
+            return not_found_response
+        if entitlement is not _MISSING and entitlement[1] and entitlement[1] < datetime.now():
+            return expired_response(entitlement[1])
         
-        has_access = True
-        message = None
-        session_token = None
+        # Вернувшееся устройство с подписанным токеном проверяем без user_sessions
+        token_claims = None
+        presented_token = params.get('session_token')
+        if SESSION_TOKEN_SECRET and presented_token:
+            token_claims = verify_session_token(presented_token, email, source_ip)
         
-        # Проверка срока подписки
-        if expires_at:
-            now = datetime.now()
-            if expires_at.tzinfo:
-                from datetime import timezone
-                now = datetime.now(timezone.utc)
-            
-            if now > expires_at:
-                has_access = False
-                message = 'Срок действия подписки истёк'
-                
-                now_iso = now.isoformat()
-                ip_esc = escape_sql_string(source_ip)
-                ua_esc = escape_sql_string(user_agent)
-                
-                cur.execute(f"""
-                    INSERT INTO t_p85141447_matrix_destiny_proje.security_logs (email, event_type, ip_address, user_agent, details)
-                    VALUES ('{email_esc}', 'expired_access', '{ip_esc}', '{ua_esc}', 'Попытка доступа с истёкшей подпиской')
-                """)
-                conn.commit()
-                
+        if token_claims is not None:
+            # После медленного пути отзывы устройств не известны — дочитываем строку
+            if entitlement is _MISSING or entitlement[7] is None:
+                conn = get_connection()
+                cur = conn.cursor()
+                execute_prepared(cur, 'select_entitlement', (email,))
+                entitlement = cur.fetchone()
                 cur.close()
-                conn.close()
-                
+                release_connection(conn)
+                remember_entitlement(email, entitlement)
+                if entitlement is None:
+                    return not_found_response
+            
+            (plan_type, expires_at, downloads_left, granted_at, max_devices, session_epoch,
+             active_devices_count, revoked_devices) = entitlement
+            token_epoch, issued_at = token_claims
+            revoked_at = revoked_devices.get(device_id(source_ip))
+            if (token_epoch == session_epoch and (revoked_at is None or issued_at > revoked_at) and
+                    (not expires_at or expires_at > datetime.now())):
+                record_heartbeat(email, source_ip)
+                flush_heartbeats()
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                     'body': json.dumps({
-                        'has_access': False,
-                        'message': message,
-                        'expires_at': expires_at.isoformat()
+                        'has_access': True,
+                        'message': None,
+                        'plan_type': plan_type,
+                        'expires_at': expires_at.isoformat() if expires_at else None,
+                        'downloads_left': downloads_left,
+                        'granted_at': granted_at.isoformat() if granted_at else None,
+                        'session_token': presented_token,
+                        'active_devices': active_devices_count,
+                        'max_devices': max_devices
                     }),
                     'isBase64Encoded': False
                 }
         
-        # Проверка лимита устройств
-        threshold_time = (datetime.now() - timedelta(hours=24)).isoformat()
+        conn = get_connection()
+        cur = conn.cursor()
         
-        cur.execute(f"""
-            SELECT COUNT(DISTINCT ip_address) 
-            FROM t_p85141447_matrix_destiny_proje.user_sessions 
-            WHERE email = '{email_esc}' AND last_activity > '{threshold_time}'
-        """)
+        execute_prepared(cur, 'access_check', (email, source_ip, user_agent, secrets.token_urlsafe(32)))
         
-        active_devices_count = cur.fetchone()[0]
+        result = cur.fetchone()
+        conn.commit()
+        cur.close()
+        release_connection(conn)
         
-        # Проверяем, есть ли активная сессия для текущего устройства
-        ip_esc = escape_sql_string(source_ip)
+        if not result:
+            remember_entitlement(email, None)
+            return not_found_response
         
-        cur.execute(f"""
-            SELECT session_token 
-            FROM t_p85141447_matrix_destiny_proje.user_sessions 
-            WHERE email = '{email_esc}' AND ip_address = '{ip_esc}' AND last_activity > '{threshold_time}'
-        """)
+        (plan_type, expires_at, downloads_left, granted_at, max_devices, session_epoch,
+         is_expired, active_devices_count, session_token, limit_exceeded) = result
+        remember_entitlement(email, (plan_type, expires_at, downloads_left, granted_at, max_devices, session_epoch,
+                                     active_devices_count, None))
         
-        existing_session = cur.fetchone()
+        if session_token:
+            record_heartbeat(email, source_ip)
+            flush_heartbeats()
+            if SESSION_TOKEN_SECRET:
+                session_token = issue_session_token(email, source_ip, session_epoch)
         
-        if existing_session:
-            session_token = existing_session[0]
-            
-            now_iso = datetime.now().isoformat()
-            cur.execute(f"""
-                UPDATE t_p85141447_matrix_destiny_proje.user_sessions 
-                SET last_activity = '{now_iso}'
-                WHERE email = '{email_esc}' AND ip_address = '{ip_esc}'
-            """)
-            conn.commit()
-        else:
-            # Новое устройство
-            if active_devices_count >= (max_devices or 2):
-                has_access = False
-                message = f'Превышен лимит устройств ({max_devices or 2}). Выйдите с одного из устройств.'
-                
-                now_iso = datetime.now().isoformat()
-                ua_esc = escape_sql_string(user_agent)
-                
-                cur.execute(f"""
-                    INSERT INTO t_p85141447_matrix_destiny_proje.security_logs (email, event_type, ip_address, user_agent, details)
-                    VALUES ('{email_esc}', 'device_limit_exceeded', '{ip_esc}', '{ua_esc}', 'Попытка входа с нового устройства при превышении лимита')
-                """)
-                conn.commit()
-            else:
-                # Создаём новую сессию
-                session_token = secrets.token_urlsafe(32)
-                now_iso = datetime.now().isoformat()
-                token_esc = escape_sql_string(session_token)
-                ua_esc = escape_sql_string(user_agent)
-                
-                cur.execute(f"""
-                    INSERT INTO t_p85141447_matrix_destiny_proje.user_sessions 
-                    (email, session_token, ip_address, user_agent, created_at, last_activity)
-                    VALUES ('{email_esc}', '{token_esc}', '{ip_esc}', '{ua_esc}', '{now_iso}', '{now_iso}')
-                """)
-                conn.commit()
+        # Проверка срока подписки
+        if is_expired:
+            return expired_response(expires_at)
         
-        cur.close()
-        conn.close()
+        # Проверка лимита устройств
+        has_access = not limit_exceeded
+        message = None
+        if limit_exceeded:
+            message = f'Превышен лимит устройств ({max_devices}). Выйдите с одного из устройств.'
+            log_security_event(email, 'device_limit_exceeded', source_ip, user_agent)
+            flush_security_events()
         
         return {
             'statusCode': 200,
@@ -324,7 +710,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'granted_at': granted_at.isoformat() if granted_at else None,
                 'session_token': session_token,
                 'active_devices': active_devices_count,
-                'max_devices': max_devices or 2
+                'max_devices': max_devices
             }),
             'isBase64Encoded': False
         }
@@ -1,10 +1,292 @@
+import base64
+import csv
+import hashlib
+import io
 import json
 import os
+import zlib
+import threading
+import time
+import uuid
 import psycopg2
-from typing import Dict, Any
-from datetime import datetime, timedelta
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+from datetime import date, datetime, timedelta
 from urllib.parse import parse_qs
 
+DB_POOL_MAX_IDLE = int(os.environ.get('DB_POOL_MAX_IDLE', '4'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+_pool_lock = threading.Lock()
+_pool_idle: List[Tuple[Any, float]] = []
+_pool_stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'reconnects': 0}
+
+def _close_quietly(conn: Any) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+def _connection_alive(conn: Any, released_at: float) -> bool:
+    """Проверяет, что соединение из пула ещё живо (пингуем только давно простаивающие)"""
+    if conn.closed:
+        return False
+    if time.monotonic() - released_at < DB_POOL_PING_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_connection() -> Any:
+    """Берёт соединение из пула прогретого контейнера или открывает новое"""
+    while True:
+        with _pool_lock:
+            if not _pool_idle:
+                _pool_stats['misses'] += 1
+                break
+            conn, released_at = _pool_idle.pop()
+        if _connection_alive(conn, released_at):
+            with _pool_lock:
+                _pool_stats['hits'] += 1
+            return conn
+        with _pool_lock:
+            _pool_stats['reconnects'] += 1
+        _close_quietly(conn)
+    return psycopg2.connect(os.environ['DATABASE_URL'])
+
+def release_connection(conn: Any) -> None:
+    """Возвращает соединение в пул; битые и лишние соединения закрываются"""
+    if conn.closed:
+        return
+    try:
+        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        _close_quietly(conn)
+        return
+    with _pool_lock:
+        if len(_pool_idle) < DB_POOL_MAX_IDLE:
+            _pool_idle.append((conn, time.monotonic()))
+            return
+    _close_quietly(conn)
+
+def get_pool_stats() -> Dict[str, int]:
+    """Счётчики пула: hits — переиспользованные соединения, misses — новые, reconnects — выброшенные битые"""
+    with _pool_lock:
+        return dict(_pool_stats, idle=len(_pool_idle))
+
+LIST_PAGE_DEFAULT = 50
+LIST_PAGE_MAX = 500
+
+REQUEST_COLUMNS = """
+    pr.id, pr.email, pr.phone, pr.screenshot_url, pr.status, pr.created_at, pr.plan_type, pr.amount,
+    aa.plan_type, aa.expires_at, aa.downloads_left, pr.screenshot_thumb_url
+"""
+
+def serialize_request(r: Tuple) -> Dict[str, Any]:
+    """Строка payment_requests + active_access в формате админки"""
+    access_info = None
+    if r[8]:  # has active_access
+        access_info = {
+            'plan_type': r[8],
+            'expires_at': r[9].isoformat() if r[9] else None,
+            'downloads_left': r[10]
+        }
+    
+    return {
+        'id': r[0],
+        'email': r[1],
+        'phone': r[2] or '',
+        'screenshot_url': r[3] or '',
+        'screenshot_thumb_url': r[11] or '',
+        'status': r[4],
+        'created_at': r[5].isoformat() if r[5] else '',
+        'plan_type': r[6],
+        'amount': r[7],
+        'access_info': access_info
+    }
+
+def encode_cursor(created_at: datetime, request_id: int) -> str:
+    return base64.urlsafe_b64encode(f'{created_at.isoformat()}|{request_id}'.encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    created_at, request_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created_at), int(request_id)
+
+def parse_date_bound(value: str, inclusive_day: bool) -> datetime:
+    """Граница периода; дата без времени в date_to означает «весь этот день»"""
+    bound = datetime.fromisoformat(value)
+    if inclusive_day and len(value) == 10:
+        bound += timedelta(days=1)
+    return bound
+
+def build_list_filters(params: Dict[str, str]) -> Tuple[List[str], List[Any]]:
+    """WHERE-условия списка заявок по статусу, тарифу и периоду"""
+    conditions: List[str] = []
+    values: List[Any] = []
+    if params.get('status'):
+        conditions.append('pr.status = %s')
+        values.append(params['status'])
+    if params.get('plan_type'):
+        conditions.append('pr.plan_type = %s')
+        values.append(params['plan_type'])
+    if params.get('date_from'):
+        conditions.append('pr.created_at >= %s')
+        values.append(parse_date_bound(params['date_from'], inclusive_day=False))
+    if params.get('date_to'):
+        conditions.append('pr.created_at < %s')
+        values.append(parse_date_bound(params['date_to'], inclusive_day=True))
+    return conditions, values
+
+def estimate_count(cur: Any, schema: str, conditions: List[str], values: List[Any]) -> int:
+    """Оценка числа строк по статистике планировщика, без COUNT(*)"""
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    cur.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM {schema}.payment_requests pr {where}", values)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', '2000'))
+EXPORT_URL_TTL = int(os.environ.get('EXPORT_URL_TTL', '3600'))
+# Выгрузки с персональными данными живут в бакете не дольше срока ссылки (и не меньше его)
+EXPORT_TTL = max(int(os.environ.get('EXPORT_TTL', '86400')), EXPORT_URL_TTL)
+EXPORT_PREFIX = 'exports/'
+EXPORT_FIELDS = ['id', 'email', 'phone', 'status', 'plan_type', 'amount', 'created_at', 'approved_at', 'screenshot_url']
+
+class IterStream(io.RawIOBase):
+    """Файловый объект поверх итератора байтовых кусков — для потоковой загрузки в S3"""
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        self._chunks = chunks
+        self._pending = b''
+    
+    def readable(self) -> bool:
+        return True
+    
+    def readinto(self, buffer: Any) -> int:
+        while not self._pending:
+            try:
+                self._pending = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+def export_lines(conn: Any, schema: str, conditions: List[str], values: List[Any], fmt: str, stats: Dict[str, int]) -> Iterator[bytes]:
+    """Читает заявки именованным (серверным) курсором порциями и отдаёт строки CSV или NDJSON"""
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    cur = conn.cursor(name='payment_requests_export')
+    cur.itersize = EXPORT_CHUNK_ROWS
+    cur.execute(f"""
+        SELECT pr.id, pr.email, pr.phone, pr.status, pr.plan_type, pr.amount, pr.created_at, pr.approved_at, pr.screenshot_url
+        FROM {schema}.payment_requests pr
+        {where}
+        ORDER BY pr.created_at, pr.id
+    """, values)
+    
+    line = io.StringIO()
+    writer = csv.writer(line)
+    if fmt == 'csv':
+        writer.writerow(EXPORT_FIELDS)
+        yield line.getvalue().encode('utf-8')
+    
+    for row in cur:
+        record = [v.isoformat() if isinstance(v, datetime) else v for v in row]
+        if fmt == 'csv':
+            line.seek(0)
+            line.truncate()
+            writer.writerow(record)
+            yield line.getvalue().encode('utf-8')
+        else:
+            yield (json.dumps(dict(zip(EXPORT_FIELDS, record)), ensure_ascii=False) + '\n').encode('utf-8')
+        stats['rows'] += 1
+    
+    cur.close()
+
+def gzip_chunks(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client() -> Any:
+    """S3-клиент прогретого контейнера: создаётся один раз и переиспользует keep-alive соединения"""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                import boto3
+                _s3_client = boto3.client('s3',
+                    endpoint_url='https://bucket.poehali.dev',
+                    aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                    aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+                )
+    return _s3_client
+
+def cleanup_exports(s3: Any, keep: str) -> int:
+    """Удаляет выгрузки старше EXPORT_TTL, кроме только что созданной keep; вызывается при каждой выгрузке"""
+    cutoff = time.time() - EXPORT_TTL
+    expired = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket='files', Prefix=EXPORT_PREFIX):
+        for obj in page.get('Contents', []):
+            if obj['Key'] != keep and obj['LastModified'].timestamp() < cutoff:
+                expired.append({'Key': obj['Key']})
+    for i in range(0, len(expired), 1000):
+        s3.delete_objects(Bucket='files', Delete={'Objects': expired[i:i + 1000], 'Quiet': True})
+    return len(expired)
+
+BULK_MAX_IDS = 1000
+
+def parse_bulk_ids(params: Dict[str, str], event: Dict[str, Any]) -> List[int]:
+    """id заявок из ?ids=1,2,3 или из JSON-тела {"ids": [...]}"""
+    if params.get('ids'):
+        raw_ids = params['ids'].split(',')
+    else:
+        raw_ids = json.loads(event.get('body') or '{}').get('ids', [])
+    ids = list(dict.fromkeys(int(i) for i in raw_ids))
+    if not ids or len(ids) > BULK_MAX_IDS:
+        raise ValueError('ids')
+    return ids
+
+LIST_ETAG_SETTLE = float(os.environ.get('LIST_ETAG_SETTLE', '5'))
+
+def list_etag(cur: Any, schema: str, params: Dict[str, str]) -> Optional[str]:
+    """
+    ETag списка: водяные знаки payment_requests и active_access (max(updated_at) по индексу
+    и время последнего удаления из list_deletions) + отпечаток параметров запроса.
+    None, пока последнее изменение моложе LIST_ETAG_SETTLE секунд: транзакция с более ранней
+    меткой могла ещё не закоммититься, и выданный сейчас ETag пропустил бы её изменения
+    """
+    cur.execute(f"""
+        SELECT (SELECT MAX(updated_at) FROM {schema}.payment_requests),
+               (SELECT MAX(updated_at) FROM {schema}.active_access),
+               (SELECT MAX(deleted_at) FROM {schema}.list_deletions),
+               clock_timestamp()::TIMESTAMP
+    """)
+    requests_max, access_max, deleted_max, now = cur.fetchone()
+    latest = max((t for t in (requests_max, access_max, deleted_max) if t), default=None)
+    if latest and (now - latest).total_seconds() < LIST_ETAG_SETTLE:
+        return None
+    version = hashlib.md5(f'{requests_max}|{access_max}|{deleted_max}'.encode()).hexdigest()[:16]
+    fingerprint = hashlib.md5(json.dumps(sorted(params.items())).encode()).hexdigest()[:12]
+    return f'"{version}-{fingerprint}"'
+
+def etag_matches(event: Dict[str, Any], etag: str) -> bool:
+    request_headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    candidates = request_headers.get('if-none-match', '')
+    return any(c.strip().removeprefix('W/') in (etag, '*') for c in candidates.split(',') if c.strip())
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Прямая админка через GET параметры (без CORS preflight)
@@ -25,94 +307,199 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     try:
         schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_connection()
         cur = conn.cursor()
         
         params = event.get('queryStringParameters') or {}
         action = params.get('action', 'list')
         
         if action == 'list':
+            # Админка опрашивает список: без изменений отвечаем 304, не выполняя JOIN
+            etag = list_etag(cur, schema, params)
+            list_headers = {**headers, 'Cache-Control': 'no-cache'}
+            if etag:
+                list_headers.update({'ETag': etag, 'Access-Control-Expose-Headers': 'ETag'})
+            if etag and etag_matches(event, etag):
+                cur.close()
+                release_connection(conn)
+                return {'statusCode': 304, 'headers': list_headers, 'body': '', 'isBase64Encoded': False}
+        
+        if action == 'list' and not (params.get('limit') or params.get('cursor')):
+            # Старый формат: весь список одним массивом
             cur.execute(f"""
-                SELECT pr.id, pr.email, pr.phone, pr.screenshot_url, pr.status, pr.created_at, pr.plan_type, pr.amount,
-                       aa.plan_type, aa.expires_at, aa.downloads_left
+                SELECT {REQUEST_COLUMNS}
                 FROM {schema}.payment_requests pr
                 LEFT JOIN {schema}.active_access aa ON pr.email = aa.email
                 ORDER BY pr.created_at DESC
             """)
+            result = [serialize_request(r) for r in cur.fetchall()]
+            
+            cur.close()
+            release_connection(conn)
+            return {'statusCode': 200, 'headers': list_headers, 'body': json.dumps(result), 'isBase64Encoded': False}
+        
+        elif action == 'list':
+            # Постраничный список: курсор по (created_at, id), фильтры status/plan_type/date_from/date_to
+            try:
+                limit = min(max(int(params.get('limit') or LIST_PAGE_DEFAULT), 1), LIST_PAGE_MAX)
+                conditions, values = build_list_filters(params)
+                cursor = decode_cursor(params['cursor']) if params.get('cursor') else None
+            except ValueError:
+                cur.close()
+                release_connection(conn)
+                return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'Invalid list parameters'}), 'isBase64Encoded': False}
+            
+            total_estimate = estimate_count(cur, schema, conditions, values)
+            
+            page_conditions = list(conditions)
+            page_values = list(values)
+            if cursor:
+                # created_at <= ... отдельно, чтобы граница попадала в индекс по created_at
+                page_conditions.append('pr.created_at <= %s AND (pr.created_at < %s OR pr.id < %s)')
+                page_values.extend([cursor[0], cursor[0], cursor[1]])
+            where = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ''
+            
+            cur.execute(f"""
+                SELECT {REQUEST_COLUMNS}
+                FROM {schema}.payment_requests pr
+                LEFT JOIN {schema}.active_access aa ON pr.email = aa.email
+                {where}
+                ORDER BY pr.created_at DESC, pr.id DESC
+                LIMIT %s
+            """, page_values + [limit + 1])
             rows = cur.fetchall()
             
-            result = []
-            for r in rows:
-                access_info = None
-                if r[8]:  # has active_access
-                    access_info = {
-                        'plan_type': r[8],
-                        'expires_at': r[9].isoformat() if r[9] else None,
-                        'downloads_left': r[10]
-                    }
-                
-                result.append({
-                    'id': r[0],
-                    'email': r[1],
-                    'phone': r[2] or '',
-                    'screenshot_url': r[3] or '',
-                    'status': r[4],
-                    'created_at': r[5].isoformat() if r[5] else '',
-                    'plan_type': r[6],
-                    'amount': r[7],
-                    'access_info': access_info
-                })
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = encode_cursor(rows[-1][5], rows[-1][0])
+            
+            cur.close()
+            release_connection(conn)
+            return {'statusCode': 200, 'headers': list_headers, 'body': json.dumps({
+                'items': [serialize_request(r) for r in rows],
+                'next_cursor': next_cursor,
+                'total_estimate': total_estimate
+            }), 'isBase64Encoded': False}
+        
+        elif action == 'stats':
+            # Дашборд: выручка и число заявок по дням/тарифам/статусам из payment_stats_daily
+            conditions = []
+            values: List[Any] = []
+            try:
+                if params.get('date_from'):
+                    conditions.append('day >= %s')
+                    values.append(date.fromisoformat(params['date_from']))
+                if params.get('date_to'):
+                    conditions.append('day <= %s')
+                    values.append(date.fromisoformat(params['date_to']))
+            except ValueError:
+                cur.close()
+                release_connection(conn)
+                return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'Invalid date'}), 'isBase64Encoded': False}
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
             
+            cur.execute(f"""
+                SELECT day, plan_type, status, requests, amount
+                FROM {schema}.payment_stats_daily
+                {where}
+                ORDER BY day, plan_type, status
+            """, values)
+            rows = cur.fetchall()
             cur.close()
-            conn.close()
-            return {'statusCode': 200, 'headers': headers, 'body': json.dumps(result), 'isBase64Encoded': False}
+            release_connection(conn)
+            
+            days = []
+            by_plan: Dict[str, Dict[str, Dict[str, int]]] = {}
+            revenue = 0
+            for day, plan_type, status, requests_count, amount in rows:
+                if not requests_count:
+                    continue
+                days.append({'day': day.isoformat(), 'plan_type': plan_type, 'status': status, 'requests': requests_count, 'amount': amount})
+                totals = by_plan.setdefault(plan_type, {}).setdefault(status, {'requests': 0, 'amount': 0})
+                totals['requests'] += requests_count
+                totals['amount'] += amount
+                if status == 'approved':
+                    revenue += amount
+            
+            return {'statusCode': 200, 'headers': headers, 'body': json.dumps({
+                'days': days,
+                'by_plan': by_plan,
+                'revenue': revenue
+            }), 'isBase64Encoded': False}
+        
+        elif action == 'export':
+            # Выгрузка для бухгалтерии: format=csv|ndjson, gzip=1, date_from/date_to.
+            # Строки идут из серверного курсора прямо в составную загрузку S3, память не растёт
+            fmt = params.get('format', 'csv')
+            use_gzip = params.get('gzip') in ('1', 'true')
+            try:
+                if fmt not in ('csv', 'ndjson'):
+                    raise ValueError(fmt)
+                conditions, values = build_list_filters(params)
+            except ValueError:
+                cur.close()
+                release_connection(conn)
+                return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'Invalid export parameters'}), 'isBase64Encoded': False}
+            
+            from boto3.s3.transfer import TransferConfig
+            
+            stats = {'rows': 0}
+            chunks = export_lines(conn, schema, conditions, values, fmt, stats)
+            if use_gzip:
+                chunks = gzip_chunks(chunks)
+            
+            # Случайная часть ключа: по времени выгрузки ссылку на неё не подобрать
+            file_key = (
+                f"{EXPORT_PREFIX}payment-requests-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex}.{fmt}"
+                + ('.gz' if use_gzip else '')
+            )
+            content_type = 'application/gzip' if use_gzip else ('text/csv' if fmt == 'csv' else 'application/x-ndjson')
+            
+            s3 = get_s3_client()
+            s3.upload_fileobj(
+                io.BufferedReader(IterStream(chunks)), 'files', file_key,
+                ExtraArgs={'ContentType': content_type},
+                Config=TransferConfig(use_threads=False)
+            )
+            conn.commit()
+            cur.close()
+            release_connection(conn)
+            
+            try:
+                removed = cleanup_exports(s3, file_key)
+                if removed:
+                    print(f"Export cleanup: {removed} expired exports removed")
+            except Exception as e:
+                print(f"WARNING: export cleanup failed: {str(e)}")
+            
+            url = s3.generate_presigned_url('get_object', Params={'Bucket': 'files', 'Key': file_key}, ExpiresIn=EXPORT_URL_TTL)
+            return {'statusCode': 200, 'headers': headers, 'body': json.dumps({
+                'url': url,
+                'rows': stats['rows'],
+                'format': fmt,
+                'gzip': use_gzip
+            }), 'isBase64Encoded': False}
         
         elif action == 'grant':
             email = params.get('email')
             plan = params.get('plan_type', 'month')
             
             if not email:
+                cur.close()
+                release_connection(conn)
                 return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'Email required'}), 'isBase64Encoded': False}
             
-            exp = None
-            dl = None
-            
-            if plan == 'single':
-                dl = 1
-            elif plan == 'month':
-                exp = datetime.now() + timedelta(days=30)
-            elif plan == 'half_year':
-                exp = datetime.now() + timedelta(days=180)
-            elif plan == 'year':
-                exp = datetime.now() + timedelta(days=365)
-            
-            cur.execute(f"SELECT plan_type, downloads_left FROM {schema}.active_access WHERE email = %s", (email,))
-            existing = cur.fetchone()
-            
-            if existing and plan == 'single':
-                existing_downloads = existing[1] or 0
-                new_downloads = existing_downloads + 1
-                cur.execute(f"""
-                    UPDATE {schema}.active_access 
-                    SET downloads_left = %s, granted_at = CURRENT_TIMESTAMP
-                    WHERE email = %s
-                """, (new_downloads, email))
-            elif existing:
-                cur.execute(f"""
-                    UPDATE {schema}.active_access 
-                    SET plan_type = %s, expires_at = %s, downloads_left = %s, granted_at = CURRENT_TIMESTAMP
-                    WHERE email = %s
-                """, (plan, exp, dl, email))
-            else:
-                cur.execute(f"""
-                    INSERT INTO {schema}.active_access (email, plan_type, expires_at, downloads_left, granted_by)
-                    VALUES (%s, %s, %s, %s, 'admin')
-                """, (email, plan, exp, dl))
+            cur.execute(f"SELECT plan_type FROM {schema}.grant_access(%s, %s, 'admin')", (email, plan))
+            if not cur.fetchone():
+                cur.close()
+                release_connection(conn)
+                return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'Unknown plan'}), 'isBase64Encoded': False}
             
             conn.commit()
             
             cur.close()
-            conn.close()
+            release_connection(conn)
             return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'ok': True}), 'isBase64Encoded': False}
         
         elif action == 'approve':
@@ -120,72 +507,96 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             email = params.get('email')
             
             if not rid or not email:
+                cur.close()
+                release_connection(conn)
                 return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'ID and email required'}), 'isBase64Encoded': False}
             
-            cur.execute(f"SELECT plan_type FROM {schema}.payment_requests WHERE id = %s", (rid,))
-            row = cur.fetchone()
-            if not row:
+            # Статус заявки и выдача доступа одним запросом
+            cur.execute(f"""
+                WITH req AS (
+                    UPDATE {schema}.payment_requests
+                    SET status = 'approved', approved_at = CURRENT_TIMESTAMP
+                    WHERE id = %s
+                    RETURNING plan_type
+                )
+                SELECT g.plan_type
+                FROM req, LATERAL {schema}.grant_access(%s, req.plan_type, 'admin') g
+            """, (rid, email))
+            if not cur.fetchone():
+                cur.close()
+                release_connection(conn)
                 return {'statusCode': 404, 'headers': headers, 'body': json.dumps({'error': 'Request not found'}), 'isBase64Encoded': False}
             
-            plan = row[0]
-            
-            exp = None
-            dl = None
-            
-            if plan == 'single':
-                dl = 1
-            elif plan == 'month':
-                exp = datetime.now() + timedelta(days=30)
-            elif plan == 'half_year':
-                exp = datetime.now() + timedelta(days=180)
-            elif plan == 'year':
-                exp = datetime.now() + timedelta(days=365)
-            
-            cur.execute(f"UPDATE {schema}.payment_requests SET status = 'approved', approved_at = %s WHERE id = %s", (datetime.now(), rid))
-            
-            cur.execute(f"SELECT plan_type, downloads_left FROM {schema}.active_access WHERE email = %s", (email,))
-            existing = cur.fetchone()
-            
-            if existing and plan == 'single':
-                existing_downloads = existing[1] or 0
-                new_downloads = existing_downloads + 1
-                cur.execute(f"""
-                    UPDATE {schema}.active_access 
-                    SET downloads_left = %s, granted_at = CURRENT_TIMESTAMP
-                    WHERE email = %s
-                """, (new_downloads, email))
-            elif existing and plan != 'single':
-                cur.execute(f"""
-                    UPDATE {schema}.active_access 
-                    SET plan_type = %s, expires_at = %s, downloads_left = %s, granted_at = CURRENT_TIMESTAMP
-                    WHERE email = %s
-                """, (plan, exp, dl, email))
-            else:
-                cur.execute(f"""
-                    INSERT INTO {schema}.active_access (email, plan_type, expires_at, downloads_left, granted_by)
-                    VALUES (%s, %s, %s, %s, 'admin')
-                """, (email, plan, exp, dl))
-            
             conn.commit()
             
             cur.close()
-            conn.close()
+            release_connection(conn)
             return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'ok': True}), 'isBase64Encoded': False}
         
         elif action == 'reject':
             rid = int(params.get('id', 0))
             
             if not rid:
+                cur.close()
+                release_connection(conn)
                 return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'ID required'}), 'isBase64Encoded': False}
             
             cur.execute(f"UPDATE {schema}.payment_requests SET status = 'rejected' WHERE id = %s", (rid,))
             conn.commit()
             cur.close()
-            conn.close()
+            release_connection(conn)
             return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'ok': True}), 'isBase64Encoded': False}
         
+        elif action in ('bulk_approve', 'bulk_reject'):
+            try:
+                ids = parse_bulk_ids(params, event)
+            except (ValueError, TypeError):
+                cur.close()
+                release_connection(conn)
+                return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': f'ids required (max {BULK_MAX_IDS})'}), 'isBase64Encoded': False}
+            
+            if action == 'bulk_approve':
+                # Все заявки одним запросом: статус и grant_access по каждой заявке в порядке id,
+                # так что несколько заявок одного email складываются как при поштучном одобрении
+                cur.execute(f"""
+                    WITH done AS (
+                        UPDATE {schema}.payment_requests
+                        SET status = 'approved', approved_at = CURRENT_TIMESTAMP
+                        WHERE id = ANY(%s) AND status <> 'approved'
+                        RETURNING id, email, plan_type
+                    ),
+                    granted AS (
+                        SELECT d.id
+                        FROM (SELECT * FROM done ORDER BY id) d,
+                             LATERAL {schema}.grant_access(d.email, d.plan_type, 'admin') g
+                    )
+                    SELECT i.id, CASE WHEN g.id IS NOT NULL THEN 'approved' WHEN pr.id IS NULL THEN 'not_found' ELSE 'already_approved' END
+                    FROM UNNEST(%s::INTEGER[]) AS i(id)
+                    LEFT JOIN granted g ON g.id = i.id
+                    LEFT JOIN {schema}.payment_requests pr ON pr.id = i.id
+                """, (ids, ids))
+            else:
+                cur.execute(f"""
+                    WITH done AS (
+                        UPDATE {schema}.payment_requests
+                        SET status = 'rejected'
+                        WHERE id = ANY(%s) AND status <> 'rejected'
+                        RETURNING id
+                    )
+                    SELECT i.id, CASE WHEN d.id IS NOT NULL THEN 'rejected' WHEN pr.id IS NULL THEN 'not_found' ELSE 'already_rejected' END
+                    FROM UNNEST(%s::INTEGER[]) AS i(id)
+                    LEFT JOIN done d ON d.id = i.id
+                    LEFT JOIN {schema}.payment_requests pr ON pr.id = i.id
+                """, (ids, ids))
+            
+            results = {str(rid): outcome for rid, outcome in cur.fetchall()}
+            conn.commit()
+            cur.close()
+            release_connection(conn)
+            return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'ok': True, 'results': results}), 'isBase64Encoded': False}
+        
         cur.close()
-        conn.close()
+        release_connection(conn)
         return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'Unknown action'}), 'isBase64Encoded': False}
     
     except Exception as e:
@@ -1,19 +1,298 @@
 import json
 import os
 import base64
-import smtplib
+import binascii
+import threading
+import time
+import bisect
+import hashlib
 import psycopg2
-import requests
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, connection as PgConnection
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
 from datetime import datetime
-from typing import Dict, Any, Optional
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+from typing import Dict, Any, Optional, List, Tuple, Callable
+
+DB_POOL_MAX_IDLE = int(os.environ.get('DB_POOL_MAX_IDLE', '4'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+_pool_lock = threading.Lock()
+_pool_idle: List[Tuple[Any, float]] = []
+_pool_stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'reconnects': 0}
+
+class PooledConnection(PgConnection):
+    """Соединение пула; помнит, какие запросы уже подготовлены в его сессии"""
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared_statements: set = set()
+
+def _close_quietly(conn: Any) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+def _connection_alive(conn: Any, released_at: float) -> bool:
+    """Проверяет, что соединение из пула ещё живо (пингуем только давно простаивающие)"""
+    if conn.closed:
+        return False
+    if time.monotonic() - released_at < DB_POOL_PING_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_connection() -> Any:
+    """Берёт соединение из пула прогретого контейнера или открывает новое"""
+    while True:
+        with _pool_lock:
+            if not _pool_idle:
+                _pool_stats['misses'] += 1
+                break
+            conn, released_at = _pool_idle.pop()
+        if _connection_alive(conn, released_at):
+            with _pool_lock:
+                _pool_stats['hits'] += 1
+            return conn
+        with _pool_lock:
+            _pool_stats['reconnects'] += 1
+        _close_quietly(conn)
+    return psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=PooledConnection)
+
+def release_connection(conn: Any) -> None:
+    """Возвращает соединение в пул; битые и лишние соединения закрываются"""
+    if conn.closed:
+        return
+    try:
+        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        _close_quietly(conn)
+        return
+    with _pool_lock:
+        if len(_pool_idle) < DB_POOL_MAX_IDLE:
+            _pool_idle.append((conn, time.monotonic()))
+            return
+    _close_quietly(conn)
+
+def get_pool_stats() -> Dict[str, int]:
+    """Счётчики пула: hits — переиспользованные соединения, misses — новые, reconnects — выброшенные битые"""
+    with _pool_lock:
+        return dict(_pool_stats, idle=len(_pool_idle))
+
+# Горячие запросы: готовятся на сервере один раз на соединение пула
+STATEMENTS: Dict[str, str] = {
+    'select_entitlement': """
+        SELECT plan_type, expires_at, downloads_left
+        FROM active_access
+        WHERE email = $1
+    """,
+    # Списание и запись скачивания одним запросом. Пакет скачиваний уменьшается условным UPDATE
+    # под блокировкой строки, поэтому параллельные запросы не уводят остаток ниже нуля.
+    # Безлимит строку не переписывает (иначе каждое скачивание будило бы NOTIFY и триггеры
+    # active_access): её только держит FOR SHARE, пока скачивание записывается.
+    # Сам расчёт хранится один раз в calculations, скачивание ссылается на него по хэшу
+    'record_download': """
+        WITH limited AS (
+            UPDATE active_access
+            SET downloads_left = downloads_left - 1
+            WHERE email = $1
+              AND downloads_left > 0
+              AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+            RETURNING downloads_left
+        ), unlimited AS (
+            SELECT downloads_left
+            FROM active_access
+            WHERE email = $1
+              AND downloads_left IS NULL
+              AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+            FOR SHARE
+        ), access AS (
+            SELECT downloads_left FROM limited
+            UNION ALL
+            SELECT downloads_left FROM unlimited
+        ), calculation AS (
+            INSERT INTO calculations (hash, data)
+            SELECT sha256(convert_to($2::jsonb::text, 'UTF8')), $2::jsonb FROM access
+            ON CONFLICT (hash) DO NOTHING
+        ), download AS (
+            INSERT INTO downloads (email, calculation_hash)
+            SELECT $1, sha256(convert_to($2::jsonb::text, 'UTF8')) FROM access
+        )
+        SELECT downloads_left FROM access
+    """,
+    'enqueue_email': """
+        INSERT INTO email_outbox (recipient_email, recipient_name, pdf_key)
+        VALUES ($1, $2, $3)
+        RETURNING id
+    """
+}
+
+TIMING_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+_statement_timings: Dict[str, List[int]] = {}
+_statement_timings_lock = threading.Lock()
+
+def execute_prepared(cur: Any, name: str, params: Tuple = ()) -> None:
+    """Выполняет запрос из реестра STATEMENTS: PREPARE один раз на соединение, дальше только EXECUTE"""
+    conn = cur.connection
+    try:
+        if name not in conn.prepared_statements:
+            cur.execute(f'PREPARE {name} AS {STATEMENTS[name]}')
+            conn.prepared_statements.add(name)
+        started = time.perf_counter()
+        if params:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            cur.execute(f'EXECUTE {name}')
+    except psycopg2.Error:
+        # Устаревший план или сбой сессии: соединение вместе с его PREPARE больше не используем
+        _close_quietly(conn)
+        raise
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    bucket = bisect.bisect_left(TIMING_BUCKETS_MS, elapsed_ms)
+    with _statement_timings_lock:
+        histogram = _statement_timings.setdefault(name, [0] * (len(TIMING_BUCKETS_MS) + 1))
+        histogram[bucket] += 1
+
+def get_statement_stats() -> Dict[str, Dict[str, int]]:
+    """Гистограммы времени выполнения подготовленных запросов"""
+    labels = [f'<={bound}ms' for bound in TIMING_BUCKETS_MS] + [f'>{TIMING_BUCKETS_MS[-1]}ms']
+    with _statement_timings_lock:
+        return {name: dict(zip(labels, counts)) for name, counts in _statement_timings.items()}
+
+ENTITLEMENT_CACHE_TTL = float(os.environ.get('ENTITLEMENT_CACHE_TTL', '60'))
+ENTITLEMENT_CACHE_SIZE = int(os.environ.get('ENTITLEMENT_CACHE_SIZE', '1024'))
+ENTITLEMENT_CHANNEL = 'active_access_changed'
+
+_MISSING = object()
+_entitlements: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+_entitlements_lock = threading.Lock()
+_listen_conn: Any = None
+_listen_lock = threading.Lock()
+
+def _drain_entitlement_notifications() -> None:
+    """Сбрасывает из кэша записи, о смене которых сообщил NOTIFY триггера active_access"""
+    global _listen_conn
+    # Соединение LISTEN одно на контейнер: poll() из нескольких потоков сразу зависает
+    with _listen_lock:
+        try:
+            if _listen_conn is None or _listen_conn.closed:
+                _listen_conn = psycopg2.connect(os.environ['DATABASE_URL'])
+                _listen_conn.autocommit = True
+                with _listen_conn.cursor() as cur:
+                    cur.execute(f'LISTEN {ENTITLEMENT_CHANNEL}')
+                # Пока слушателя не было, изменения могли пройти мимо
+                with _entitlements_lock:
+                    _entitlements.clear()
+                return
+            _listen_conn.poll()
+        except psycopg2.Error:
+            if _listen_conn is not None:
+                _close_quietly(_listen_conn)
+            _listen_conn = None
+            with _entitlements_lock:
+                _entitlements.clear()
+            return
+        while _listen_conn.notifies:
+            notify = _listen_conn.notifies.pop(0)
+            with _entitlements_lock:
+                _entitlements.pop(notify.payload, None)
+
+def lookup_entitlement(email: str) -> Any:
+    """Возвращает закэшированную строку active_access (None — доступа нет) или _MISSING"""
+    if ENTITLEMENT_CACHE_TTL <= 0:
+        return _MISSING
+    _drain_entitlement_notifications()
+    with _entitlements_lock:
+        cached = _entitlements.get(email)
+        if cached is None:
+            return _MISSING
+        stored_at, row = cached
+        if time.monotonic() - stored_at > ENTITLEMENT_CACHE_TTL:
+            del _entitlements[email]
+            return _MISSING
+        _entitlements.move_to_end(email)
+        return row
+
+def remember_entitlement(email: str, row: Any) -> None:
+    """Кладёт строку active_access в LRU-кэш, вытесняя самые старые записи"""
+    if ENTITLEMENT_CACHE_TTL <= 0:
+        return
+    with _entitlements_lock:
+        _entitlements[email] = (time.monotonic(), row)
+        _entitlements.move_to_end(email)
+        while len(_entitlements) > ENTITLEMENT_CACHE_SIZE:
+            _entitlements.popitem(last=False)
+
+def forget_entitlement(email: str) -> None:
+    with _entitlements_lock:
+        _entitlements.pop(email, None)
+
+SIDE_EFFECT_WORKERS = int(os.environ.get('SIDE_EFFECT_WORKERS', '4'))
+SIDE_EFFECT_TIMEOUT = float(os.environ.get('SIDE_EFFECT_TIMEOUT', '10'))
+
+# Пул для уведомлений Telegram, которые drain_outbox шлёт параллельно со следующими письмами пачки.
+# В пути запроса download-report он не используется; живёт вместе с прогретым контейнером
+_side_effects = ThreadPoolExecutor(max_workers=SIDE_EFFECT_WORKERS, thread_name_prefix='side-effect')
+
+def submit_side_effect(fn: Callable[..., Any], *args: Any) -> Future:
+    """
+    Запускает задачу в пуле; результат future — (значение, время выполнения в мс).
+    В future.timing — моменты начала и конца задачи, они есть и у упавших задач
+    """
+    timing: Dict[str, float] = {}
+    
+    def run() -> Tuple[Any, float]:
+        timing['started'] = time.perf_counter()
+        try:
+            result = fn(*args)
+            return result, (time.perf_counter() - timing['started']) * 1000
+        finally:
+            timing['finished'] = time.perf_counter()
+    
+    future = _side_effects.submit(run)
+    future.timing = timing
+    return future
+
+def _side_effect_ms(future: Future) -> float:
+    """Сколько задача проработала: до конца или до текущего момента; 0 — ещё ждёт в очереди"""
+    timing = getattr(future, 'timing', {})
+    if 'started' not in timing:
+        return 0.0
+    return round((timing.get('finished', time.perf_counter()) - timing['started']) * 1000, 1)
+
+def collect_side_effects(tasks: Dict[str, Future], timeout: float = SIDE_EFFECT_TIMEOUT) -> Dict[str, Dict[str, Any]]:
+    """
+    Дожидается задач с общим сроком timeout секунд на всю пачку (задачи уже идут параллельно).
+    Возвращает по имени задачи результат или ошибку и фактическое время работы; пишет время в лог
+    """
+    outcomes: Dict[str, Dict[str, Any]] = {}
+    deadline = time.monotonic() + timeout
+    for name, future in tasks.items():
+        try:
+            result, elapsed_ms = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            outcomes[name] = {'ok': True, 'result': result, 'ms': round(elapsed_ms, 1)}
+        except FutureTimeoutError:
+            outcomes[name] = {'ok': False, 'error': 'timeout', 'ms': _side_effect_ms(future)}
+        except Exception as e:
+            outcomes[name] = {'ok': False, 'error': str(e), 'ms': _side_effect_ms(future)}
+    if outcomes:
+        print('SIDE_EFFECTS: ' + ', '.join(
+            f"{name}={'ok' if o['ok'] else o['error']} {o['ms']}ms"
+            for name, o in outcomes.items()
+        ))
+    return outcomes
 
 def send_telegram_notification(recipient_email: str, recipient_name: str) -> bool:
     """Отправка уведомления в Telegram о скачивании PDF"""
     try:
+        import requests
+        
         bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
         chat_id = os.environ.get('TELEGRAM_CHAT_ID')
         
@@ -41,89 +320,522 @@ def send_telegram_notification(recipient_email: str, recipient_name: str) -> boo
     except:
         return False
 
-def send_pdf_email(recipient_email: str, recipient_name: str, pdf_base64: str) -> bool:
-    """Отправка PDF на email клиента"""
-    try:
-        smtp_user = os.environ.get('SMTP_USER')
-        smtp_password = os.environ.get('SMTP_PASSWORD')
-        smtp_host = os.environ.get('SMTP_HOST')
-        smtp_port = int(os.environ.get('SMTP_PORT', '587'))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '20'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '6'))
+OUTBOX_BACKOFF_SECONDS = int(os.environ.get('OUTBOX_BACKOFF_SECONDS', '60'))
+OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', '300'))
+OUTBOX_PDF_RETENTION_DAYS = int(os.environ.get('OUTBOX_PDF_RETENTION_DAYS', '7'))
+OUTBOX_EXPIRE_BATCH = 1000  # предел delete_objects за один вызов
+
+def build_pdf_message(sender: str, recipient_email: str, recipient_name: str, pdf_data: bytes) -> Any:
+    """Письмо клиенту с PDF-отчётом во вложении"""
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.base import MIMEBase
+    from email import encoders
+    
+    msg = MIMEMultipart()
+    msg['From'] = sender
+    msg['To'] = recipient_email
+    msg['Subject'] = f'Ваш персональный отчёт Матрица Судьбы - {recipient_name}'
+    
+    html_body = f'''
+    <html>
+    <body style="font-family: Arial, sans-serif; color: #333;">
+        <h2 style="color: #2980b9;">Здравствуйте, {recipient_name}! 👋</h2>
+        <p>Ваш <strong>персональный PDF-отчёт Матрица Судьбы</strong> готов!</p>
         
-        print(f'DEBUG: SMTP configured: {bool(smtp_user and smtp_password and smtp_host)}')
-        print(f'DEBUG: SMTP host: {smtp_host}, port: {smtp_port}')
+        <div style="background: #f8f9fa; padding: 20px; border-radius: 8px; margin: 20px 0;">
+            <h3 style="color: #2980b9; margin-top: 0;">📊 В отчёте вы найдёте:</h3>
+            <ul style="line-height: 1.8;">
+                <li>✨ Расшифровку всех 4 ключевых энергий</li>
+                <li>💊 Детальные рекомендации по здоровью</li>
+                <li>💕 Советы по отношениям и совместимости</li>
+                <li>💰 Стратегии финансов и карьеры</li>
+                <li>🎯 Профессии по вашему предназначению</li>
+            </ul>
+        </div>
         
-        if not all([smtp_user, smtp_password, smtp_host]):
-            print('ERROR: Missing SMTP credentials')
-            return False
+        <p>PDF-файл прикреплён к этому письму.</p>
         
-        msg = MIMEMultipart()
-        msg['From'] = smtp_user
-        msg['To'] = recipient_email
-        msg['Subject'] = f'Ваш персональный отчёт Матрица Судьбы - {recipient_name}'
+        <p style="margin-top: 30px;">
+            <strong>Используйте эти знания для осознанной жизни! 🚀</strong>
+        </p>
         
-        html_body = f'''
-        <html>
-        <body style="font-family: Arial, sans-serif; color: #333;">
-            <h2 style="color: #2980b9;">Здравствуйте, {recipient_name}! 👋</h2>
-            <p>Ваш <strong>персональный PDF-отчёт Матрица Судьбы</strong> готов!</p>
-            
-            <div style="background: #f8f9fa; padding: 20px; border-radius: 8px; margin: 20px 0;">
-                <h3 style="color: #2980b9; margin-top: 0;">📊 В отчёте вы найдёте:</h3>
-                <ul style="line-height: 1.8;">
-                    <li>✨ Расшифровку всех 4 ключевых энергий</li>
-                    <li>💊 Детальные рекомендации по здоровью</li>
-                    <li>💕 Советы по отношениям и совместимости</li>
-                    <li>💰 Стратегии финансов и карьеры</li>
-                    <li>🎯 Профессии по вашему предназначению</li>
-                </ul>
-            </div>
-            
-            <p>PDF-файл прикреплён к этому письму.</p>
-            
-            <p style="margin-top: 30px;">
-                <strong>Используйте эти знания для осознанной жизни! 🚀</strong>
-            </p>
+        <hr style="border: none; border-top: 1px solid #ddd; margin: 30px 0;">
+        
+        <p style="color: #666; font-size: 12px;">
+            Если у вас возникли вопросы, ответьте на это письмо или посетите наш сайт 
+            <a href="https://xn----7sbbaano7aqfmvd0b8d.xn--p1ai" style="color: #2980b9;">о-тебе.рф</a>
+        </p>
+    </body>
+    </html>
+    '''
+    
+    msg.attach(MIMEText(html_body, 'html', 'utf-8'))
+    
+    pdf_attachment = MIMEBase('application', 'pdf')
+    pdf_attachment.set_payload(pdf_data)
+    encoders.encode_base64(pdf_attachment)
+    pdf_attachment.add_header(
+        'Content-Disposition',
+        f'attachment; filename="matrix-{recipient_name}.pdf"'
+    )
+    msg.attach(pdf_attachment)
+    return msg
+
+def open_smtp_session() -> Any:
+    """SMTP-соединение после STARTTLS и логина; переиспользуется для всей пачки писем"""
+    import smtplib
+    
+    smtp_host = os.environ['SMTP_HOST']
+    smtp_port = int(os.environ.get('SMTP_PORT', '587'))
+    print(f'DEBUG: Connecting to SMTP {smtp_host}:{smtp_port}')
+    server = smtplib.SMTP(smtp_host, smtp_port, timeout=30)
+    server.starttls()
+    server.login(os.environ['SMTP_USER'], os.environ['SMTP_PASSWORD'])
+    return server
+
+def drain_outbox() -> Dict[str, int]:
+    """
+    Обработчик очереди email_outbox: забирает пачку писем под аренду (SKIP LOCKED),
+    отправляет их через одну SMTP-сессию, неудачные откладывает с экспоненциальной задержкой
+    """
+    import smtplib
+    
+    stats = {'sent': 0, 'retried': 0, 'failed': 0}
+    if not all([os.environ.get('SMTP_USER'), os.environ.get('SMTP_PASSWORD'), os.environ.get('SMTP_HOST')]):
+        print('ERROR: Missing SMTP credentials')
+        return stats
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE email_outbox
+        SET next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+        WHERE id IN (
+            SELECT id FROM email_outbox
+            WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+            ORDER BY next_attempt_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, recipient_email, recipient_name, pdf_key, pdf, attempts
+    """, (OUTBOX_LEASE_SECONDS, OUTBOX_BATCH_SIZE))
+    jobs = cur.fetchall()
+    conn.commit()
+    
+    server = None
+    notifications: Dict[str, Future] = {}
+    for job_id, recipient_email, recipient_name, pdf_key, pdf, attempts in jobs:
+        try:
+            # pdf — письма, поставленные в очередь до перехода на pdf_key
+            pdf_data = load_report_pdf(pdf_key) if pdf_key else bytes(pdf)
+            msg = build_pdf_message(os.environ['SMTP_USER'], recipient_email, recipient_name, pdf_data)
+            if server is None:
+                server = open_smtp_session()
+            try:
+                server.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                server = open_smtp_session()
+                server.send_message(msg)
             
-            <hr style="border: none; border-top: 1px solid #ddd; margin: 30px 0;">
+            cur.execute("""
+                UPDATE email_outbox
+                SET status = 'sent', sent_at = CURRENT_TIMESTAMP, attempts = attempts + 1, pdf = NULL, last_error = NULL
+                WHERE id = %s
+            """, (job_id,))
+            conn.commit()
+            stats['sent'] += 1
+            print(f'SUCCESS: Email sent to {recipient_email}')
+            # Уведомление уходит параллельно со следующими письмами пачки
+            notifications[f'telegram_{job_id}'] = submit_side_effect(send_telegram_notification, recipient_email, recipient_name)
+        except Exception as e:
+            print(f'ERROR: Failed to send email to {recipient_email}: {str(e)}')
+            if server is not None and isinstance(e, (smtplib.SMTPException, OSError)):
+                try:
+                    server.close()
+                except Exception:
+                    pass
+                server = None
             
-            <p style="color: #666; font-size: 12px;">
-                Если у вас возникли вопросы, ответьте на это письмо или посетите наш сайт 
-                <a href="https://xn----7sbbaano7aqfmvd0b8d.xn--p1ai" style="color: #2980b9;">о-тебе.рф</a>
-            </p>
-        </body>
-        </html>
-        '''
-        
-        msg.attach(MIMEText(html_body, 'html', 'utf-8'))
-        
-        pdf_data = base64.b64decode(pdf_base64)
-        pdf_attachment = MIMEBase('application', 'pdf')
-        pdf_attachment.set_payload(pdf_data)
-        encoders.encode_base64(pdf_attachment)
-        pdf_attachment.add_header(
-            'Content-Disposition',
-            f'attachment; filename="matrix-{recipient_name}.pdf"'
+            give_up = attempts + 1 >= OUTBOX_MAX_ATTEMPTS
+            cur.execute("""
+                UPDATE email_outbox
+                SET attempts = attempts + 1,
+                    last_error = %s,
+                    status = CASE WHEN %s THEN 'failed' ELSE 'pending' END,
+                    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                WHERE id = %s
+            """, (str(e)[:1000], give_up, OUTBOX_BACKOFF_SECONDS * 2 ** attempts, job_id))
+            conn.commit()
+            stats['failed' if give_up else 'retried'] += 1
+    
+    if server is not None:
+        try:
+            server.quit()
+        except Exception:
+            pass
+    
+    collect_side_effects(notifications)
+    
+    cur.close()
+    try:
+        stats['expired'] = expire_outbox_pdfs(conn)
+    finally:
+        release_connection(conn)
+    return stats
+
+def expire_outbox_pdfs(conn: Any) -> int:
+    """
+    Удаляет из S3 (REPORT_MAIL_S3_PREFIX) PDF отправленных и брошенных писем
+    старше OUTBOX_PDF_RETENTION_DAYS. Объект удаляется, только если на его ключ
+    не ссылается ни одно другое письмо: одинаковый PDF по адресу содержимого общий
+    """
+    if not REPORT_MAIL_S3_PREFIX:
+        return 0
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE email_outbox o
+        SET pdf_key = NULL
+        FROM (
+            SELECT id, pdf_key FROM email_outbox
+            WHERE status <> 'pending'
+              AND pdf_key IS NOT NULL
+              AND left(pdf_key, length(%s)) = %s
+              AND created_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ) expired
+        WHERE o.id = expired.id
+        RETURNING expired.pdf_key
+    """, (REPORT_MAIL_S3_PREFIX, REPORT_MAIL_S3_PREFIX, OUTBOX_PDF_RETENTION_DAYS, OUTBOX_EXPIRE_BATCH))
+    keys = {row[0] for row in cur.fetchall()}
+    if keys:
+        cur.execute('SELECT DISTINCT pdf_key FROM email_outbox WHERE pdf_key = ANY(%s)', (list(keys),))
+        keys -= {row[0] for row in cur.fetchall()}
+    if keys:
+        # Сначала бакет, потом коммит: при сбое удаления ключи остаются в очереди до следующего раза
+        try:
+            get_s3_client().delete_objects(
+                Bucket=S3_BUCKET,
+                Delete={'Objects': [{'Key': key} for key in sorted(keys)], 'Quiet': True}
+            )
+        except Exception:
+            conn.rollback()
+            cur.close()
+            raise
+    conn.commit()
+    cur.close()
+    if keys:
+        print(f'Outbox PDF expiry: {len(keys)} objects removed')
+    return len(keys)
+
+def read_raw_body(event: Dict[str, Any]) -> bytes:
+    """
+    Тело запроса в байтах: бинарные тела шлюз передаёт в base64.
+    binascii читает ASCII-строку напрямую, base64.b64decode сначала копирует её в bytes
+    """
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        return binascii.a2b_base64(body)
+    return body.encode('utf-8', 'surrogateescape')
+
+def parse_multipart(body: bytes, content_type: str) -> Dict[str, memoryview]:
+    """
+    Разбирает multipart/form-data без копирования частей:
+    значения — срезы memoryview поверх декодированного тела.
+    Само тело от шлюза всё равно декодируется из base64 целиком
+    """
+    boundary = None
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'boundary':
+            boundary = value.strip('"').encode('latin-1')
+    if not boundary:
+        raise ValueError('multipart boundary не указан')
+    
+    delimiter = b'--' + boundary
+    view = memoryview(body)
+    fields: Dict[str, memoryview] = {}
+    pos = body.find(delimiter)
+    while pos != -1:
+        start = pos + len(delimiter)
+        if body[start:start + 2] == b'--':
+            break
+        headers_end = body.find(b'\r\n\r\n', start)
+        if headers_end == -1:
+            break
+        data_end = body.find(b'\r\n' + delimiter, headers_end + 4)
+        if data_end == -1:
+            break
+        
+        name = None
+        for line in body[start:headers_end].decode('utf-8', 'replace').split('\r\n'):
+            header, _, value = line.partition(':')
+            if header.strip().lower() == 'content-disposition':
+                for item in value.split(';'):
+                    key, _, item_value = item.strip().partition('=')
+                    if key == 'name':
+                        name = item_value.strip('"')
+        if name:
+            fields[name] = view[headers_end + 4:data_end]
+        pos = data_end + 2
+    return fields
+
+def parse_upload(event: Dict[str, Any]) -> Tuple[Optional[str], str, Any, Optional[Any]]:
+    """
+    Достаёт email, имя, calculation_data и PDF из запроса.
+    Поддерживает JSON с pdf_base64, multipart/form-data (поле pdf)
+    и сырой application/pdf с остальными полями в query-параметрах
+    """
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    content_type = headers.get('content-type', 'application/json')
+    mime = content_type.split(';')[0].strip().lower()
+    
+    if mime == 'application/pdf':
+        params = event.get('queryStringParameters') or {}
+        pdf_data = memoryview(read_raw_body(event))
+        return (
+            params.get('email'),
+            params.get('name') or 'Клиент',
+            json.loads(params.get('calculation_data') or '{}'),
+            pdf_data if pdf_data.nbytes else None
         )
-        msg.attach(pdf_attachment)
+    
+    if mime == 'multipart/form-data':
+        fields = parse_multipart(read_raw_body(event), content_type)
         
-        print(f'DEBUG: Connecting to SMTP {smtp_host}:{smtp_port}')
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            print(f'DEBUG: Logging in as {smtp_user}')
-            server.login(smtp_user, smtp_password)
-            print(f'DEBUG: Sending email to {recipient_email}')
-            server.send_message(msg)
+        def text(name: str) -> Optional[str]:
+            value = fields.get(name)
+            return bytes(value).decode('utf-8') if value is not None else None
         
-        print(f'SUCCESS: Email sent to {recipient_email}')
-        return True
-    except Exception as e:
-        print(f'ERROR: Failed to send email: {str(e)}')
-        return False
+        pdf_data = fields.get('pdf')
+        return (
+            text('email'),
+            text('name') or 'Клиент',
+            json.loads(text('calculation_data') or '{}'),
+            pdf_data if pdf_data is not None and pdf_data.nbytes else None
+        )
+    
+    body_data = json.loads(event.get('body') or '{}')
+    pdf_base64 = body_data.get('pdf_base64')
+    return (
+        body_data.get('email'),
+        body_data.get('name', 'Клиент'),
+        body_data.get('calculation_data', {}),
+        binascii.a2b_base64(pdf_base64) if pdf_base64 else None
+    )
+
+REPORT_CACHE_DIR = os.environ.get('REPORT_CACHE_DIR', '/tmp/report-cache')
+REPORT_CACHE_MAX_BYTES = int(os.environ.get('REPORT_CACHE_MAX_BYTES', str(200 * 1024 * 1024)))
+REPORT_CACHE_S3_PREFIX = os.environ.get('REPORT_CACHE_S3_PREFIX', '')  # пусто: без S3-уровня
+REPORT_MAIL_S3_PREFIX = os.environ.get('REPORT_MAIL_S3_PREFIX', 'reports/mail/')
+# TTF-шрифт с кириллицей лежит рядом с функцией и деплоится вместе с ней
+REPORT_FONT_PATH = os.environ.get(
+    'REPORT_FONT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'DejaVuSans.ttf')
+)
+S3_BUCKET = 'files'
+
+ENERGY_TITLES = (
+    ('personal', 'Личная энергия'),
+    ('destiny', 'Энергия предназначения'),
+    ('social', 'Социальная энергия'),
+    ('spiritual', 'Духовная энергия'),
+)
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client() -> Any:
+    """S3-клиент прогретого контейнера: создаётся один раз и переиспользует keep-alive соединения"""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                import boto3
+                _s3_client = boto3.client('s3',
+                    endpoint_url='https://bucket.poehali.dev',
+                    aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                    aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+                )
+    return _s3_client
+
+def normalize_calculation(calculation_data: Any) -> Optional[Dict[str, Any]]:
+    """
+    Поля, от которых зависит отчёт, в каноническом виде.
+    None, если данных для отчёта не хватает
+    """
+    if not isinstance(calculation_data, dict):
+        return None
+    try:
+        normalized = {
+            'name': ' '.join(str(calculation_data.get('name') or '').split()),
+            'birth_date': str(calculation_data.get('birth_date') or calculation_data.get('birthDate') or '').strip(),
+        }
+        for key, _ in ENERGY_TITLES:
+            normalized[key] = int(calculation_data[key])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return normalized
+
+def report_hash(normalized: Dict[str, Any]) -> str:
+    """Адрес отчёта в кэше: sha256 от канонического JSON"""
+    canonical = json.dumps(normalized, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def render_report_pdf(normalized: Dict[str, Any]) -> bytes:
+    """Собирает PDF-отчёт по имени, дате рождения и четырём энергиям"""
+    from fpdf import FPDF
+    
+    pdf = FPDF()
+    pdf.add_font('DejaVu', fname=REPORT_FONT_PATH)
+    pdf.add_page()
+    pdf.set_font('DejaVu', size=20)
+    pdf.cell(0, 14, 'Матрица Судьбы', new_x='LMARGIN', new_y='NEXT', align='C')
+    pdf.set_font('DejaVu', size=12)
+    pdf.cell(0, 8, f"Персональный отчёт: {normalized['name'] or 'Клиент'}", new_x='LMARGIN', new_y='NEXT', align='C')
+    if normalized['birth_date']:
+        pdf.cell(0, 8, f"Дата рождения: {normalized['birth_date']}", new_x='LMARGIN', new_y='NEXT', align='C')
+    pdf.ln(8)
+    pdf.set_font('DejaVu', size=14)
+    for key, title in ENERGY_TITLES:
+        pdf.cell(120, 10, title, border='B')
+        pdf.cell(0, 10, str(normalized[key]), border='B', new_x='LMARGIN', new_y='NEXT', align='R')
+    return bytes(pdf.output())
+
+def _evict_report_cache() -> None:
+    """LRU по времени последнего обращения (mtime обновляется при попадании)"""
+    entries = []
+    total = 0
+    for entry in os.scandir(REPORT_CACHE_DIR):
+        if entry.name.endswith('.pdf'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total <= REPORT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def get_report_pdf(normalized: Dict[str, Any]) -> Tuple[str, bytes]:
+    """
+    PDF из кэша по адресу содержимого: локальный диск, затем S3, затем рендер.
+    Возвращает (хэш, байты PDF)
+    """
+    digest = report_hash(normalized)
+    path = os.path.join(REPORT_CACHE_DIR, f'{digest}.pdf')
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)
+        return digest, data
+    except FileNotFoundError:
+        pass
+    
+    data = None
+    s3_key = f'{REPORT_CACHE_S3_PREFIX}{digest}.pdf'
+    if REPORT_CACHE_S3_PREFIX:
+        try:
+            data = get_s3_client().get_object(Bucket=S3_BUCKET, Key=s3_key)['Body'].read()
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                print(f'ERROR: Report cache S3 read failed: {str(e)}')
+    
+    if data is None:
+        data = render_report_pdf(normalized)
+        if REPORT_CACHE_S3_PREFIX:
+            try:
+                get_s3_client().put_object(Bucket=S3_BUCKET, Key=s3_key, Body=data, ContentType='application/pdf')
+            except Exception as e:
+                print(f'ERROR: Report cache S3 write failed: {str(e)}')
+    
+    _write_report_cache(path, data)
+    return digest, data
+
+def _write_report_cache(path: str, data: bytes) -> None:
+    """Атомарная запись файла в локальный кэш с последующим вытеснением"""
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.part'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    _evict_report_cache()
+
+def report_mail_key(pdf_data: bytes, digest: Optional[str] = None) -> str:
+    """
+    Ключ PDF письма в S3 по адресу содержимого — его хранит email_outbox.
+    Собранный на сервере отчёт при S3-уровне кэша (digest) уже лежит под своим ключом
+    """
+    if digest and REPORT_CACHE_S3_PREFIX:
+        return f'{REPORT_CACHE_S3_PREFIX}{digest}.pdf'
+    return f'{REPORT_MAIL_S3_PREFIX}{hashlib.sha256(pdf_data).hexdigest()}.pdf'
+
+def stash_report_pdf(key: str, pdf_data: bytes) -> None:
+    """
+    Загружает PDF письма в S3, если под ключом ещё ничего нет, и оставляет копию в локальном кэше.
+    Вызывается после коммита очереди: откат учёта скачивания не оставляет в бакете сирот
+    """
+    path = os.path.join(REPORT_CACHE_DIR, os.path.basename(key))
+    # Загрузка идёт из файла кэша: тело может быть memoryview, а boto3 принимает только bytes или файл
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.part'
+    with open(tmp_path, 'wb') as f:
+        f.write(pdf_data)
+    try:
+        s3 = get_s3_client()
+        try:
+            s3.head_object(Bucket=S3_BUCKET, Key=key)
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                raise
+            s3.upload_file(tmp_path, S3_BUCKET, key, ExtraArgs={'ContentType': 'application/pdf'})
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    _evict_report_cache()
+
+def load_report_pdf(key: str) -> bytes:
+    """PDF письма по ключу из email_outbox: локальный кэш, затем S3"""
+    path = os.path.join(REPORT_CACHE_DIR, os.path.basename(key))
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)
+        return data
+    except FileNotFoundError:
+        pass
+    
+    data = get_s3_client().get_object(Bucket=S3_BUCKET, Key=key)['Body'].read()
+    _write_report_cache(path, data)
+    return data
+
+def report_url(digest: str) -> Optional[str]:
+    """Временная ссылка на отчёт в S3-уровне кэша"""
+    if not REPORT_CACHE_S3_PREFIX:
+        return None
+    return get_s3_client().generate_presigned_url(
+        'get_object',
+        Params={'Bucket': S3_BUCKET, 'Key': f'{REPORT_CACHE_S3_PREFIX}{digest}.pdf'},
+        ExpiresIn=3600
+    )
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
-    Учитывает скачивание отчёта, проверяет доступ и отправляет PDF на email
+    Учитывает скачивание отчёта, проверяет доступ и ставит PDF в очередь на отправку по email
     Args: event - dict с httpMethod, body (email, calculation_data, pdf_base64, name)
+          либо multipart/form-data с полем pdf, либо сырой application/pdf с полями в query;
+          ?render=1 без загруженного PDF — отчёт собирается на сервере по calculation_data
+          и возвращается ссылкой report_url (или pdf_base64 без S3-уровня кэша),
+          на почту такой отчёт уходит только с ?send_email=1;
+          GET ?action=drain_outbox отправляет накопившиеся письма и удаляет старые PDF писем
+          (вызывается по таймеру .github/workflows/timers.yml)
           context - объект с атрибутами запроса
     Returns: HTTP response dict с подтверждением или ошибкой
     """
@@ -134,7 +846,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type',
                 'Access-Control-Max-Age': '86400'
             },
@@ -142,6 +854,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    if method == 'GET' and (event.get('queryStringParameters') or {}).get('action') == 'drain_outbox':
+        try:
+            stats = drain_outbox()
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(stats),
+                'isBase64Encoded': False
+            }
+        except Exception as e:
+            return {
+                'statusCode': 500,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': str(e)}),
+                'isBase64Encoded': False
+            }
+    
     if method != 'POST':
         return {
             'statusCode': 405,
@@ -151,11 +880,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     try:
-        body_data = json.loads(event.get('body', '{}'))
-        email = body_data.get('email')
-        calculation_data = body_data.get('calculation_data', {})
-        pdf_base64 = body_data.get('pdf_base64')
-        user_name = body_data.get('name', 'Клиент')
+        email, user_name, calculation_data, pdf_data = parse_upload(event)
         
         if not email:
             return {
@@ -165,91 +890,126 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT plan_type, expires_at, downloads_left
-            FROM active_access
-            WHERE email = %s
-        """, (email,))
-        
-        result = cur.fetchone()
-        
-        if not result:
-            cur.close()
-            conn.close()
+        def forbidden(error: str) -> Dict[str, Any]:
             return {
                 'statusCode': 403,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Доступ не найден'}),
+                'body': json.dumps({'error': error}),
                 'isBase64Encoded': False
             }
         
+        result = lookup_entitlement(email)
+        conn = None
+        
+        if result is _MISSING:
+            conn = get_connection()
+            cur = conn.cursor()
+            execute_prepared(cur, 'select_entitlement', (email,))
+            result = cur.fetchone()
+            remember_entitlement(email, result)
+        
+        if not result:
+            if conn:
+                cur.close()
+                release_connection(conn)
+            return forbidden('Доступ не найден')
+        
         plan_type, expires_at, downloads_left = result
         
         if expires_at and datetime.now() > expires_at:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 403,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Срок действия подписки истёк'}),
-                'isBase64Encoded': False
-            }
+            if conn:
+                cur.close()
+                release_connection(conn)
+            return forbidden('Срок действия подписки истёк')
         
-        if downloads_left is not None:
-            if downloads_left <= 0:
+        if downloads_left is not None and downloads_left <= 0:
+            if conn:
                 cur.close()
-                conn.close()
+                release_connection(conn)
+            return forbidden('Использованы все доступные скачивания')
+        
+        digest = None
+        query = event.get('queryStringParameters') or {}
+        render = query.get('render') in ('1', 'true')
+        # Загруженный клиентом PDF всегда уходит на почту, собранный на сервере — только по просьбе
+        send_email = pdf_data is not None or query.get('send_email') in ('1', 'true')
+        if pdf_data is None and render:
+            normalized = normalize_calculation(calculation_data)
+            if normalized is None:
+                if conn:
+                    cur.close()
+                    release_connection(conn)
                 return {
-                    'statusCode': 403,
+                    'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Использованы все доступные скачивания'}),
+                    'body': json.dumps({'error': 'Недостаточно данных расчёта для отчёта'}),
                     'isBase64Encoded': False
                 }
-            
-            cur.execute("""
-                UPDATE active_access
-                SET downloads_left = downloads_left - 1
-                WHERE email = %s
-            """, (email,))
+            digest, pdf_data = get_report_pdf(normalized)
         
-        cur.execute("""
-            INSERT INTO downloads (email, calculation_data)
-            VALUES (%s, %s)
-        """, (email, json.dumps(calculation_data)))
+        # В очередь ставится только ключ PDF; сам файл уходит в S3 после коммита
+        pdf_key = report_mail_key(pdf_data, digest) if pdf_data is not None and send_email else None
         
-        conn.commit()
+        if conn is None:
+            conn = get_connection()
+            cur = conn.cursor()
+        
+        # Значение могло прийти из кэша, поэтому лимит и срок проверяются ещё и в самом UPDATE
+        execute_prepared(cur, 'record_download', (email, json.dumps(calculation_data)))
+        recorded = cur.fetchone()
+        
+        if recorded is None:
+            conn.rollback()
+            cur.close()
+            release_connection(conn)
+            forget_entitlement(email)
+            return forbidden('Использованы все доступные скачивания')
         
-        cur.execute("""
-            SELECT downloads_left FROM active_access WHERE email = %s
-        """, (email,))
+        new_downloads_left = recorded[0]
         
-        new_downloads_left = cur.fetchone()[0]
+        # Письмо уходит в очередь в той же транзакции, что и учёт скачивания:
+        # ответ не ждёт SMTP, а сбой почты не теряет уже списанное скачивание
+        outbox_id = None
+        if pdf_key:
+            execute_prepared(cur, 'enqueue_email', (email, user_name, pdf_key))
+            outbox_id = cur.fetchone()[0]
+        
+        conn.commit()
+        
+        if outbox_id is not None:
+            try:
+                stash_report_pdf(pdf_key, pdf_data)
+            except Exception as e:
+                # Письмо не теряется: байты остаются в строке очереди, как до перехода на pdf_key
+                print(f'ERROR: Report PDF upload failed, keeping it in the outbox row: {str(e)}')
+                cur.execute(
+                    'UPDATE email_outbox SET pdf_key = NULL, pdf = %s WHERE id = %s',
+                    (bytes(pdf_data), outbox_id)
+                )
+                conn.commit()
         
         cur.close()
-        conn.close()
+        release_connection(conn)
+        if new_downloads_left is not None:
+            forget_entitlement(email)
         
-        # Отправляем PDF на email если предоставлен
-        email_sent = False
-        telegram_sent = False
-        if pdf_base64:
-            email_sent = send_pdf_email(email, user_name, pdf_base64)
-            # Отправляем уведомление в Telegram если email отправлен
-            if email_sent:
-                telegram_sent = send_telegram_notification(email, user_name)
+        response = {
+            'success': True,
+            'downloads_left': new_downloads_left,
+            'message': 'Скачивание учтено',
+            'email_queued': outbox_id is not None
+        }
+        if digest:
+            # Без S3-уровня кэша ссылку дать не на что — отчёт возвращается прямо в ответе
+            response['report_hash'] = digest
+            response['report_url'] = report_url(digest)
+            if response['report_url'] is None:
+                response['pdf_base64'] = base64.b64encode(pdf_data).decode('ascii')
         
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'success': True,
-                'downloads_left': new_downloads_left,
-                'message': 'Скачивание учтено',
-                'email_sent': email_sent,
-                'telegram_notification': telegram_sent
-            }),
+            'body': json.dumps(response),
             'isBase64Encoded': False
         }
     
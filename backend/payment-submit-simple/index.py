@@ -1,15 +1,465 @@
 import json
 import os
+import threading
+import time
 import psycopg2
-import requests
-import boto3
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from collections import OrderedDict
 import base64
+import hashlib
+import io
+import re
 import uuid
-from typing import Dict, Any
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from typing import Dict, Any, List, Optional, Tuple, Callable
+
+DB_POOL_MAX_IDLE = int(os.environ.get('DB_POOL_MAX_IDLE', '4'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+_pool_lock = threading.Lock()
+_pool_idle: List[Tuple[Any, float]] = []
+_pool_stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'reconnects': 0}
+
+def _close_quietly(conn: Any) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+def _connection_alive(conn: Any, released_at: float) -> bool:
+    """Проверяет, что соединение из пула ещё живо (пингуем только давно простаивающие)"""
+    if conn.closed:
+        return False
+    if time.monotonic() - released_at < DB_POOL_PING_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_connection() -> Any:
+    """Берёт соединение из пула прогретого контейнера или открывает новое"""
+    while True:
+        with _pool_lock:
+            if not _pool_idle:
+                _pool_stats['misses'] += 1
+                break
+            conn, released_at = _pool_idle.pop()
+        if _connection_alive(conn, released_at):
+            with _pool_lock:
+                _pool_stats['hits'] += 1
+            return conn
+        with _pool_lock:
+            _pool_stats['reconnects'] += 1
+        _close_quietly(conn)
+    return psycopg2.connect(os.environ['DATABASE_URL'])
+
+def release_connection(conn: Any) -> None:
+    """Возвращает соединение в пул; битые и лишние соединения закрываются"""
+    if conn.closed:
+        return
+    try:
+        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        _close_quietly(conn)
+        return
+    with _pool_lock:
+        if len(_pool_idle) < DB_POOL_MAX_IDLE:
+            _pool_idle.append((conn, time.monotonic()))
+            return
+    _close_quietly(conn)
+
+def get_pool_stats() -> Dict[str, int]:
+    """Счётчики пула: hits — переиспользованные соединения, misses — новые, reconnects — выброшенные битые"""
+    with _pool_lock:
+        return dict(_pool_stats, idle=len(_pool_idle))
+
+SIDE_EFFECT_WORKERS = int(os.environ.get('SIDE_EFFECT_WORKERS', '4'))
+SIDE_EFFECT_TIMEOUT = float(os.environ.get('SIDE_EFFECT_TIMEOUT', '10'))
+
+# Пул для загрузки скриншота в S3 и уведомления Telegram после INSERT заявки: живёт вместе с прогретым контейнером
+_side_effects = ThreadPoolExecutor(max_workers=SIDE_EFFECT_WORKERS, thread_name_prefix='side-effect')
+
+def submit_side_effect(fn: Callable[..., Any], *args: Any) -> Future:
+    """
+    Запускает задачу в пуле; результат future — (значение, время выполнения в мс).
+    В future.timing — моменты начала и конца задачи, они есть и у упавших задач
+    """
+    timing: Dict[str, float] = {}
+    
+    def run() -> Tuple[Any, float]:
+        timing['started'] = time.perf_counter()
+        try:
+            result = fn(*args)
+            return result, (time.perf_counter() - timing['started']) * 1000
+        finally:
+            timing['finished'] = time.perf_counter()
+    
+    future = _side_effects.submit(run)
+    future.timing = timing
+    return future
+
+def _side_effect_ms(future: Future) -> float:
+    """Сколько задача проработала: до конца или до текущего момента; 0 — ещё ждёт в очереди"""
+    timing = getattr(future, 'timing', {})
+    if 'started' not in timing:
+        return 0.0
+    return round((timing.get('finished', time.perf_counter()) - timing['started']) * 1000, 1)
+
+def collect_side_effects(tasks: Dict[str, Future], timeout: float = SIDE_EFFECT_TIMEOUT) -> Dict[str, Dict[str, Any]]:
+    """
+    Дожидается задач с общим сроком timeout секунд на всю пачку (задачи уже идут параллельно).
+    Возвращает по имени задачи результат или ошибку и фактическое время работы; пишет время в лог
+    """
+    outcomes: Dict[str, Dict[str, Any]] = {}
+    deadline = time.monotonic() + timeout
+    for name, future in tasks.items():
+        try:
+            result, elapsed_ms = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            outcomes[name] = {'ok': True, 'result': result, 'ms': round(elapsed_ms, 1)}
+        except FutureTimeoutError:
+            outcomes[name] = {'ok': False, 'error': 'timeout', 'ms': _side_effect_ms(future)}
+        except Exception as e:
+            outcomes[name] = {'ok': False, 'error': str(e), 'ms': _side_effect_ms(future)}
+    if outcomes:
+        print('SIDE_EFFECTS: ' + ', '.join(
+            f"{name}={'ok' if o['ok'] else o['error']} {o['ms']}ms"
+            for name, o in outcomes.items()
+        ))
+    return outcomes
+
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev')
+S3_BUCKET = 'files'
+SCREENSHOT_PREFIX = 'payment-screenshots/'
+SCREENSHOT_UPLOAD_TTL = int(os.environ.get('SCREENSHOT_UPLOAD_TTL', '900'))
+SCREENSHOT_MAX_BYTES = int(os.environ.get('SCREENSHOT_MAX_BYTES', str(10 * 1024 * 1024)))
+SCREENSHOT_CONTENT_TYPES = {
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+    'image/webp': 'webp',
+    'image/gif': 'gif',
+    'image/heic': 'heic',
+    'application/pdf': 'pdf'
+}
+
+THUMBNAIL_MAX_SIZE = int(os.environ.get('THUMBNAIL_MAX_SIZE', '320'))
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', '70'))
+THUMBNAIL_FORMATS = ('image/jpeg', 'image/png', 'image/webp', 'image/gif')
+THUMBNAIL_MAX_PIXELS = int(os.environ.get('THUMBNAIL_MAX_PIXELS', '40000000'))
+THUMBNAIL_BATCH_SIZE = int(os.environ.get('THUMBNAIL_BATCH_SIZE', '20'))
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client() -> Any:
+    """S3-клиент прогретого контейнера: создаётся один раз и переиспользует keep-alive соединения"""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                import boto3
+                _s3_client = boto3.client('s3',
+                    endpoint_url=S3_ENDPOINT_URL,
+                    aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                    aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+                )
+    return _s3_client
+
+def screenshot_key_prefix(email: str) -> str:
+    safe_email = email.replace('@', '_').replace('.', '_')
+    return f"{SCREENSHOT_PREFIX}{safe_email}_"
+
+def screenshot_public_url(file_key: str) -> str:
+    return f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{file_key}"
+
+def screenshot_extension(content_type: str) -> Optional[str]:
+    """Расширение для ключа скриншота: известные типы, любой image/* кроме SVG и PDF; иначе None"""
+    if content_type in SCREENSHOT_CONTENT_TYPES:
+        return SCREENSHOT_CONTENT_TYPES[content_type]
+    match = re.fullmatch(r'image/([a-z0-9.+-]+)', content_type)
+    if not match or match.group(1).startswith('svg'):
+        return None
+    return re.sub(r'[^a-z0-9]', '', match.group(1).split('+')[0])[:10] or 'img'
+
+def presign_screenshot_upload(email: str, content_type: str) -> Dict[str, Any]:
+    """
+    Ключ и presigned POST: браузер загружает скриншот прямо в хранилище, минуя функцию.
+    Политика POST фиксирует Content-Type и ограничивает размер SCREENSHOT_MAX_BYTES
+    """
+    file_key = f"{screenshot_key_prefix(email)}{uuid.uuid4()}.{screenshot_extension(content_type)}"
+    upload = get_s3_client().generate_presigned_post(
+        Bucket=S3_BUCKET,
+        Key=file_key,
+        Fields={'Content-Type': content_type},
+        Conditions=[
+            {'Content-Type': content_type},
+            ['content-length-range', 1, SCREENSHOT_MAX_BYTES]
+        ],
+        ExpiresIn=SCREENSHOT_UPLOAD_TTL
+    )
+    return {
+        'upload_url': upload['url'],
+        'upload_fields': upload['fields'],
+        'screenshot_key': file_key,
+        'content_type': content_type,
+        'max_bytes': SCREENSHOT_MAX_BYTES,
+        'expires_in': SCREENSHOT_UPLOAD_TTL
+    }
+
+def check_screenshot_uploaded(file_key: str) -> int:
+    """HEAD объекта: падает, если скриншот по ключу не загрузили или он больше лимита; возвращает размер"""
+    size = get_s3_client().head_object(Bucket=S3_BUCKET, Key=file_key)['ContentLength']
+    if size > SCREENSHOT_MAX_BYTES:
+        raise ValueError(f'screenshot is {size} bytes, limit {SCREENSHOT_MAX_BYTES}')
+    return size
+
+def upload_screenshot(file_key: str, screenshot_data: bytes, content_type: str) -> None:
+    """Загрузка скриншота оплаты в S3 (старые клиенты присылают его base64 в теле)"""
+    get_s3_client().put_object(
+        Bucket=S3_BUCKET,
+        Key=file_key,
+        Body=screenshot_data,
+        ContentType=content_type
+    )
+
+def detect_image_format(data: bytes) -> Optional[str]:
+    """Настоящий тип файла по сигнатуре, а не по расширению или заявленному Content-Type"""
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[4:8] == b'ftyp' and data[8:12] in (b'heic', b'heix', b'mif1', b'msf1'):
+        return 'image/heic'
+    if data.startswith(b'%PDF'):
+        return 'application/pdf'
+    return None
+
+def thumbnail_key(file_key: str) -> str:
+    """Миниатюра лежит рядом с оригиналом: payment-screenshots/<имя>.thumb.jpg"""
+    return f"{file_key.rsplit('.', 1)[0]}.thumb.jpg"
+
+def make_thumbnail(data: bytes) -> bytes:
+    """Уменьшенная копия скриншота, пережатая в JPEG"""
+    from PIL import Image
+    
+    # Защита от «бомб распаковки»: размер проверяется по заголовку до декодирования
+    Image.MAX_IMAGE_PIXELS = THUMBNAIL_MAX_PIXELS
+    with Image.open(io.BytesIO(data)) as img:
+        if img.width * img.height > THUMBNAIL_MAX_PIXELS:
+            raise ValueError(f'image is {img.width}x{img.height}, limit {THUMBNAIL_MAX_PIXELS} pixels')
+        img.draft('RGB', (THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+        img.thumbnail((THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+        thumb = img.convert('RGB')
+    out = io.BytesIO()
+    thumb.save(out, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True, progressive=True)
+    return out.getvalue()
+
+def process_screenshot(file_key: str) -> Optional[str]:
+    """
+    Определяет формат скриншота и кладёт миниатюру рядом с оригиналом.
+    Возвращает ключ миниатюры; для PDF, неподдерживаемых и слишком больших файлов — None
+    """
+    s3 = get_s3_client()
+    if s3.head_object(Bucket=S3_BUCKET, Key=file_key)['ContentLength'] > SCREENSHOT_MAX_BYTES:
+        return None
+    screenshot_data = s3.get_object(Bucket=S3_BUCKET, Key=file_key)['Body'].read(SCREENSHOT_MAX_BYTES + 1)
+    if len(screenshot_data) > SCREENSHOT_MAX_BYTES or detect_image_format(screenshot_data) not in THUMBNAIL_FORMATS:
+        return None
+    
+    key = thumbnail_key(file_key)
+    s3.put_object(
+        Bucket=S3_BUCKET,
+        Key=key,
+        Body=make_thumbnail(screenshot_data),
+        ContentType='image/jpeg',
+        CacheControl='public, max-age=31536000, immutable'
+    )
+    return key
+
+def process_pending_thumbnails() -> Dict[str, int]:
+    """
+    Обработчик миниатюр (вызывается по таймеру из .github/workflows/timers.yml, вне запроса
+    на заявку): берёт заявки со скриншотом без миниатюры, включая старые, и готовит их.
+    '' в screenshot_thumb_url — миниатюры не будет
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+    
+    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
+    stats = {'processed': 0, 'skipped': 0, 'failed': 0}
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT id, screenshot_url
+        FROM {schema}.payment_requests
+        WHERE screenshot_thumb_url IS NULL AND screenshot_url <> ''
+        ORDER BY id DESC
+        LIMIT %s
+    """, (THUMBNAIL_BATCH_SIZE,))
+    rows = cur.fetchall()
+    conn.commit()
+    
+    for request_id, screenshot_url in rows:
+        thumb_url = ''
+        try:
+            if '/bucket/' in screenshot_url:
+                thumb_key = process_screenshot(screenshot_url.split('/bucket/', 1)[1])
+                if thumb_key:
+                    thumb_url = screenshot_public_url(thumb_key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+                print(f"WARNING: Thumbnail for request {request_id} postponed: {str(e)}")
+                stats['failed'] += 1
+                continue
+        except BotoCoreError as e:
+            print(f"WARNING: Thumbnail for request {request_id} postponed: {str(e)}")
+            stats['failed'] += 1
+            continue
+        except Exception as e:
+            print(f"WARNING: Thumbnail for request {request_id} skipped: {str(e)}")
+        
+        cur.execute(f"""
+            UPDATE {schema}.payment_requests SET screenshot_thumb_url = %s WHERE id = %s
+        """, (thumb_url, request_id))
+        conn.commit()
+        stats['processed' if thumb_url else 'skipped'] += 1
+    
+    cur.close()
+    release_connection(conn)
+    return stats
+
+def send_telegram_notification(request_id: int, email: str, phone: str, plan_type: str, amount: Any, screenshot_url: str) -> bool:
+    """Уведомление администратора в Telegram о новой заявке"""
+    import requests
+    
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    chat_id = os.environ.get('TELEGRAM_CHAT_ID')
+    
+    if not bot_token or not chat_id:
+        return False
+    
+    plan_labels = {
+        'single': 'Разовая расшифровка',
+        'month': '1 месяц безлимит',
+        'half_year': '6 месяцев безлимит',
+        'year': '12 месяцев безлимит'
+    }
+    
+    admin_url = "https://preview--matrix-destiny-project.poehali.dev/admin"
+    
+    message = f"""🔔 *Новая заявка #{request_id}*
+
+📧 Email: {email}"""
+    
+    if phone:
+        message += f"\n📱 Телефон: {phone}"
+    
+    message += f"""
+💳 Тариф: {plan_labels.get(plan_type, plan_type)}
+💰 Сумма: *{amount} ₽*
+"""
+    
+    if screenshot_url:
+        message += f"\n📸 [Скриншот оплаты]({screenshot_url})"
+    
+    message += f"\n\n[Открыть админ-панель]({admin_url})"
+    
+    telegram_url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+    response = requests.post(telegram_url, json={
+        'chat_id': chat_id,
+        'text': message,
+        'parse_mode': 'Markdown',
+        'disable_web_page_preview': True
+    }, timeout=SIDE_EFFECT_TIMEOUT)
+    
+    if response.status_code != 200:
+        print(f"WARNING: Telegram notification failed: {response.text}")
+        return False
+    return True
+
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', '3600'))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '1024'))
+
+# Ключ идемпотентности -> (request_id, момент истечения); повтор из того же контейнера не идёт даже в БД
+_idempotency_cache: 'OrderedDict[str, Tuple[int, float]]' = OrderedDict()
+_idempotency_lock = threading.Lock()
+
+def idempotency_key(event: Dict[str, Any], body_data: Dict[str, Any], email: str, plan_type: str,
+                    amount: Any, screenshot: str) -> str:
+    """
+    Ключ из заголовка Idempotency-Key / поля idempotency_key, а без него — хэш email+тариф+сумма+скриншот.
+    Ключ клиента привязывается к email, чтобы заявки разных людей не склеивались
+    """
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    client_key = headers.get('idempotency-key') or body_data.get('idempotency_key')
+    if client_key:
+        material = f'client\n{email}\n{client_key}'
+    else:
+        material = f'auto\n{email}\n{plan_type}\n{amount}\n{hashlib.sha256(screenshot.encode()).hexdigest()}'
+    return hashlib.sha256(material.encode()).hexdigest()
+
+def lookup_idempotent(key: str) -> Optional[int]:
+    with _idempotency_lock:
+        entry = _idempotency_cache.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del _idempotency_cache[key]
+            return None
+        _idempotency_cache.move_to_end(key)
+        return entry[0]
+
+def remember_idempotent(key: str, request_id: int, ttl: float = IDEMPOTENCY_TTL) -> None:
+    with _idempotency_lock:
+        _idempotency_cache[key] = (request_id, time.monotonic() + ttl)
+        _idempotency_cache.move_to_end(key)
+        while len(_idempotency_cache) > IDEMPOTENCY_CACHE_SIZE:
+            _idempotency_cache.popitem(last=False)
+
+def claim_payment_request(cur: Any, schema: str, key: str, values: Tuple) -> Tuple[int, bool, float]:
+    """
+    Вставляет заявку под ключом идемпотентности.
+    Возвращает (request_id, создана ли новая, сколько секунд ключ ещё действует).
+    Ключ старше IDEMPOTENCY_TTL снимается со старой заявки, и вставка повторяется
+    """
+    for _ in range(3):
+        cur.execute(f"""
+            INSERT INTO {schema}.payment_requests (email, phone, status, plan_type, amount, screenshot_url, idempotency_key)
+            VALUES (%s, %s, 'pending', %s, %s, %s, %s)
+            ON CONFLICT (idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
+            RETURNING id
+        """, values + (key,))
+        row = cur.fetchone()
+        if row:
+            return row[0], True, IDEMPOTENCY_TTL
+        
+        cur.execute(f"""
+            SELECT id, %s - EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - created_at)
+            FROM {schema}.payment_requests
+            WHERE idempotency_key = %s
+        """, (IDEMPOTENCY_TTL, key))
+        row = cur.fetchone()
+        if row and row[1] > 0:
+            return row[0], False, float(row[1])
+        if row:
+            cur.execute(f"""
+                UPDATE {schema}.payment_requests SET idempotency_key = NULL WHERE id = %s
+            """, (row[0],))
+    raise RuntimeError('Не удалось занять ключ идемпотентности')
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
-    Простая функция приема заявок на оплату
+    Простая функция приема заявок на оплату.
+    GET ?action=upload_url&email=...&content_type=... выдаёт presigned POST для загрузки скриншота,
+    GET ?action=process_thumbnails готовит миниатюры скриншотов (вызывается по таймеру),
+    POST принимает заявку со screenshot_key (или со скриншотом base64 от старых клиентов)
     """
     method: str = event.get('httpMethod', 'POST')
     
@@ -18,14 +468,58 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, Idempotency-Key',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
+    params = event.get('queryStringParameters') or {}
+    if method == 'GET' and params.get('action') == 'process_thumbnails':
+        try:
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(process_pending_thumbnails()),
+                'isBase64Encoded': False
+            }
+        except Exception as e:
+            print(f"ERROR: {str(e)}")
+            return {
+                'statusCode': 500,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': f'Ошибка сервера: {str(e)}'}),
+                'isBase64Encoded': False
+            }
+    
+    if method == 'GET' and params.get('action') == 'upload_url':
+        email = params.get('email')
+        content_type = params.get('content_type', 'image/jpeg')
+        if not email or screenshot_extension(content_type) is None:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Нужны email и поддерживаемый content_type'}),
+                'isBase64Encoded': False
+            }
+        try:
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(presign_screenshot_upload(email, content_type)),
+                'isBase64Encoded': False
+            }
+        except Exception as e:
+            print(f"ERROR: {str(e)}")
+            return {
+                'statusCode': 500,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': f'Ошибка сервера: {str(e)}'}),
+                'isBase64Encoded': False
+            }
+    
     if method != 'POST':
         return {
             'statusCode': 405,
@@ -41,6 +535,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         plan_type = body_data.get('plan_type', 'single')
         amount = body_data.get('amount', 300)
         screenshot_base64 = body_data.get('screenshot', '')
+        screenshot_key = body_data.get('screenshot_key', '')
         
         if not email:
             return {
@@ -50,106 +545,102 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
+        if screenshot_key and (not screenshot_key.startswith(screenshot_key_prefix(email)) or '/' in screenshot_key[len(SCREENSHOT_PREFIX):]):
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Неверный screenshot_key'}),
+                'isBase64Encoded': False
+            }
+        
+        # URL скриншота известен до загрузки, поэтому ключ объекта выбирается заранее,
+        # а сама загрузка (или проверка загруженного по presigned URL) начинается после INSERT
         screenshot_url = ''
-        if screenshot_base64:
+        file_key = ''
+        screenshot_data = None
+        content_type = ''
+        if screenshot_key:
+            file_key = screenshot_key
+            screenshot_url = screenshot_public_url(file_key)
+        elif screenshot_base64:
             try:
                 if ',' in screenshot_base64:
                     screenshot_base64 = screenshot_base64.split(',')[1]
                 
                 screenshot_data = base64.b64decode(screenshot_base64)
                 
-                s3 = boto3.client('s3',
-                    endpoint_url='https://bucket.poehali.dev',
-                    aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-                    aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
-                )
-                
-                file_ext = 'jpg'
-                safe_email = email.replace('@', '_').replace('.', '_')
-                file_key = f"payment-screenshots/{safe_email}_{uuid.uuid4()}.{file_ext}"
-                
-                s3.put_object(
-                    Bucket='files',
-                    Key=file_key,
-                    Body=screenshot_data,
-                    ContentType='image/jpeg'
-                )
-                
-                screenshot_url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{file_key}"
-                print(f"Screenshot uploaded: {screenshot_url}")
+                content_type = detect_image_format(screenshot_data) or 'image/jpeg'
+                file_ext = SCREENSHOT_CONTENT_TYPES.get(content_type, 'jpg')
+                file_key = f"{screenshot_key_prefix(email)}{uuid.uuid4()}.{file_ext}"
+                screenshot_url = screenshot_public_url(file_key)
             except Exception as upload_error:
                 print(f"WARNING: Screenshot upload failed: {str(upload_error)}")
         
+        def accepted(request_id: int, duplicate: bool) -> Dict[str, Any]:
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'request_id': request_id,
+                    'duplicate': duplicate,
+                    'message': 'Заявка принята и сохранена в админке'
+                }),
+                'isBase64Encoded': False
+            }
+        
+        # Повторное нажатие «Отправить» возвращает исходную заявку без загрузок и уведомлений
+        idem_key = idempotency_key(event, body_data, email, plan_type, amount, screenshot_key or screenshot_base64)
+        cached_request_id = lookup_idempotent(idem_key)
+        if cached_request_id is not None:
+            return accepted(cached_request_id, True)
+        
         schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_connection()
         cur = conn.cursor()
         
-        cur.execute(f"""
-            INSERT INTO {schema}.payment_requests (email, phone, status, plan_type, amount, screenshot_url)
-            VALUES (%s, %s, 'pending', %s, %s, %s)
-            RETURNING id
-        """, (email, phone, plan_type, amount, screenshot_url))
-        
-        request_id = cur.fetchone()[0]
+        request_id, created, ttl_left = claim_payment_request(
+            cur, schema, idem_key, (email, phone, plan_type, amount, screenshot_url)
+        )
         
         conn.commit()
         cur.close()
-        conn.close()
+        release_connection(conn)
+        remember_idempotent(idem_key, request_id, ttl_left)
         
-        try:
-            bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-            chat_id = os.environ.get('TELEGRAM_CHAT_ID')
-            
-            if bot_token and chat_id:
-                plan_labels = {
-                    'single': 'Разовая расшифровка',
-                    'month': '1 месяц безлимит',
-                    'half_year': '6 месяцев безлимит',
-                    'year': '12 месяцев безлимит'
-                }
-                
-                admin_url = "https://preview--matrix-destiny-project.poehali.dev/admin"
-                
-                message = f"""🔔 *Новая заявка #{request_id}*
-
-📧 Email: {email}"""
-                
-                if phone:
-                    message += f"\n📱 Телефон: {phone}"
-                
-                message += f"""
-💳 Тариф: {plan_labels.get(plan_type, plan_type)}
-💰 Сумма: *{amount} ₽*
-"""
-                
-                if screenshot_url:
-                    message += f"\n📸 [Скриншот оплаты]({screenshot_url})"
-                
-                message += f"\n\n[Открыть админ-панель]({admin_url})"
-                
-                telegram_url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-                response = requests.post(telegram_url, json={
-                    'chat_id': chat_id,
-                    'text': message,
-                    'parse_mode': 'Markdown',
-                    'disable_web_page_preview': True
-                })
-                
-                if response.status_code != 200:
-                    print(f"WARNING: Telegram notification failed: {response.text}")
-        except Exception as telegram_error:
-            print(f"WARNING: Telegram error (non-critical): {str(telegram_error)}")
+        if not created:
+            return accepted(request_id, True)
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'success': True,
-                'request_id': request_id,
-                'message': 'Заявка принята и сохранена в админке'
-            }),
-            'isBase64Encoded': False
+        # Загрузка (или проверка) скриншота и уведомление идут параллельно под одним общим сроком.
+        # Уведомление не ждёт S3: при сбое загрузки ссылка в нём ведёт в пустоту, а заявка
+        # в админке остаётся без скриншота. Миниатюру готовит process_pending_thumbnails по таймеру
+        tasks = {
+            'telegram': submit_side_effect(
+                send_telegram_notification, request_id, email, phone, plan_type, amount, screenshot_url
+            )
         }
+        if file_key:
+            if screenshot_data is not None:
+                tasks['s3_upload'] = submit_side_effect(upload_screenshot, file_key, screenshot_data, content_type)
+            else:
+                tasks['s3_upload'] = submit_side_effect(check_screenshot_uploaded, file_key)
+        
+        results = collect_side_effects(tasks)
+        upload = results.get('s3_upload')
+        if upload and upload['ok']:
+            print(f"Screenshot uploaded: {screenshot_url}")
+        elif upload:
+            print(f"WARNING: Screenshot upload failed: {upload['error']}")
+            conn = get_connection()
+            cur = conn.cursor()
+            cur.execute(f"""
+                UPDATE {schema}.payment_requests SET screenshot_url = '' WHERE id = %s
+            """, (request_id,))
+            conn.commit()
+            cur.close()
+            release_connection(conn)
+        
+        return accepted(request_id, False)
     
     except Exception as e:
         print(f"ERROR: {str(e)}")
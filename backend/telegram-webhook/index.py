@@ -1,9 +1,76 @@
 import json
 import os
+import threading
+import time
 import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 import requests
-from typing import Dict, Any
-from datetime import datetime, timedelta
+from typing import Dict, Any, List, Tuple
+
+DB_POOL_MAX_IDLE = int(os.environ.get('DB_POOL_MAX_IDLE', '4'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+_pool_lock = threading.Lock()
+_pool_idle: List[Tuple[Any, float]] = []
+_pool_stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'reconnects': 0}
+
+def _close_quietly(conn: Any) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+def _connection_alive(conn: Any, released_at: float) -> bool:
+    """Проверяет, что соединение из пула ещё живо (пингуем только давно простаивающие)"""
+    if conn.closed:
+        return False
+    if time.monotonic() - released_at < DB_POOL_PING_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_connection() -> Any:
+    """Берёт соединение из пула прогретого контейнера или открывает новое"""
+    while True:
+        with _pool_lock:
+            if not _pool_idle:
+                _pool_stats['misses'] += 1
+                break
+            conn, released_at = _pool_idle.pop()
+        if _connection_alive(conn, released_at):
+            with _pool_lock:
+                _pool_stats['hits'] += 1
+            return conn
+        with _pool_lock:
+            _pool_stats['reconnects'] += 1
+        _close_quietly(conn)
+    return psycopg2.connect(os.environ['DATABASE_URL'])
+
+def release_connection(conn: Any) -> None:
+    """Возвращает соединение в пул; битые и лишние соединения закрываются"""
+    if conn.closed:
+        return
+    try:
+        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        _close_quietly(conn)
+        return
+    with _pool_lock:
+        if len(_pool_idle) < DB_POOL_MAX_IDLE:
+            _pool_idle.append((conn, time.monotonic()))
+            return
+    _close_quietly(conn)
+
+def get_pool_stats() -> Dict[str, int]:
+    """Счётчики пула: hits — переиспользованные соединения, misses — новые, reconnects — выброшенные битые"""
+    with _pool_lock:
+        return dict(_pool_stats, idle=len(_pool_idle))
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
@@ -51,19 +118,26 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             action, request_id = callback_data.split('_')
             request_id = int(request_id)
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_connection()
             cur = conn.cursor()
             
             if action == 'approve':
-                # Получаем данные заявки
+                # Статус заявки и выдача доступа одним запросом (grant_access, общий с админкой)
                 cur.execute("""
-                    SELECT email, plan_type FROM payment_requests WHERE id = %s
+                    WITH req AS (
+                        UPDATE payment_requests
+                        SET status = 'approved', approved_at = CURRENT_TIMESTAMP
+                        WHERE id = %s
+                        RETURNING email, plan_type
+                    )
+                    SELECT req.email
+                    FROM req, LATERAL grant_access(req.email, req.plan_type, 'telegram') g
                 """, (request_id,))
                 result = cur.fetchone()
                 
                 if not result:
                     cur.close()
-                    conn.close()
+                    release_connection(conn)
                     
                     # Уведомляем пользователя
                     requests.post(f"https://api.telegram.org/bot{bot_token}/answerCallbackQuery", json={
@@ -79,42 +153,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'isBase64Encoded': False
                     }
                 
-                email, plan_type = result
-                
-                # Обновляем статус заявки
-                cur.execute("""
-                    UPDATE payment_requests 
-                    SET status = 'approved', approved_at = %s
-                    WHERE id = %s
-                """, (datetime.now(), request_id))
-                
-                # Выдаём доступ
-                expires_at = None
-                downloads_left = None
-                
-                if plan_type == 'single':
-                    downloads_left = 1
-                elif plan_type == 'month':
-                    expires_at = datetime.now() + timedelta(days=30)
-                elif plan_type == 'half_year':
-                    expires_at = datetime.now() + timedelta(days=180)
-                elif plan_type == 'year':
-                    expires_at = datetime.now() + timedelta(days=365)
-                
-                cur.execute("""
-                    INSERT INTO active_access (email, plan_type, expires_at, downloads_left, granted_by)
-                    VALUES (%s, %s, %s, %s, 'telegram')
-                    ON CONFLICT (email) 
-                    DO UPDATE SET 
-                        plan_type = EXCLUDED.plan_type,
-                        expires_at = EXCLUDED.expires_at,
-                        downloads_left = EXCLUDED.downloads_left,
-                        granted_at = CURRENT_TIMESTAMP
-                """, (email, plan_type, expires_at, downloads_left))
+                email = result[0]
                 
                 conn.commit()
                 cur.close()
-                conn.close()
+                release_connection(conn)
                 
                 # Обновляем сообщение
                 new_text = message['text'] + f"\n\n✅ *ОДОБРЕНО* администратором"
@@ -143,7 +186,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 conn.commit()
                 cur.close()
-                conn.close()
+                release_connection(conn)
                 
                 # Обновляем сообщение
                 new_text = message['text'] + f"\n\n❌ *ОТКЛОНЕНО* администратором"
@@ -0,0 +1,24 @@
+-- Оповещение прогретых функций об изменении доступа: payload — email,
+-- по нему access-check и download-report сбрасывают запись кэша тарифов
+CREATE OR REPLACE FUNCTION notify_active_access_changed()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('active_access_changed', NEW.email);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('active_access_changed', OLD.email);
+    ELSE
+        PERFORM pg_notify('active_access_changed', OLD.email);
+        IF NEW.email <> OLD.email THEN
+            PERFORM pg_notify('active_access_changed', NEW.email);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER active_access_changed
+AFTER INSERT OR UPDATE OR DELETE ON active_access
+FOR EACH ROW EXECUTE FUNCTION notify_active_access_changed();
@@ -0,0 +1,98 @@
+-- Поколение сессий: входит в подписанный токен access-check.
+-- Выход с устройства и смена лимита устройств увеличивают его,
+-- и все ранее выданные токены перестают приниматься без похода в БД
+ALTER TABLE active_access
+ADD COLUMN IF NOT EXISTS session_epoch INTEGER NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION bump_session_epoch_on_max_devices()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NEW.max_devices IS DISTINCT FROM OLD.max_devices THEN
+        NEW.session_epoch := OLD.session_epoch + 1;
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER active_access_max_devices_epoch
+BEFORE UPDATE ON active_access
+FOR EACH ROW EXECUTE FUNCTION bump_session_epoch_on_max_devices();
+
+-- access_check теперь возвращает и поколение сессий
+DROP FUNCTION IF EXISTS access_check(VARCHAR, VARCHAR, TEXT, VARCHAR);
+
+CREATE FUNCTION access_check(
+    p_email VARCHAR,
+    p_ip VARCHAR,
+    p_user_agent TEXT,
+    p_new_token VARCHAR
+)
+RETURNS TABLE (
+    plan_type VARCHAR,
+    expires_at TIMESTAMP,
+    downloads_left INTEGER,
+    granted_at TIMESTAMP,
+    max_devices INTEGER,
+    session_epoch INTEGER,
+    is_expired BOOLEAN,
+    active_devices INTEGER,
+    session_token VARCHAR,
+    limit_exceeded BOOLEAN
+)
+LANGUAGE plpgsql
+SET search_path FROM CURRENT
+AS $$
+#variable_conflict use_column
+DECLARE
+    v_threshold TIMESTAMP := CURRENT_TIMESTAMP - INTERVAL '24 hours';
+BEGIN
+    SELECT a.plan_type, a.expires_at, a.downloads_left, a.granted_at, COALESCE(a.max_devices, 2), a.session_epoch
+    INTO plan_type, expires_at, downloads_left, granted_at, max_devices, session_epoch
+    FROM active_access a
+    WHERE a.email = p_email;
+
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    is_expired := expires_at IS NOT NULL AND expires_at < CURRENT_TIMESTAMP;
+    limit_exceeded := FALSE;
+    active_devices := 0;
+
+    IF is_expired THEN
+        INSERT INTO security_logs (email, event_type, ip_address, user_agent, details)
+        VALUES (p_email, 'expired_access', p_ip, p_user_agent, to_jsonb('Попытка доступа с истёкшей подпиской'::TEXT));
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    SELECT COUNT(DISTINCT s.ip_address)
+    INTO active_devices
+    FROM user_sessions s
+    WHERE s.email = p_email AND s.last_activity > v_threshold;
+
+    SELECT s.session_token
+    INTO session_token
+    FROM user_sessions s
+    WHERE s.email = p_email AND s.ip_address = p_ip AND s.last_activity > v_threshold
+    LIMIT 1;
+
+    IF FOUND THEN
+        UPDATE user_sessions s
+        SET last_activity = CURRENT_TIMESTAMP
+        WHERE s.email = p_email AND s.ip_address = p_ip;
+    ELSIF active_devices >= max_devices THEN
+        limit_exceeded := TRUE;
+        INSERT INTO security_logs (email, event_type, ip_address, user_agent, details)
+        VALUES (p_email, 'device_limit_exceeded', p_ip, p_user_agent, to_jsonb('Попытка входа с нового устройства при превышении лимита'::TEXT));
+    ELSE
+        INSERT INTO user_sessions (email, session_token, ip_address, user_agent, created_at, last_activity)
+        VALUES (p_email, p_new_token, p_ip, p_user_agent, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP);
+        session_token := p_new_token;
+    END IF;
+
+    RETURN NEXT;
+END;
+$$;
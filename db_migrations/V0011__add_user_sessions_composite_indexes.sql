@@ -0,0 +1,13 @@
+-- Индексы под запросы access-check к user_sessions
+
+-- Подсчёт устройств и список устройств: email + окно по last_activity,
+-- ip_address берётся прямо из индекса
+CREATE INDEX IF NOT EXISTS idx_sessions_email_activity
+    ON user_sessions(email, last_activity DESC) INCLUDE (ip_address);
+
+-- Сессия текущего устройства, пачечное обновление last_activity и выход
+CREATE INDEX IF NOT EXISTS idx_sessions_email_ip
+    ON user_sessions(email, ip_address, last_activity DESC);
+
+-- Покрывается обоими индексами выше
+DROP INDEX IF EXISTS idx_sessions_email;
@@ -0,0 +1,177 @@
+-- Помесячное секционирование user_sessions и security_logs по created_at.
+-- Старые секции удаляются целиком, поэтому горячая секция остаётся маленькой.
+-- Имена таблиц не меняются, запросы access-check работают как раньше.
+--
+-- user_sessions секционируется по created_at, хотя горячий запрос (число устройств за 24 часа)
+-- фильтрует по last_activity и секции не отсекает. Секционирование по last_activity хуже:
+-- каждый пульс (UPDATE last_activity) на границе месяца переносил бы строку в другую секцию
+-- (DELETE + INSERT), а ключ секционирования входил бы в первичный ключ и менялся.
+-- По created_at строка живёт в одной секции; запрос по устройствам делает по одному спуску
+-- по idx_sessions_email_activity в каждой секции, а их число ограничено сроком хранения
+-- (SESSIONS_RETENTION_DAYS = 90 дней — 4–5 секций плюс две наперёд).
+-- Секции удаляются по дате создания сессии; устройство, чья сессия старше срока хранения,
+-- при следующей проверке доступа просто регистрируется заново.
+
+-- Создаёт помесячные секции начиная с месяца p_from и на p_months_ahead месяцев вперёд
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(
+    p_table TEXT,
+    p_from DATE DEFAULT CURRENT_DATE,
+    p_months_ahead INTEGER DEFAULT 2
+)
+RETURNS VOID
+LANGUAGE plpgsql
+SET search_path FROM CURRENT
+AS $$
+DECLARE
+    v_month DATE := date_trunc('month', LEAST(p_from, CURRENT_DATE))::DATE;
+    v_last DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => p_months_ahead))::DATE;
+    v_name TEXT;
+BEGIN
+    WHILE v_month <= v_last LOOP
+        v_name := format('%s_p%s', p_table, to_char(v_month, 'YYYYMM'));
+        IF to_regclass(v_name) IS NULL THEN
+            BEGIN
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                    v_name, p_table, v_month, (v_month + INTERVAL '1 month')::DATE
+                );
+            EXCEPTION WHEN check_violation THEN
+                -- В секции по умолчанию уже есть строки этого месяца
+                RAISE WARNING 'partition % skipped: rows for this range are in the default partition', v_name;
+            END;
+        END IF;
+        v_month := (v_month + INTERVAL '1 month')::DATE;
+    END LOOP;
+END;
+$$;
+
+-- Отсоединяет (и, если не p_detach_only, удаляет) секции старше p_retention
+CREATE OR REPLACE FUNCTION prune_monthly_partitions(
+    p_table TEXT,
+    p_column TEXT,
+    p_retention INTERVAL,
+    p_detach_only BOOLEAN DEFAULT FALSE
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SET search_path FROM CURRENT
+AS $$
+DECLARE
+    v_cutoff TIMESTAMP := CURRENT_TIMESTAMP - p_retention;
+    v_partition TEXT;
+    v_pruned INTEGER := 0;
+BEGIN
+    FOR v_partition IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = p_table::REGCLASS
+          AND c.relname ~ ('^' || p_table || '_p[0-9]{6}$')
+        ORDER BY c.relname
+    LOOP
+        IF to_date(right(v_partition, 6), 'YYYYMM') + INTERVAL '1 month' <= v_cutoff THEN
+            EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', p_table, v_partition);
+            IF NOT p_detach_only THEN
+                EXECUTE format('DROP TABLE %I', v_partition);
+            END IF;
+            v_pruned := v_pruned + 1;
+        END IF;
+    END LOOP;
+
+    EXECUTE format('DELETE FROM %I WHERE %I < %L', p_table || '_default', p_column, v_cutoff);
+
+    RETURN v_pruned;
+END;
+$$;
+
+-- Точка входа фонового обслуживания; параллельные вызовы из разных контейнеров пропускаются
+CREATE OR REPLACE FUNCTION maintain_time_partitions(
+    p_sessions_retention INTERVAL,
+    p_security_logs_retention INTERVAL,
+    p_detach_only BOOLEAN DEFAULT FALSE
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SET search_path FROM CURRENT
+AS $$
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('maintain_time_partitions')) THEN
+        RETURN 0;
+    END IF;
+
+    PERFORM ensure_monthly_partitions('user_sessions');
+    PERFORM ensure_monthly_partitions('security_logs');
+
+    RETURN prune_monthly_partitions('user_sessions', 'created_at', p_sessions_retention, p_detach_only)
+         + prune_monthly_partitions('security_logs', 'created_at', p_security_logs_retention, p_detach_only);
+END;
+$$;
+
+-- user_sessions
+ALTER TABLE user_sessions RENAME TO user_sessions_unpartitioned;
+
+CREATE TABLE user_sessions (
+    id INTEGER NOT NULL DEFAULT nextval('user_sessions_id_seq'),
+    email VARCHAR(255) NOT NULL,
+    ip_address VARCHAR(45) NOT NULL,
+    user_agent TEXT,
+    last_activity TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    session_token VARCHAR(64) NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE user_sessions_default PARTITION OF user_sessions DEFAULT;
+
+SELECT ensure_monthly_partitions(
+    'user_sessions',
+    COALESCE((SELECT MIN(COALESCE(created_at, last_activity))::DATE FROM user_sessions_unpartitioned), CURRENT_DATE)
+);
+
+INSERT INTO user_sessions (id, email, ip_address, user_agent, last_activity, session_token, created_at)
+SELECT id, email, ip_address, user_agent,
+       COALESCE(last_activity, created_at, CURRENT_TIMESTAMP), session_token,
+       COALESCE(created_at, last_activity, CURRENT_TIMESTAMP)
+FROM user_sessions_unpartitioned;
+
+ALTER SEQUENCE user_sessions_id_seq OWNED BY user_sessions.id;
+DROP TABLE user_sessions_unpartitioned;
+
+-- Уникальность session_token больше не обеспечивается индексом: он должен включать ключ секционирования,
+-- а токены — 256 случайных бит
+ALTER TABLE user_sessions ADD PRIMARY KEY (id, created_at);
+CREATE INDEX idx_sessions_token ON user_sessions(session_token);
+CREATE INDEX idx_sessions_activity ON user_sessions(last_activity DESC);
+CREATE INDEX idx_sessions_email_activity ON user_sessions(email, last_activity DESC) INCLUDE (ip_address);
+CREATE INDEX idx_sessions_email_ip ON user_sessions(email, ip_address, last_activity DESC);
+
+-- security_logs
+ALTER TABLE security_logs RENAME TO security_logs_unpartitioned;
+
+CREATE TABLE security_logs (
+    id INTEGER NOT NULL DEFAULT nextval('security_logs_id_seq'),
+    email VARCHAR(255) NOT NULL,
+    event_type VARCHAR(50) NOT NULL,
+    ip_address VARCHAR(45),
+    user_agent TEXT,
+    details JSONB,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE security_logs_default PARTITION OF security_logs DEFAULT;
+
+SELECT ensure_monthly_partitions(
+    'security_logs',
+    COALESCE((SELECT MIN(created_at)::DATE FROM security_logs_unpartitioned), CURRENT_DATE)
+);
+
+INSERT INTO security_logs (id, email, event_type, ip_address, user_agent, details, created_at)
+SELECT id, email, event_type, ip_address, user_agent, details, COALESCE(created_at, CURRENT_TIMESTAMP)
+FROM security_logs_unpartitioned;
+
+ALTER SEQUENCE security_logs_id_seq OWNED BY security_logs.id;
+DROP TABLE security_logs_unpartitioned;
+
+ALTER TABLE security_logs ADD PRIMARY KEY (id, created_at);
+CREATE INDEX idx_security_logs_email ON security_logs(email);
+CREATE INDEX idx_security_logs_type ON security_logs(event_type);
+CREATE INDEX idx_security_logs_date ON security_logs(created_at DESC);
@@ -0,0 +1,69 @@
+-- События безопасности (истёкшая подписка, превышение лимита устройств) больше не пишутся
+-- внутри access_check: access-check копит их в буфере и вставляет пачкой
+CREATE OR REPLACE FUNCTION access_check(
+    p_email VARCHAR,
+    p_ip VARCHAR,
+    p_user_agent TEXT,
+    p_new_token VARCHAR
+)
+RETURNS TABLE (
+    plan_type VARCHAR,
+    expires_at TIMESTAMP,
+    downloads_left INTEGER,
+    granted_at TIMESTAMP,
+    max_devices INTEGER,
+    session_epoch INTEGER,
+    is_expired BOOLEAN,
+    active_devices INTEGER,
+    session_token VARCHAR,
+    limit_exceeded BOOLEAN
+)
+LANGUAGE plpgsql
+SET search_path FROM CURRENT
+AS $$
+#variable_conflict use_column
+DECLARE
+    v_threshold TIMESTAMP := CURRENT_TIMESTAMP - INTERVAL '24 hours';
+BEGIN
+    SELECT a.plan_type, a.expires_at, a.downloads_left, a.granted_at, COALESCE(a.max_devices, 2), a.session_epoch
+    INTO plan_type, expires_at, downloads_left, granted_at, max_devices, session_epoch
+    FROM active_access a
+    WHERE a.email = p_email;
+
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    is_expired := expires_at IS NOT NULL AND expires_at < CURRENT_TIMESTAMP;
+    limit_exceeded := FALSE;
+    active_devices := 0;
+
+    IF is_expired THEN
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    SELECT COUNT(DISTINCT s.ip_address)
+    INTO active_devices
+    FROM user_sessions s
+    WHERE s.email = p_email AND s.last_activity > v_threshold;
+
+    SELECT s.session_token
+    INTO session_token
+    FROM user_sessions s
+    WHERE s.email = p_email AND s.ip_address = p_ip AND s.last_activity > v_threshold
+    LIMIT 1;
+
+    IF NOT FOUND THEN
+        IF active_devices >= max_devices THEN
+            limit_exceeded := TRUE;
+        ELSE
+            INSERT INTO user_sessions (email, session_token, ip_address, user_agent, created_at, last_activity)
+            VALUES (p_email, p_new_token, p_ip, p_user_agent, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP);
+            session_token := p_new_token;
+        END IF;
+    END IF;
+
+    RETURN NEXT;
+END;
+$$;
@@ -0,0 +1,64 @@
+-- Справочник тарифов: срок действия и число скачиваний
+CREATE TABLE IF NOT EXISTS plans (
+    plan_type VARCHAR(20) PRIMARY KEY,
+    duration_days INTEGER,  -- NULL: бессрочно
+    downloads INTEGER,      -- NULL: без лимита скачиваний
+    title VARCHAR(100) NOT NULL
+);
+
+INSERT INTO plans (plan_type, duration_days, downloads, title) VALUES
+    ('single', NULL, 1, 'Разовая расшифровка'),
+    ('month', 30, NULL, '1 месяц безлимит'),
+    ('half_year', 180, NULL, '6 месяцев безлимит'),
+    ('year', 365, NULL, '12 месяцев безлимит'),
+    ('admin', NULL, NULL, 'Администратор')
+ON CONFLICT (plan_type) DO NOTHING;
+
+-- Выдача доступа по тарифу одним INSERT ... ON CONFLICT, общая для админки и Telegram.
+-- Срочный тариф заменяет текущий доступ. Пакет скачиваний прибавляется к остатку,
+-- а при действующем безлимите ничего не меняет.
+-- Неизвестный тариф — пустой результат.
+CREATE OR REPLACE FUNCTION grant_access(
+    p_email VARCHAR,
+    p_plan_type VARCHAR,
+    p_granted_by VARCHAR
+)
+RETURNS TABLE (
+    plan_type VARCHAR,
+    expires_at TIMESTAMP,
+    downloads_left INTEGER
+)
+LANGUAGE sql
+SET search_path FROM CURRENT
+AS $$
+    INSERT INTO active_access AS aa (email, plan_type, expires_at, downloads_left, granted_by, granted_at)
+    SELECT p_email,
+           p.plan_type,
+           CURRENT_TIMESTAMP + make_interval(days => p.duration_days),
+           p.downloads,
+           p_granted_by,
+           CURRENT_TIMESTAMP
+    FROM plans p
+    WHERE p.plan_type = p_plan_type
+    ON CONFLICT (email) DO UPDATE SET
+        plan_type = CASE
+            WHEN EXCLUDED.downloads_left IS NULL THEN EXCLUDED.plan_type
+            WHEN aa.plan_type <> 'single' AND aa.downloads_left IS NULL
+                 AND (aa.expires_at IS NULL OR aa.expires_at > CURRENT_TIMESTAMP) THEN aa.plan_type
+            ELSE EXCLUDED.plan_type
+        END,
+        expires_at = CASE
+            WHEN EXCLUDED.downloads_left IS NULL THEN EXCLUDED.expires_at
+            WHEN aa.plan_type <> 'single' AND aa.downloads_left IS NULL
+                 AND (aa.expires_at IS NULL OR aa.expires_at > CURRENT_TIMESTAMP) THEN aa.expires_at
+            ELSE NULL
+        END,
+        downloads_left = CASE
+            WHEN EXCLUDED.downloads_left IS NULL THEN NULL
+            WHEN aa.plan_type <> 'single' AND aa.downloads_left IS NULL
+                 AND (aa.expires_at IS NULL OR aa.expires_at > CURRENT_TIMESTAMP) THEN NULL
+            ELSE COALESCE(aa.downloads_left, 0) + EXCLUDED.downloads_left
+        END,
+        granted_at = CURRENT_TIMESTAMP
+    RETURNING aa.plan_type, aa.expires_at, aa.downloads_left;
+$$;
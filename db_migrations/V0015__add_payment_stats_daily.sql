@@ -0,0 +1,71 @@
+-- Агрегаты заявок по дням для дашборда админки: (день, тариф, статус) -> количество и сумма.
+-- Поддерживаются триггером на каждое изменение payment_requests, без пересчёта всей таблицы
+CREATE TABLE IF NOT EXISTS payment_stats_daily (
+    day DATE NOT NULL,
+    plan_type VARCHAR(20) NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    requests INTEGER NOT NULL DEFAULT 0,
+    amount BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, plan_type, status)
+);
+
+CREATE OR REPLACE FUNCTION apply_payment_stats_delta(
+    p_created_at TIMESTAMP,
+    p_plan_type VARCHAR,
+    p_status VARCHAR,
+    p_requests INTEGER,
+    p_amount BIGINT
+)
+RETURNS VOID
+LANGUAGE sql
+SET search_path FROM CURRENT
+AS $$
+    INSERT INTO payment_stats_daily AS s (day, plan_type, status, requests, amount)
+    VALUES (
+        COALESCE(p_created_at, TIMESTAMP 'epoch')::DATE,
+        COALESCE(p_plan_type, 'single'),
+        COALESCE(p_status, 'pending'),
+        p_requests,
+        p_amount
+    )
+    ON CONFLICT (day, plan_type, status) DO UPDATE SET
+        requests = s.requests + EXCLUDED.requests,
+        amount = s.amount + EXCLUDED.amount;
+$$;
+
+CREATE OR REPLACE FUNCTION track_payment_stats()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+SET search_path FROM CURRENT
+AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM apply_payment_stats_delta(OLD.created_at, OLD.plan_type, OLD.status, -1, -COALESCE(OLD.amount, 0));
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM apply_payment_stats_delta(NEW.created_at, NEW.plan_type, NEW.status, 1, COALESCE(NEW.amount, 0));
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER payment_requests_stats_insert_delete
+AFTER INSERT OR DELETE ON payment_requests
+FOR EACH ROW EXECUTE FUNCTION track_payment_stats();
+
+CREATE TRIGGER payment_requests_stats_update
+AFTER UPDATE OF created_at, plan_type, status, amount ON payment_requests
+FOR EACH ROW
+WHEN ((OLD.created_at, OLD.plan_type, OLD.status, OLD.amount) IS DISTINCT FROM (NEW.created_at, NEW.plan_type, NEW.status, NEW.amount))
+EXECUTE FUNCTION track_payment_stats();
+
+-- Заполняем по существующим заявкам
+INSERT INTO payment_stats_daily (day, plan_type, status, requests, amount)
+SELECT COALESCE(created_at, TIMESTAMP 'epoch')::DATE,
+       COALESCE(plan_type, 'single'),
+       COALESCE(status, 'pending'),
+       COUNT(*),
+       COALESCE(SUM(amount), 0)
+FROM payment_requests
+GROUP BY 1, 2, 3
+ON CONFLICT (day, plan_type, status) DO NOTHING;
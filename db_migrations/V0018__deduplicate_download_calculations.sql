@@ -0,0 +1,52 @@
+-- Уникальные расчёты хранятся один раз, скачивания ссылаются на них по хэшу.
+-- Хэш — sha256 от текста JSONB: он канонический (ключи упорядочены, пробелы нормализованы),
+-- поэтому одинаковые матрицы совпадают независимо от форматирования на клиенте
+CREATE TABLE IF NOT EXISTS calculations (
+    hash BYTEA PRIMARY KEY,
+    data JSONB NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE downloads
+ADD COLUMN IF NOT EXISTS calculation_hash BYTEA REFERENCES calculations(hash);
+
+-- Отчёт об экономии места: размер JSON до и после дедупликации
+DO $$
+DECLARE
+    v_downloads BIGINT;
+    v_unique BIGINT;
+    v_bytes_before BIGINT;
+    v_bytes_after BIGINT;
+BEGIN
+    INSERT INTO calculations (hash, data)
+    SELECT DISTINCT ON (h) h, calculation_data
+    FROM (
+        SELECT sha256(convert_to(calculation_data::TEXT, 'UTF8')) AS h, calculation_data
+        FROM downloads
+        WHERE calculation_data IS NOT NULL
+    ) s
+    ON CONFLICT (hash) DO NOTHING;
+
+    UPDATE downloads
+    SET calculation_hash = sha256(convert_to(calculation_data::TEXT, 'UTF8'))
+    WHERE calculation_data IS NOT NULL;
+
+    SELECT COUNT(*), COALESCE(SUM(pg_column_size(calculation_data)), 0)
+    INTO v_downloads, v_bytes_before
+    FROM downloads
+    WHERE calculation_data IS NOT NULL;
+
+    SELECT COUNT(*), COALESCE(SUM(pg_column_size(data) + pg_column_size(hash)), 0)
+                     + v_downloads * 33  -- хэш-ссылка в каждой строке downloads
+    INTO v_unique, v_bytes_after
+    FROM calculations;
+
+    RAISE NOTICE 'calculation_data dedup: % downloads -> % unique calculations, % bytes -> % bytes (saved %)',
+        v_downloads, v_unique, v_bytes_before, v_bytes_after, v_bytes_before - v_bytes_after;
+END;
+$$;
+
+-- Столбец calculation_data удаляется отдельной миграцией (V0026), когда старые версии
+-- download-report, которые ещё пишут в него, уже не работают
+
+CREATE INDEX IF NOT EXISTS idx_downloads_calculation_hash ON downloads(calculation_hash);
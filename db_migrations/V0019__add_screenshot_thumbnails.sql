@@ -0,0 +1,3 @@
+-- Миниатюра скриншота оплаты для списка в админке (оригинал остаётся в screenshot_url)
+ALTER TABLE payment_requests
+ADD COLUMN IF NOT EXISTS screenshot_thumb_url TEXT;
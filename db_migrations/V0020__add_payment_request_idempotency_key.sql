@@ -0,0 +1,7 @@
+-- Ключ идемпотентности заявки: повторная отправка формы возвращает уже созданную заявку.
+-- Ключ старше TTL функция снимает со старой заявки перед новой вставкой
+ALTER TABLE payment_requests
+ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_payment_requests_idempotency_key
+ON payment_requests(idempotency_key) WHERE idempotency_key IS NOT NULL;
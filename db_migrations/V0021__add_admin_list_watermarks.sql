@@ -0,0 +1,73 @@
+-- Версия списка заявок для ETag в admin-direct без общей горячей строки и без COUNT(*):
+-- водяные знаки самих таблиц (max(updated_at)) и время последнего удаления из list_deletions.
+-- updated_at меняется только при изменении колонок, которые показывает список
+ALTER TABLE payment_requests
+ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+ALTER TABLE active_access
+ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+-- Время записи, а не начала транзакции: admin-direct не выдаёт ETag,
+-- пока самое свежее изменение моложе окна LIST_ETAG_SETTLE
+CREATE OR REPLACE FUNCTION touch_updated_at()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.updated_at := clock_timestamp();
+    RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER payment_requests_touch_insert
+BEFORE INSERT ON payment_requests
+FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
+
+CREATE TRIGGER payment_requests_touch_update
+BEFORE UPDATE ON payment_requests
+FOR EACH ROW
+WHEN ((OLD.email, OLD.phone, OLD.screenshot_url, OLD.screenshot_thumb_url, OLD.status, OLD.created_at, OLD.plan_type, OLD.amount)
+      IS DISTINCT FROM (NEW.email, NEW.phone, NEW.screenshot_url, NEW.screenshot_thumb_url, NEW.status, NEW.created_at, NEW.plan_type, NEW.amount))
+EXECUTE FUNCTION touch_updated_at();
+
+CREATE TRIGGER active_access_touch_insert
+BEFORE INSERT ON active_access
+FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
+
+CREATE TRIGGER active_access_touch_update
+BEFORE UPDATE ON active_access
+FOR EACH ROW
+WHEN ((OLD.email, OLD.plan_type, OLD.expires_at, OLD.downloads_left)
+      IS DISTINCT FROM (NEW.email, NEW.plan_type, NEW.expires_at, NEW.downloads_left))
+EXECUTE FUNCTION touch_updated_at();
+
+CREATE INDEX IF NOT EXISTS idx_payment_requests_updated_at ON payment_requests(updated_at);
+CREATE INDEX IF NOT EXISTS idx_active_access_updated_at ON active_access(updated_at);
+
+-- Удалённая строка не сдвигает max(updated_at): время последнего удаления по таблице.
+-- Строка на таблицу обновляется один раз на оператор, а удаления из списка редки
+CREATE TABLE IF NOT EXISTS list_deletions (
+    table_name VARCHAR(63) PRIMARY KEY,
+    deleted_at TIMESTAMP NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION touch_list_deletion()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+SET search_path FROM CURRENT
+AS $$
+BEGIN
+    INSERT INTO list_deletions (table_name, deleted_at)
+    VALUES (TG_TABLE_NAME, clock_timestamp())
+    ON CONFLICT (table_name) DO UPDATE SET deleted_at = EXCLUDED.deleted_at;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER payment_requests_list_deletion
+AFTER DELETE OR TRUNCATE ON payment_requests
+FOR EACH STATEMENT EXECUTE FUNCTION touch_list_deletion();
+
+CREATE TRIGGER active_access_list_deletion
+AFTER DELETE OR TRUNCATE ON active_access
+FOR EACH STATEMENT EXECUTE FUNCTION touch_list_deletion();
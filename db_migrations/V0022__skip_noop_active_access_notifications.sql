@@ -0,0 +1,12 @@
+-- UPDATE без фактических изменений строки не должен будить кэши тарифов во всех контейнерах
+DROP TRIGGER IF EXISTS active_access_changed ON active_access;
+
+CREATE TRIGGER active_access_changed_insert_delete
+AFTER INSERT OR DELETE ON active_access
+FOR EACH ROW EXECUTE FUNCTION notify_active_access_changed();
+
+CREATE TRIGGER active_access_changed_update
+AFTER UPDATE ON active_access
+FOR EACH ROW
+WHEN (OLD.* IS DISTINCT FROM NEW.*)
+EXECUTE FUNCTION notify_active_access_changed();
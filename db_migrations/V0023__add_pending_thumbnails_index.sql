@@ -0,0 +1,3 @@
+-- Очередь миниатюр для обработчика по таймеру: скриншот есть, миниатюра ещё не готовилась
+CREATE INDEX IF NOT EXISTS idx_payment_requests_pending_thumbnails
+ON payment_requests(id DESC) WHERE screenshot_thumb_url IS NULL AND screenshot_url <> '';
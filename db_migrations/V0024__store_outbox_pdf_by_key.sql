@@ -0,0 +1,3 @@
+-- PDF письма хранится в S3 по адресу содержимого, в очереди остаётся только ключ.
+-- Столбец pdf нужен для писем, поставленных в очередь до перехода, и очищается после отправки
+ALTER TABLE email_outbox ADD COLUMN IF NOT EXISTS pdf_key VARCHAR(255);
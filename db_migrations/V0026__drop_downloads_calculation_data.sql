@@ -0,0 +1,17 @@
+-- Завершение дедупликации расчётов (V0018): строки, которые старые версии download-report
+-- успели записать только в calculation_data, переносятся в calculations, затем столбец удаляется
+INSERT INTO calculations (hash, data)
+SELECT DISTINCT ON (h) h, calculation_data
+FROM (
+    SELECT sha256(convert_to(calculation_data::TEXT, 'UTF8')) AS h, calculation_data
+    FROM downloads
+    WHERE calculation_hash IS NULL AND calculation_data IS NOT NULL
+) s
+ON CONFLICT (hash) DO NOTHING;
+
+UPDATE downloads
+SET calculation_hash = sha256(convert_to(calculation_data::TEXT, 'UTF8'))
+WHERE calculation_hash IS NULL AND calculation_data IS NOT NULL;
+
+-- Место в куче освободится после VACUUM FULL downloads (или pg_repack)
+ALTER TABLE downloads DROP COLUMN calculation_data;
@@ -0,0 +1,5 @@
+-- Выход с устройства отзывает только его токены: время отзыва хранится по хэшу IP
+-- (как в токене access-check), поколение сессий остаётся для смены лимита устройств.
+-- Записи старше 24 часов вычищаются при следующем выходе — токены живут не дольше
+ALTER TABLE active_access
+ADD COLUMN IF NOT EXISTS revoked_devices JSONB NOT NULL DEFAULT '{}';
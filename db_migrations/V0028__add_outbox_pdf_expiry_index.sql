@@ -0,0 +1,3 @@
+-- drain_outbox удаляет из S3 PDF отправленных и брошенных писем старше срока хранения
+CREATE INDEX IF NOT EXISTS idx_email_outbox_pdf_expiry
+ON email_outbox(created_at) WHERE pdf_key IS NOT NULL AND status <> 'pending';
@@ -34,14 +34,21 @@ export interface SubscriptionCheckResponse {
   end_date?: string;
 }
 
+const SESSION_TOKEN_KEY = 'access_session_token';
+
 export const checkAccess = async (email: string): Promise<SubscriptionCheckResponse> => {
-  const response = await fetch(`${ACCESS_CHECK_URL}?email=${encodeURIComponent(email)}`);
+  const sessionToken = localStorage.getItem(SESSION_TOKEN_KEY);
+  const tokenParam = sessionToken ? `&session_token=${encodeURIComponent(sessionToken)}` : '';
+  const response = await fetch(`${ACCESS_CHECK_URL}?email=${encodeURIComponent(email)}${tokenParam}`);
 
   if (!response.ok) {
     throw new Error('Failed to check access');
   }
 
   const data = await response.json();
+  if (data.session_token) {
+    localStorage.setItem(SESSION_TOKEN_KEY, data.session_token);
+  }
   return data;
 };
 
@@ -85,37 +92,118 @@ export interface PaymentSubmitRequest {
   screenshot?: File;
 }
 
+// Повторы POST заявки с тем же ключом идемпотентности: обрыв сети или ответ 5xx
+const PAYMENT_SUBMIT_RETRIES = 2;
+
+// Повторное нажатие, пока те же данные формы ещё отправляются, присоединяется к этой отправке
+const paymentFormFingerprint = (data: PaymentSubmitRequest): string => {
+  const file = data.screenshot;
+  return [
+    data.email,
+    data.plan_type,
+    data.amount,
+    file ? `${file.name}:${file.size}:${file.lastModified}` : '',
+  ].join('\n');
+};
+
+const pendingPaymentSubmits = new Map<string, Promise<any>>();
+
 export const submitPayment = async (data: PaymentSubmitRequest): Promise<any> => {
   if (!PAYMENT_SUBMIT_URL) {
     console.error('PAYMENT_SUBMIT_URL is not defined. func2url:', func2url);
     throw new Error('Сервис временно недоступен');
   }
 
+  const fingerprint = paymentFormFingerprint(data);
+  const pending = pendingPaymentSubmits.get(fingerprint);
+  if (pending) {
+    return pending;
+  }
+
+  // Новый ключ на каждую отправку: его повторы сервер склеит в одну заявку,
+  // а после ошибки или отклонённой заявки те же данные можно подать заново
+  const idempotencyKey = crypto.randomUUID();
+  const request = sendPaymentRequest(data, idempotencyKey).finally(() => {
+    pendingPaymentSubmits.delete(fingerprint);
+  });
+  pendingPaymentSubmits.set(fingerprint, request);
+  return request;
+};
+
+const postPaymentRequest = async (body: string, idempotencyKey: string): Promise<Response> => {
+  for (let attempt = 0; ; attempt++) {
+    try {
+      const response = await fetch(PAYMENT_SUBMIT_URL, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'Idempotency-Key': idempotencyKey,
+        },
+        body,
+      });
+      if (response.status < 500 || attempt >= PAYMENT_SUBMIT_RETRIES) {
+        return response;
+      }
+    } catch (error) {
+      if (attempt >= PAYMENT_SUBMIT_RETRIES) {
+        throw error;
+      }
+    }
+    await new Promise((resolve) => setTimeout(resolve, 1000 * 2 ** attempt));
+  }
+};
+
+const sendPaymentRequest = async (data: PaymentSubmitRequest, idempotencyKey: string): Promise<any> => {
   console.log('Submitting payment to:', PAYMENT_SUBMIT_URL);
   
+  // Скриншот загружается напрямую в хранилище по presigned POST, в заявку уходит только ключ.
+  // Типы, которые хранилище не принимает, уходят по-старому: base64 в теле заявки
+  let screenshotKey = '';
   let screenshotBase64 = '';
   if (data.screenshot) {
-    const reader = new FileReader();
-    screenshotBase64 = await new Promise((resolve, reject) => {
-      reader.onload = () => resolve(reader.result as string);
-      reader.onerror = reject;
-      reader.readAsDataURL(data.screenshot!);
-    });
+    const contentType = data.screenshot.type || 'application/octet-stream';
+    const params = new URLSearchParams({ action: 'upload_url', email: data.email, content_type: contentType });
+    const uploadResponse = await fetch(`${PAYMENT_SUBMIT_URL}?${params}`);
+
+    if (uploadResponse.status === 400) {
+      const reader = new FileReader();
+      screenshotBase64 = await new Promise((resolve, reject) => {
+        reader.onload = () => resolve(reader.result as string);
+        reader.onerror = reject;
+        reader.readAsDataURL(data.screenshot!);
+      });
+    } else {
+      if (!uploadResponse.ok) {
+        const errorData = await uploadResponse.json();
+        throw new Error(errorData.error || 'Не удалось загрузить скриншот');
+      }
+      const upload = await uploadResponse.json();
+      if (data.screenshot.size > upload.max_bytes) {
+        throw new Error(`Скриншот больше ${Math.floor(upload.max_bytes / 1024 / 1024)} МБ`);
+      }
+
+      const form = new FormData();
+      Object.entries(upload.upload_fields as Record<string, string>).forEach(([name, value]) => {
+        form.append(name, value);
+      });
+      form.append('file', data.screenshot);
+
+      const storageResponse = await fetch(upload.upload_url, { method: 'POST', body: form });
+      if (!storageResponse.ok) {
+        throw new Error('Не удалось загрузить скриншот');
+      }
+      screenshotKey = upload.screenshot_key;
+    }
   }
   
-  const response = await fetch(PAYMENT_SUBMIT_URL, {
-    method: 'POST',
-    headers: {
-      'Content-Type': 'application/json',
-    },
-    body: JSON.stringify({
-      email: data.email,
-      phone: data.phone,
-      plan_type: data.plan_type,
-      amount: data.amount,
-      screenshot: screenshotBase64,
-    }),
-  });
+  const response = await postPaymentRequest(JSON.stringify({
+    email: data.email,
+    phone: data.phone,
+    plan_type: data.plan_type,
+    amount: data.amount,
+    screenshot_key: screenshotKey,
+    screenshot: screenshotBase64,
+  }), idempotencyKey);
 
   if (!response.ok) {
     const errorData = await response.json();
@@ -17,6 +17,7 @@ interface Request {
   email: string;
   phone: string;
   screenshot_url: string;
+  screenshot_thumb_url?: string;
   status: string;
   created_at: string;
   plan_type: string;
@@ -192,6 +193,15 @@ const Admin = () => {
                           </div>
                         )}
                       </div>
+                      {r.screenshot_thumb_url && (
+                        <img
+                          src={r.screenshot_thumb_url}
+                          alt="Скриншот оплаты"
+                          loading="lazy"
+                          className="max-h-40 rounded border cursor-pointer"
+                          onClick={() => window.open(r.screenshot_url, '_blank')}
+                        />
+                      )}
                       <div className="flex gap-2">
                         {r.screenshot_url && (
                           <Button variant="outline" size="sm" onClick={() => window.open(r.screenshot_url, '_blank')}>
@@ -0,0 +1,75 @@
+"""
+p50/p99 задержки GET access-check до и после проверки доступа одним вызовом (user-002).
+
+    TEST_DATABASE_URL=postgresql://postgres@localhost/postgres \\
+        python tests/bench/bench_access_check.py [--rev REV ...] [--requests N]
+
+Для каждой ревизии создаётся своя база с её миграциями, функция загружается из той же
+ревизии. По умолчанию: b4b076e^ (пять запросов), b4b076e (функция access_check) и WORKTREE.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import WORKTREE, create_database, drop_database, load_function, percentiles  # noqa: E402
+
+DEFAULT_REVS = ['b4b076e^', 'b4b076e', WORKTREE]
+
+def seed(url: str, emails: int) -> None:
+    import psycopg2
+    
+    conn = psycopg2.connect(url)
+    conn.autocommit = True
+    conn.cursor().execute("""
+        INSERT INTO active_access (email, plan_type, expires_at, granted_by, granted_at)
+        SELECT 'bench' || n || '@example.com', 'year', CURRENT_TIMESTAMP + INTERVAL '365 days', 'bench', CURRENT_TIMESTAMP
+        FROM generate_series(1, %s) AS n
+    """, (emails,))
+    conn.close()
+
+def run(rev: str, server_url: str, requests: int, emails: int) -> dict:
+    url = create_database(server_url, rev)
+    try:
+        seed(url, emails)
+        os.environ['DATABASE_URL'] = url
+        module = load_function('access-check', rev)
+        
+        def check(n: int) -> float:
+            # Два устройства на email — в пределах лимита, журнал безопасности не пишется
+            event = {
+                'httpMethod': 'GET',
+                'queryStringParameters': {'email': f'bench{n % emails + 1}@example.com'},
+                'headers': {'X-Forwarded-For': f'10.0.0.{n % 2 + 1}', 'User-Agent': 'bench'},
+            }
+            started = time.perf_counter()
+            response = module.handler(event, None)
+            elapsed = (time.perf_counter() - started) * 1000
+            assert response['statusCode'] == 200, response
+            return elapsed
+        
+        for n in range(min(requests, emails * 2)):
+            check(n)  # прогрев: пул, подготовленные выражения, первые сессии устройств
+        return percentiles([check(n) for n in range(requests)])
+    finally:
+        drop_database(server_url, url)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rev', action='append', help='ревизия git или WORKTREE (можно несколько раз)')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--emails', type=int, default=200)
+    args = parser.parse_args()
+    
+    server_url = os.environ.get('TEST_DATABASE_URL')
+    if not server_url:
+        sys.exit('TEST_DATABASE_URL не задан')
+    
+    print(f"{'revision':12} {'p50, ms':>9} {'p99, ms':>9} {'mean, ms':>9}")
+    for rev in args.rev or DEFAULT_REVS:
+        stats = run(rev, server_url, args.requests, args.emails)
+        print(f"{rev:12} {stats['p50']:9.2f} {stats['p99']:9.2f} {stats['mean']:9.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Время импорта index.py каждой функции (холодный старт) до и после ленивых импортов (user-022).
+
+    python tests/bench/bench_import_time.py [--rev REV ...] [--runs N]
+
+Для каждой ревизии и функции index.py кладётся во временный каталог и импортируется
+в новом процессе под `python -X importtime`; берётся медиана суммарного времени модуля index
+по N запускам (первый запуск — прогрев байткода, не считается). БД и S3 не нужны:
+на импорте функции никуда не подключаются. По умолчанию: 1abf23c^ и WORKTREE.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Dict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import ROOT, WORKTREE, read_file  # noqa: E402
+
+DEFAULT_REVS = ['1abf23c^', WORKTREE]
+FUNCTIONS = sorted(
+    name for name in os.listdir(os.path.join(ROOT, 'backend'))
+    if os.path.exists(os.path.join(ROOT, 'backend', name, 'index.py'))
+)
+
+def import_once(directory: str) -> Dict[str, float]:
+    """Один импорт в новом процессе: суммарное время index и число загруженных модулей"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import index'],
+        cwd=directory, capture_output=True, text=True, check=True,
+        env={k: v for k, v in os.environ.items() if k != 'PYTHONPATH'}
+    )
+    # Формат строк: "import time: self [us] | cumulative | imported package"
+    rows = [line.split('|') for line in result.stderr.splitlines() if line.startswith('import time:')]
+    rows = [row for row in rows if row[1].strip().isdigit()]
+    index_us = next(int(row[1]) for row in rows if row[2].strip() == 'index')
+    return {'ms': index_us / 1000, 'modules': len(rows)}
+
+def measure(rev: str, name: str, runs: int) -> Dict[str, float]:
+    directory = tempfile.mkdtemp(prefix='bench-import-')
+    with open(os.path.join(directory, 'index.py'), 'w', encoding='utf-8') as f:
+        f.write(read_file(rev, f'backend/{name}/index.py'))
+    import_once(directory)  # прогрев: __pycache__ самой функции и библиотек
+    samples = [import_once(directory) for _ in range(runs)]
+    return {
+        'ms': statistics.median(s['ms'] for s in samples),
+        'modules': samples[-1]['modules'],
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rev', action='append', help='ревизия git или WORKTREE (можно несколько раз)')
+    parser.add_argument('--function', action='append', choices=FUNCTIONS, help='по умолчанию все функции')
+    parser.add_argument('--runs', type=int, default=7)
+    args = parser.parse_args()
+    
+    print(f"{'function':24} {'revision':12} {'import, ms':>11} {'modules':>8}")
+    for name in args.function or FUNCTIONS:
+        for rev in args.rev or DEFAULT_REVS:
+            stats = measure(rev, name, args.runs)
+            print(f"{name:24} {rev:12} {stats['ms']:11.1f} {stats['modules']:8d}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Пиковая память POST download-report с PDF до и после приёма загрузки без base64 в JSON (user-017).
+
+    TEST_DATABASE_URL=postgresql://postgres@localhost/postgres \\
+        python tests/bench/bench_upload_memory.py [--rev REV ...] [--pdf-mb N]
+
+Для каждой ревизии создаётся своя база с её миграциями; каждый замер идёт в отдельном процессе,
+чтобы модули и кэши предыдущего не попадали в замер. S3 — локальный moto. Печатается пик
+tracemalloc за вызов обработчика (событие шлюза уже собрано и в пик не входит).
+По умолчанию: e4677a0^ (только JSON с pdf_base64) и WORKTREE.
+"""
+import argparse
+import base64
+import gc
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import WORKTREE, create_database, drop_database, load_function, read_file  # noqa: E402
+
+DEFAULT_REVS = ['e4677a0^', WORKTREE]
+MODES = ('json', 'multipart', 'raw')
+EMAIL = 'bench-upload@example.com'
+
+def build_event(mode: str, pdf: bytes) -> dict:
+    """Запрос в том виде, в каком его передаёт шлюз (бинарное тело — base64)"""
+    if mode == 'json':
+        body = {'email': EMAIL, 'calculation_data': {}, 'pdf_base64': base64.b64encode(pdf).decode('ascii')}
+        return {'httpMethod': 'POST', 'body': json.dumps(body)}
+    if mode == 'multipart':
+        boundary = b'bench-boundary'
+        body = (b'--' + boundary + b'\r\nContent-Disposition: form-data; name="email"\r\n\r\n' + EMAIL.encode() +
+                b'\r\n--' + boundary + b'\r\nContent-Disposition: form-data; name="pdf"; filename="report.pdf"\r\n'
+                b'Content-Type: application/pdf\r\n\r\n' + pdf + b'\r\n--' + boundary + b'--\r\n')
+        return {
+            'httpMethod': 'POST',
+            'headers': {'Content-Type': f'multipart/form-data; boundary={boundary.decode()}'},
+            'isBase64Encoded': True,
+            'body': base64.b64encode(body).decode('ascii'),
+        }
+    return {
+        'httpMethod': 'POST',
+        'headers': {'Content-Type': 'application/pdf'},
+        'queryStringParameters': {'email': EMAIL},
+        'isBase64Encoded': True,
+        'body': base64.b64encode(pdf).decode('ascii'),
+    }
+
+def measure(rev: str, mode: str, pdf_mb: int, s3_endpoint: str) -> dict:
+    """Один замер в текущем процессе (вызывается из дочернего процесса)"""
+    import boto3
+    import psycopg2
+    
+    os.environ.update(AWS_ACCESS_KEY_ID='bench', AWS_SECRET_ACCESS_KEY='bench',
+                      REPORT_CACHE_DIR=tempfile.mkdtemp(prefix='bench-cache-'))
+    module = load_function('download-report', rev)
+    if hasattr(module, 'get_s3_client'):
+        module._s3_client = boto3.client('s3', endpoint_url=s3_endpoint, region_name='us-east-1',
+                                         aws_access_key_id='bench', aws_secret_access_key='bench')
+    
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    conn.cursor().execute("""
+        INSERT INTO active_access (email, plan_type, expires_at) VALUES (%s, 'year', CURRENT_TIMESTAMP + INTERVAL '1 day')
+        ON CONFLICT (email) DO NOTHING
+    """, (EMAIL,))
+    conn.close()
+    
+    # Прогрев: пул, подготовленные выражения, импорт boto3 и email
+    response = module.handler(build_event('json', os.urandom(64)), None)
+    assert response['statusCode'] == 200, response
+    
+    event = build_event(mode, os.urandom(pdf_mb * 1024 * 1024))
+    gc.collect()
+    tracemalloc.start()
+    response = module.handler(event, None)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert response['statusCode'] == 200, response
+    return {'peak_mib': peak / 2 ** 20}
+
+def supports(rev: str, mode: str) -> bool:
+    return mode == 'json' or 'parse_multipart' in read_file(rev, 'backend/download-report/index.py')
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rev', action='append', help='ревизия git или WORKTREE (можно несколько раз)')
+    parser.add_argument('--pdf-mb', type=int, default=5)
+    parser.add_argument('--case', nargs=3, metavar=('REV', 'MODE', 'S3_ENDPOINT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.case:
+        rev, mode, s3_endpoint = args.case
+        print(json.dumps(measure(rev, mode, args.pdf_mb, s3_endpoint)))
+        return
+    
+    server_url = os.environ.get('TEST_DATABASE_URL')
+    if not server_url:
+        sys.exit('TEST_DATABASE_URL не задан')
+    
+    import boto3
+    from moto.server import ThreadedMotoServer
+    
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    port = free_port()
+    moto_server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    moto_server.start()
+    s3_endpoint = f'http://127.0.0.1:{port}'
+    boto3.client('s3', endpoint_url=s3_endpoint, region_name='us-east-1',
+                 aws_access_key_id='bench', aws_secret_access_key='bench').create_bucket(Bucket='files')
+    
+    print(f"PDF {args.pdf_mb} MiB")
+    print(f"{'revision':12} {'mode':10} {'tracemalloc peak, MiB':>22}")
+    try:
+        for rev in args.rev or DEFAULT_REVS:
+            url = create_database(server_url, rev)
+            try:
+                for mode in MODES:
+                    if not supports(rev, mode):
+                        print(f"{rev:12} {mode:10} {'—':>22}")
+                        continue
+                    output = subprocess.check_output(
+                        [sys.executable, os.path.abspath(__file__), '--pdf-mb', str(args.pdf_mb),
+                         '--case', rev, mode, s3_endpoint],
+                        env={**os.environ, 'DATABASE_URL': url}, text=True
+                    )
+                    stats = json.loads(output.strip().splitlines()[-1])
+                    print(f"{rev:12} {mode:10} {stats['peak_mib']:22.1f}")
+            finally:
+                drop_database(server_url, url)
+    finally:
+        moto_server.stop()
+
+if __name__ == '__main__':
+    main()
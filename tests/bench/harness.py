@@ -0,0 +1,78 @@
+"""
+Общие помощники для замеров: отдельная база с миграциями нужной ревизии
+и загрузка backend/<функция>/index.py из рабочего дерева или из git.
+
+Ревизия 'WORKTREE' — текущие файлы на диске, любая другая — git-ревизия.
+"""
+import glob
+import importlib.util
+import os
+import statistics
+import subprocess
+import tempfile
+import uuid
+from typing import Any, Dict, List
+from urllib.parse import urlsplit, urlunsplit
+
+import psycopg2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SCHEMA = 't_p85141447_matrix_destiny_proje'
+WORKTREE = 'WORKTREE'
+
+def _git(*args: str) -> str:
+    return subprocess.check_output(['git', *args], cwd=ROOT, text=True)
+
+def read_file(rev: str, path: str) -> str:
+    if rev == WORKTREE:
+        with open(os.path.join(ROOT, path), encoding='utf-8') as f:
+            return f.read()
+    return _git('show', f'{rev}:{path}')
+
+def migrations(rev: str) -> List[str]:
+    if rev == WORKTREE:
+        paths = glob.glob(os.path.join(ROOT, 'db_migrations', 'V*.sql'))
+        return [os.path.relpath(p, ROOT) for p in sorted(paths)]
+    return sorted(p for p in _git('ls-tree', '--name-only', rev, 'db_migrations/').split() if p.endswith('.sql'))
+
+def create_database(server_url: str, rev: str = WORKTREE) -> str:
+    """Новая база со схемой проекта и миграциями ревизии rev; возвращает её URL"""
+    name = f'matrix_destiny_bench_{uuid.uuid4().hex[:8]}'
+    admin = psycopg2.connect(server_url)
+    admin.autocommit = True
+    admin.cursor().execute(f'CREATE DATABASE {name}')
+    admin.close()
+    url = urlunsplit(urlsplit(server_url)._replace(path=f'/{name}'))
+    
+    conn = psycopg2.connect(url)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(f'CREATE SCHEMA {SCHEMA}')
+    cur.execute(f'ALTER DATABASE {name} SET search_path TO {SCHEMA}')
+    cur.execute(f'SET search_path TO {SCHEMA}')
+    for path in migrations(rev):
+        cur.execute(read_file(rev, path))
+    conn.close()
+    return url
+
+def drop_database(server_url: str, url: str) -> None:
+    admin = psycopg2.connect(server_url)
+    admin.autocommit = True
+    admin.cursor().execute(f'DROP DATABASE {urlsplit(url).path.lstrip("/")} WITH (FORCE)')
+    admin.close()
+
+def load_function(name: str, rev: str = WORKTREE) -> Any:
+    """Свежий экземпляр модуля функции: свой пул соединений и кэши"""
+    source = read_file(rev, f'backend/{name}/index.py')
+    path = os.path.join(tempfile.mkdtemp(prefix='bench-'), 'index.py')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(source)
+    spec = importlib.util.spec_from_file_location(f'{name.replace("-", "_")}_{uuid.uuid4().hex[:8]}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def percentiles(samples_ms: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples_ms)
+    cuts = statistics.quantiles(ordered, n=100, method='inclusive')
+    return {'p50': cuts[49], 'p99': cuts[98], 'mean': statistics.fmean(ordered)}
@@ -0,0 +1,114 @@
+"""
+Тесты функций против настоящего PostgreSQL.
+
+TEST_DATABASE_URL — строка подключения к серверу с правом CREATE DATABASE
+(например postgresql://postgres@localhost/postgres). Без неё тесты пропускаются.
+На каждый запуск создаётся отдельная база: схема проекта, все db_migrations по порядку.
+"""
+import glob
+import importlib.util
+import os
+import socket
+import uuid
+from typing import Any, Callable, Iterator
+from urllib.parse import urlsplit, urlunsplit
+
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SCHEMA = 't_p85141447_matrix_destiny_proje'
+
+def _with_database(url: str, name: str) -> str:
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(path=f'/{name}'))
+
+@pytest.fixture(scope='session')
+def database_url() -> Iterator[str]:
+    server_url = os.environ.get('TEST_DATABASE_URL')
+    if not server_url:
+        pytest.skip('TEST_DATABASE_URL не задан')
+    
+    name = f'matrix_destiny_test_{uuid.uuid4().hex[:8]}'
+    admin = psycopg2.connect(server_url)
+    admin.autocommit = True
+    admin.cursor().execute(f'CREATE DATABASE {name}')
+    url = _with_database(server_url, name)
+    
+    conn = psycopg2.connect(url)
+    conn.autocommit = True
+    cur = conn.cursor()
+    # access-check обращается к схеме по имени, остальные функции — через search_path
+    cur.execute(f'CREATE SCHEMA {SCHEMA}')
+    cur.execute(f'ALTER DATABASE {name} SET search_path TO {SCHEMA}')
+    cur.execute(f'SET search_path TO {SCHEMA}')
+    for path in sorted(glob.glob(os.path.join(ROOT, 'db_migrations', 'V*.sql'))):
+        with open(path, encoding='utf-8') as f:
+            cur.execute(f.read())
+    conn.close()
+    
+    yield url
+    
+    admin.cursor().execute(f'DROP DATABASE {name} WITH (FORCE)')
+    admin.close()
+
+@pytest.fixture
+def db(database_url: str) -> Iterator[Any]:
+    """Соединение теста в autocommit: подготовка данных и проверки"""
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    yield conn
+    conn.close()
+
+@pytest.fixture
+def load_handler(database_url: str, monkeypatch: pytest.MonkeyPatch) -> Callable[[str], Any]:
+    """Свежий экземпляр backend/<name>/index.py: свой пул соединений и кэши"""
+    monkeypatch.setenv('DATABASE_URL', database_url)
+    monkeypatch.setenv('MAIN_DB_SCHEMA', SCHEMA)
+    
+    def load(name: str) -> Any:
+        spec = importlib.util.spec_from_file_location(
+            f'{name.replace("-", "_")}_{uuid.uuid4().hex[:8]}',
+            os.path.join(ROOT, 'backend', name, 'index.py')
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    
+    return load
+
+@pytest.fixture
+def email() -> str:
+    return f'{uuid.uuid4().hex[:12]}@example.com'
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture(scope='session')
+def s3_endpoint() -> Iterator[str]:
+    """Локальный S3 (moto) вместо bucket.poehali.dev"""
+    moto_server = pytest.importorskip('moto.server')
+    port = free_port()
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    yield f'http://127.0.0.1:{port}'
+    server.stop()
+
+@pytest.fixture
+def s3(s3_endpoint: str) -> Any:
+    """Клиент с пустым бакетом files; функции получают его через module._s3_client"""
+    import boto3
+    
+    client = boto3.client(
+        's3', endpoint_url=s3_endpoint, region_name='us-east-1',
+        aws_access_key_id='testing', aws_secret_access_key='testing'
+    )
+    client.create_bucket(Bucket='files')
+    yield client
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket='files'):
+        for item in page.get('Contents', []):
+            client.delete_object(Bucket='files', Key=item['Key'])
+    client.delete_bucket(Bucket='files')
@@ -0,0 +1,50 @@
+"""download-report: учёт скачиваний под параллельной нагрузкой (record_download)"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+PARALLEL = 16
+
+def download(handler, email: str, n: int) -> int:
+    response = handler({
+        'httpMethod': 'POST',
+        'body': json.dumps({'email': email, 'calculation_data': {'request': n}})
+    }, None)
+    return response['statusCode']
+
+def test_parallel_downloads_never_exceed_limit(db, load_handler, email):
+    db.cursor().execute(
+        "INSERT INTO active_access (email, plan_type, downloads_left) VALUES (%s, 'single', 5)",
+        (email,)
+    )
+    module = load_handler('download-report')
+    
+    with ThreadPoolExecutor(PARALLEL) as pool:
+        statuses = list(pool.map(lambda n: download(module.handler, email, n), range(PARALLEL * 2)))
+    
+    assert statuses.count(200) == 5
+    assert statuses.count(403) == PARALLEL * 2 - 5
+    cur = db.cursor()
+    cur.execute('SELECT downloads_left FROM active_access WHERE email = %s', (email,))
+    assert cur.fetchone()[0] == 0
+    cur.execute('SELECT COUNT(*) FROM downloads WHERE email = %s', (email,))
+    assert cur.fetchone()[0] == 5
+
+def test_unlimited_downloads_do_not_rewrite_access_row(db, load_handler, email):
+    cur = db.cursor()
+    cur.execute(
+        """INSERT INTO active_access (email, plan_type, expires_at)
+           VALUES (%s, 'month', CURRENT_TIMESTAMP + INTERVAL '30 days')""",
+        (email,)
+    )
+    cur.execute('SELECT xmin::TEXT, updated_at FROM active_access WHERE email = %s', (email,))
+    before = cur.fetchone()
+    module = load_handler('download-report')
+    
+    with ThreadPoolExecutor(PARALLEL) as pool:
+        statuses = list(pool.map(lambda n: download(module.handler, email, n), range(PARALLEL)))
+    
+    assert statuses == [200] * PARALLEL
+    cur.execute('SELECT xmin::TEXT, updated_at FROM active_access WHERE email = %s', (email,))
+    assert cur.fetchone() == before
+    cur.execute('SELECT COUNT(*) FROM downloads WHERE email = %s', (email,))
+    assert cur.fetchone()[0] == PARALLEL
@@ -0,0 +1,213 @@
+"""
+download-report: очередь писем email_outbox — доставка через SMTP (STARTTLS + логин),
+повторы с экспоненциальной задержкой, загрузка PDF в S3 после коммита и срок хранения PDF
+"""
+import base64
+import datetime
+import email as email_parser
+import json
+import os
+import ssl
+
+import pytest
+
+from conftest import free_port
+
+aiosmtpd_controller = pytest.importorskip('aiosmtpd.controller')
+from aiosmtpd.smtp import AuthResult, LoginPassword  # noqa: E402
+
+SMTP_USER = 'reports@example.com'
+SMTP_PASSWORD = 'secret'
+PDF = b'%PDF-1.4 outbox test'
+
+class Mailbox:
+    """Принимает письма; адресаты reject-* получают временный отказ"""
+
+    def __init__(self) -> None:
+        self.messages = []
+    
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith('reject-'):
+            return '450 4.2.0 Mailbox busy'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+    
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(email_parser.message_from_bytes(envelope.content))
+        return '250 Message accepted'
+
+def authenticate(server, session, envelope, mechanism, auth_data) -> AuthResult:
+    ok = isinstance(auth_data, LoginPassword) and auth_data.login == SMTP_USER.encode() and auth_data.password == SMTP_PASSWORD.encode()
+    return AuthResult(success=ok)
+
+def self_signed_context(directory: str) -> ssl.SSLContext:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+    
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256()))
+    cert_path = os.path.join(directory, 'cert.pem')
+    key_path = os.path.join(directory, 'key.pem')
+    with open(cert_path, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_path, key_path)
+    return context
+
+@pytest.fixture(scope='module')
+def smtp(tmp_path_factory):
+    mailbox = Mailbox()
+    port = free_port()
+    controller = aiosmtpd_controller.Controller(
+        mailbox, hostname='127.0.0.1', port=port,
+        tls_context=self_signed_context(str(tmp_path_factory.mktemp('smtp'))),
+        require_starttls=True, authenticator=authenticate, auth_require_tls=True
+    )
+    controller.start()
+    yield port, mailbox
+    controller.stop()
+
+@pytest.fixture
+def outbox(db, load_handler, smtp, tmp_path, monkeypatch):
+    """download-report с SMTP-заглушкой и пустой очередью; возвращает (модуль, почтовый ящик)"""
+    port, mailbox = smtp
+    monkeypatch.setenv('SMTP_HOST', '127.0.0.1')
+    monkeypatch.setenv('SMTP_PORT', str(port))
+    monkeypatch.setenv('SMTP_USER', SMTP_USER)
+    monkeypatch.setenv('SMTP_PASSWORD', SMTP_PASSWORD)
+    monkeypatch.setenv('REPORT_CACHE_DIR', str(tmp_path))
+    db.cursor().execute('DELETE FROM email_outbox')
+    mailbox.messages.clear()
+    return load_handler('download-report'), mailbox
+
+def enqueue(db, recipient: str, pdf_key: str, **columns) -> int:
+    columns = {'recipient_email': recipient, 'recipient_name': 'Тест', 'pdf_key': pdf_key, **columns}
+    cur = db.cursor()
+    cur.execute(
+        f"INSERT INTO email_outbox ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) RETURNING id",
+        list(columns.values())
+    )
+    return cur.fetchone()[0]
+
+def outbox_row(db, job_id: int) -> tuple:
+    cur = db.cursor()
+    cur.execute("""
+        SELECT status, attempts, last_error, next_attempt_at - CURRENT_TIMESTAMP, pdf_key, pdf
+        FROM email_outbox WHERE id = %s
+    """, (job_id,))
+    return cur.fetchone()
+
+def drain(module) -> dict:
+    response = module.handler({'httpMethod': 'GET', 'queryStringParameters': {'action': 'drain_outbox'}}, None)
+    assert response['statusCode'] == 200, response['body']
+    return json.loads(response['body'])
+
+def cache_pdf(module, key: str, data: bytes = PDF) -> None:
+    with open(os.path.join(module.REPORT_CACHE_DIR, os.path.basename(key)), 'wb') as f:
+        f.write(data)
+
+def test_pending_email_is_delivered_with_pdf(db, outbox, email):
+    module, mailbox = outbox
+    cache_pdf(module, 'reports/mail/delivered.pdf')
+    job_id = enqueue(db, email, 'reports/mail/delivered.pdf')
+    
+    assert drain(module)['sent'] == 1
+    
+    status, attempts, last_error, _, _, _ = outbox_row(db, job_id)
+    assert (status, attempts, last_error) == ('sent', 1, None)
+    [message] = mailbox.messages
+    assert message['To'] == email
+    [attachment] = [part for part in message.walk() if part.get_content_type() == 'application/pdf']
+    assert attachment.get_payload(decode=True) == PDF
+
+def test_rejected_email_backs_off_then_fails(db, outbox):
+    module, mailbox = outbox
+    cache_pdf(module, 'reports/mail/rejected.pdf')
+    job_id = enqueue(db, 'reject-me@example.com', 'reports/mail/rejected.pdf', attempts=2)
+    
+    assert drain(module)['retried'] == 1
+    
+    status, attempts, last_error, delay, _, _ = outbox_row(db, job_id)
+    assert (status, attempts) == ('pending', 3)
+    assert '450' in last_error
+    # Задержка OUTBOX_BACKOFF_SECONDS * 2 ** (попытки до этой) = 60 * 4
+    expected = module.OUTBOX_BACKOFF_SECONDS * 2 ** 2
+    assert expected - 5 < delay.total_seconds() <= expected
+    assert mailbox.messages == []
+    
+    # Последняя попытка переводит письмо в failed
+    db.cursor().execute(
+        'UPDATE email_outbox SET attempts = %s, next_attempt_at = CURRENT_TIMESTAMP WHERE id = %s',
+        (module.OUTBOX_MAX_ATTEMPTS - 1, job_id)
+    )
+    assert drain(module)['failed'] == 1
+    assert outbox_row(db, job_id)[:2] == ('failed', module.OUTBOX_MAX_ATTEMPTS)
+
+def test_old_pdfs_are_removed_unless_still_referenced(db, outbox, s3, email):
+    module, _ = outbox
+    module._s3_client = s3
+    for key in ('reports/mail/old.pdf', 'reports/mail/shared.pdf'):
+        s3.put_object(Bucket='files', Key=key, Body=PDF)
+    old = datetime.datetime.now() - datetime.timedelta(days=module.OUTBOX_PDF_RETENTION_DAYS + 1)
+    old_id = enqueue(db, email, 'reports/mail/old.pdf', status='sent', created_at=old)
+    enqueue(db, email, 'reports/mail/shared.pdf', status='failed', created_at=old)
+    # Тот же PDF ещё ждёт отправки другому адресату
+    enqueue(db, 'reject-later@example.com', 'reports/mail/shared.pdf',
+            next_attempt_at=datetime.datetime.now() + datetime.timedelta(hours=1))
+    
+    assert drain(module)['expired'] == 1
+    
+    keys = {item['Key'] for item in s3.list_objects_v2(Bucket='files').get('Contents', [])}
+    assert keys == {'reports/mail/shared.pdf'}
+    assert outbox_row(db, old_id)[4] is None
+
+def post_report(module, email: str) -> dict:
+    response = module.handler({
+        'httpMethod': 'POST',
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps({
+            'email': email,
+            'name': 'Тест',
+            'calculation_data': {'personal': 1},
+            'pdf_base64': base64.b64encode(PDF).decode('ascii')
+        })
+    }, None)
+    assert response['statusCode'] == 200, response['body']
+    return json.loads(response['body'])
+
+def queued_row(db, email: str) -> tuple:
+    cur = db.cursor()
+    cur.execute('SELECT pdf_key, pdf FROM email_outbox WHERE recipient_email = %s', (email,))
+    return cur.fetchone()
+
+def test_pdf_is_uploaded_after_commit(db, outbox, s3, email):
+    module, _ = outbox
+    module._s3_client = s3
+    db.cursor().execute("INSERT INTO active_access (email, plan_type) VALUES (%s, 'year')", (email,))
+    
+    assert post_report(module, email)['email_queued'] is True
+    
+    pdf_key, pdf = queued_row(db, email)
+    assert pdf is None
+    assert s3.get_object(Bucket='files', Key=pdf_key)['Body'].read() == PDF
+
+def test_failed_upload_keeps_pdf_in_outbox_row(db, outbox, s3, email, monkeypatch):
+    module, _ = outbox
+    module._s3_client = s3
+    monkeypatch.setattr(module, 'S3_BUCKET', 'missing-bucket')
+    db.cursor().execute("INSERT INTO active_access (email, plan_type) VALUES (%s, 'year')", (email,))
+    
+    assert post_report(module, email)['email_queued'] is True
+    
+    pdf_key, pdf = queued_row(db, email)
+    assert pdf_key is None and bytes(pdf) == PDF
@@ -0,0 +1,82 @@
+"""
+admin-direct: потоковая выгрузка заявок составной загрузкой в S3 (moto) —
+число строк, gzip туда и обратно, presigned-ссылка на ключ со случайной частью
+"""
+import csv
+import gzip
+import io
+import json
+import re
+import urllib.request
+
+import pytest
+
+# ~1,2 КБ на строку: несжатый NDJSON больше порога составной загрузки boto3 (8 МБ)
+ROWS = 9000
+
+@pytest.fixture(scope='module')
+def export_rows(database_url):
+    import psycopg2
+    
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    cur = conn.cursor()
+    # Отдельный период, чтобы заявки других тестов не попадали в выгрузку
+    cur.execute("""
+        INSERT INTO payment_requests (email, phone, screenshot_url, status, plan_type, amount, created_at)
+        SELECT 'export' || n || '@example.com', '+7900' || lpad(n::TEXT, 7, '0'),
+               'https://cdn.example.com/' || repeat(md5(n::TEXT), 30) || '.png', 'approved', 'year', 1990,
+               TIMESTAMP '2001-01-01' + n * INTERVAL '1 second'
+        FROM generate_series(1, %s) AS n
+    """, (ROWS,))
+    conn.close()
+    return ROWS
+
+def export(module, **params) -> dict:
+    response = module.handler({
+        'httpMethod': 'GET',
+        'queryStringParameters': {'action': 'export', 'date_from': '2001-01-01', 'date_to': '2001-01-31', **params}
+    }, None)
+    assert response['statusCode'] == 200, response['body']
+    return json.loads(response['body'])
+
+@pytest.fixture
+def admin(load_handler, s3):
+    module = load_handler('admin-direct')
+    module._s3_client = s3
+    return module
+
+def exported_key(s3) -> str:
+    [item] = s3.list_objects_v2(Bucket='files', Prefix='exports/')['Contents']
+    return item['Key']
+
+def test_ndjson_export_is_multipart_and_complete(admin, s3, export_rows):
+    body = export(admin, format='ndjson')
+    assert body['rows'] == export_rows
+    
+    key = exported_key(s3)
+    assert re.fullmatch(r'exports/payment-requests-\d{8}-\d{6}-[0-9a-f]{32}\.ndjson', key)
+    head = s3.head_object(Bucket='files', Key=key)
+    # ETag составного объекта — "<md5>-<число частей>"
+    assert re.search(r'-\d+"$', head['ETag'])
+    assert head['ContentType'] == 'application/x-ndjson'
+    
+    # Ссылка отдаёт именно этот объект без ключей доступа
+    with urllib.request.urlopen(body['url']) as response:
+        lines = response.read().decode('utf-8').splitlines()
+    assert key in body['url']
+    assert len(lines) == export_rows
+    first = json.loads(lines[0])
+    assert first['email'] == 'export1@example.com' and first['amount'] == 1990
+
+def test_gzip_csv_round_trip(admin, s3, export_rows):
+    body = export(admin, format='csv', gzip='1')
+    assert body['rows'] == export_rows and body['gzip'] is True
+    
+    key = exported_key(s3)
+    assert key.endswith('.csv.gz')
+    data = s3.get_object(Bucket='files', Key=key)['Body'].read()
+    rows = list(csv.reader(io.StringIO(gzip.decompress(data).decode('utf-8'))))
+    assert rows[0] == admin.EXPORT_FIELDS
+    assert len(rows) == export_rows + 1
+    assert rows[-1][1] == f'export{export_rows}@example.com'
@@ -0,0 +1,72 @@
+"""admin-direct: параллельные одобрения заявок через grant_access не теряют пакеты скачиваний"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+PARALLEL = 12
+
+def create_requests(db, email: str, plan_type: str, count: int) -> list:
+    cur = db.cursor()
+    cur.execute(
+        """INSERT INTO payment_requests (email, phone, screenshot_url, status, plan_type, amount)
+           SELECT %s, '+70000000000', '', 'pending', %s, 100 FROM generate_series(1, %s)
+           RETURNING id""",
+        (email, plan_type, count)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+def access_row(db, email: str) -> tuple:
+    cur = db.cursor()
+    cur.execute('SELECT plan_type, expires_at, downloads_left FROM active_access WHERE email = %s', (email,))
+    return cur.fetchone()
+
+def test_parallel_single_approvals_add_up(db, load_handler, email):
+    ids = create_requests(db, email, 'single', PARALLEL)
+    module = load_handler('admin-direct')
+    
+    def approve(request_id: int) -> int:
+        return module.handler({
+            'httpMethod': 'GET',
+            'queryStringParameters': {'action': 'approve', 'id': str(request_id), 'email': email}
+        }, None)['statusCode']
+    
+    with ThreadPoolExecutor(PARALLEL) as pool:
+        assert list(pool.map(approve, ids)) == [200] * PARALLEL
+    
+    assert access_row(db, email) == ('single', None, PARALLEL)
+
+def test_parallel_bulk_approvals_add_up(db, load_handler, email):
+    ids = create_requests(db, email, 'single', PARALLEL * 2)
+    module = load_handler('admin-direct')
+    
+    def bulk_approve(chunk: list) -> dict:
+        response = module.handler({
+            'httpMethod': 'POST',
+            'queryStringParameters': {'action': 'bulk_approve'},
+            'body': json.dumps({'ids': chunk})
+        }, None)
+        assert response['statusCode'] == 200
+        return json.loads(response['body'])
+    
+    chunks = [ids[i::PARALLEL] for i in range(PARALLEL)]
+    with ThreadPoolExecutor(PARALLEL) as pool:
+        list(pool.map(bulk_approve, chunks))
+    
+    assert access_row(db, email) == ('single', None, PARALLEL * 2)
+
+def test_single_approvals_during_subscription_keep_it(db, load_handler, email):
+    ids = create_requests(db, email, 'month', 1) + create_requests(db, email, 'single', PARALLEL)
+    module = load_handler('admin-direct')
+    module.handler({
+        'httpMethod': 'GET',
+        'queryStringParameters': {'action': 'approve', 'id': str(ids[0]), 'email': email}
+    }, None)
+    subscription = access_row(db, email)
+    
+    with ThreadPoolExecutor(PARALLEL) as pool:
+        list(pool.map(lambda request_id: module.handler({
+            'httpMethod': 'GET',
+            'queryStringParameters': {'action': 'approve', 'id': str(request_id), 'email': email}
+        }, None), ids[1:]))
+    
+    assert subscription[0] == 'month'
+    assert access_row(db, email) == subscription
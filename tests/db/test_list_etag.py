@@ -0,0 +1,39 @@
+"""admin-direct: ETag списка меняется при вставке, изменении и удалении заявок"""
+
+def list_etag(module) -> str:
+    response = module.handler({'httpMethod': 'GET', 'queryStringParameters': {'action': 'list', 'limit': '5'}}, None)
+    assert response['statusCode'] == 200
+    return response['headers']['ETag']
+
+def test_etag_follows_insert_update_delete(db, load_handler, email, monkeypatch):
+    monkeypatch.setenv('LIST_ETAG_SETTLE', '0')
+    module = load_handler('admin-direct')
+    cur = db.cursor()
+    
+    cur.execute(
+        """INSERT INTO payment_requests (email, phone, screenshot_url, status, plan_type, amount)
+           VALUES (%s, '+70000000000', '', 'pending', 'single', 100) RETURNING id""",
+        (email,)
+    )
+    request_id = cur.fetchone()[0]
+    inserted = list_etag(module)
+    assert list_etag(module) == inserted
+    
+    # Колонка, которой нет в списке, версию не меняет
+    cur.execute('UPDATE payment_requests SET idempotency_key = %s WHERE id = %s', (email, request_id))
+    assert list_etag(module) == inserted
+    
+    cur.execute("UPDATE payment_requests SET status = 'rejected' WHERE id = %s", (request_id,))
+    updated = list_etag(module)
+    assert updated != inserted
+    
+    cur.execute(
+        """INSERT INTO payment_requests (email, phone, screenshot_url, status, plan_type, amount)
+           VALUES (%s, '+70000000000', '', 'pending', 'single', 100)""",
+        (email,)
+    )
+    latest = list_etag(module)
+    
+    # Удаление не самой свежей строки max(updated_at) не сдвигает — его ловит list_deletions
+    cur.execute('DELETE FROM payment_requests WHERE id = %s', (request_id,))
+    assert list_etag(module) not in (inserted, updated, latest)
@@ -0,0 +1,62 @@
+"""payment-submit-simple: загрузка скриншота и уведомление после INSERT идут параллельно"""
+import base64
+import json
+import time
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 64
+SLOW = 0.3
+
+def submit(module, email: str) -> dict:
+    response = module.handler({
+        'httpMethod': 'POST',
+        'body': json.dumps({
+            'email': email,
+            'phone': '+70000000000',
+            'plan_type': 'single',
+            'amount': 300,
+            'screenshot': base64.b64encode(PNG).decode('ascii')
+        })
+    }, None)
+    assert response['statusCode'] == 200, response['body']
+    return json.loads(response['body'])
+
+def screenshot_url(db, request_id: int) -> str:
+    cur = db.cursor()
+    cur.execute('SELECT screenshot_url FROM payment_requests WHERE id = %s', (request_id,))
+    return cur.fetchone()[0]
+
+def test_upload_and_notification_overlap(db, load_handler, email, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    module = load_handler('payment-submit-simple')
+    calls = []
+    
+    def slow(name):
+        def run(*args):
+            time.sleep(SLOW)
+            calls.append(name)
+            return True
+        return run
+    
+    monkeypatch.setattr(module, 'upload_screenshot', slow('s3_upload'))
+    monkeypatch.setattr(module, 'send_telegram_notification', slow('telegram'))
+    
+    started = time.perf_counter()
+    body = submit(module, email)
+    elapsed = time.perf_counter() - started
+    
+    assert sorted(calls) == ['s3_upload', 'telegram']
+    assert elapsed < SLOW * 1.8
+    assert screenshot_url(db, body['request_id']).endswith('.png')
+
+def test_failed_upload_clears_screenshot_url(db, load_handler, email, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    module = load_handler('payment-submit-simple')
+    
+    def broken(*args):
+        raise OSError('S3 недоступен')
+    
+    monkeypatch.setattr(module, 'upload_screenshot', broken)
+    monkeypatch.setattr(module, 'send_telegram_notification', lambda *args: True)
+    
+    body = submit(module, email)
+    assert screenshot_url(db, body['request_id']) == ''
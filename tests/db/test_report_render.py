@@ -0,0 +1,32 @@
+"""download-report: отчёт, собранный на сервере, рендерится с кириллицей шрифтом из комплекта функции"""
+import base64
+import io
+import json
+
+import pytest
+
+pytest.importorskip('fpdf')
+pypdf = pytest.importorskip('pypdf')
+
+def test_rendered_report_contains_cyrillic(db, load_handler, email, tmp_path, monkeypatch):
+    monkeypatch.setenv('REPORT_CACHE_DIR', str(tmp_path))
+    monkeypatch.delenv('REPORT_FONT_PATH', raising=False)
+    db.cursor().execute("INSERT INTO active_access (email, plan_type) VALUES (%s, 'year')", (email,))
+    module = load_handler('download-report')
+    
+    response = module.handler({
+        'httpMethod': 'POST',
+        'queryStringParameters': {'render': '1'},
+        'body': json.dumps({
+            'email': email,
+            'calculation_data': {'name': 'Анна Щукина', 'birth_date': '01.02.1990',
+                                 'personal': 7, 'destiny': 12, 'social': 3, 'spiritual': 22}
+        })
+    }, None)
+    assert response['statusCode'] == 200, response['body']
+    body = json.loads(response['body'])
+    
+    reader = pypdf.PdfReader(io.BytesIO(base64.b64decode(body['pdf_base64'])))
+    text = ' '.join(page.extract_text() for page in reader.pages)
+    for expected in ('Матрица Судьбы', 'Анна Щукина', 'Дата рождения: 01.02.1990', 'Духовная энергия', '22'):
+        assert expected in text
@@ -0,0 +1,106 @@
+"""
+access-check: горячие запросы к user_sessions идут по индексам на синтетической нагрузке.
+Размер набора — SESSIONS_COUNT (по умолчанию 50 000 сессий, по 5 устройств на email)
+"""
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+SESSIONS_COUNT = int(os.environ.get('SESSIONS_COUNT', '50000'))
+DEVICES_PER_EMAIL = 5
+INDEX_SCANS = {'Index Scan', 'Index Only Scan', 'Bitmap Index Scan', 'Bitmap Heap Scan'}
+
+# Те же запросы, что выполняет функция access_check() внутри БД
+ACCESS_CHECK_QUERIES = {
+    'count_devices': """
+        SELECT COUNT(DISTINCT s.ip_address) FROM user_sessions s
+        WHERE s.email = %(email)s AND s.last_activity > %(threshold)s
+    """,
+    'current_device': """
+        SELECT s.session_token FROM user_sessions s
+        WHERE s.email = %(email)s AND s.ip_address = %(ip)s AND s.last_activity > %(threshold)s
+        LIMIT 1
+    """,
+    # Пачечное обновление пульса (flush_heartbeats)
+    'heartbeat_flush': """
+        UPDATE user_sessions s
+        SET last_activity = v.last_activity
+        FROM (VALUES (%(email)s, %(ip)s, %(now)s::TIMESTAMP)) AS v(email, ip_address, last_activity)
+        WHERE s.email = v.email AND s.ip_address = v.ip_address AND s.last_activity < v.last_activity
+    """,
+}
+
+@pytest.fixture(scope='module')
+def sessions(database_url):
+    import psycopg2
+    
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO user_sessions (email, ip_address, user_agent, session_token, created_at, last_activity)
+        SELECT 'load' || (n / %(devices)s) || '@example.com',
+               '10.0.' || (n %% %(devices)s) || '.1',
+               'pytest',
+               md5(n::TEXT),
+               created_at,
+               created_at + (CURRENT_TIMESTAMP - created_at) * random()
+        FROM generate_series(0, %(count)s - 1) AS n,
+             LATERAL (SELECT CURRENT_TIMESTAMP - random() * INTERVAL '80 days' AS created_at) c
+    """, {'count': SESSIONS_COUNT, 'devices': DEVICES_PER_EMAIL})
+    cur.execute('ANALYZE user_sessions')
+    # Пустые секции (наперёд) планировщик честно читает последовательно — проверяются только заполненные
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'user_sessions'::REGCLASS AND c.reltuples > 0
+    """)
+    populated = {row[0] for row in cur.fetchall()}
+    yield conn, populated
+    cur.execute("DELETE FROM user_sessions WHERE user_agent = 'pytest'")
+    conn.close()
+
+def scans(plan: dict):
+    if 'Relation Name' in plan:
+        yield plan['Relation Name'], plan['Node Type']
+    for child in plan.get('Plans', []):
+        yield from scans(child)
+
+def assert_index_scans(cur, populated: set) -> None:
+    plan = cur.fetchone()[0][0]['Plan']
+    touched = [(relation, node) for relation, node in scans(plan) if relation in populated]
+    assert touched, json.dumps(plan)
+    assert all(node in INDEX_SCANS for _, node in touched), touched
+
+def params() -> dict:
+    now = datetime.now()
+    return {
+        'email': f'load{SESSIONS_COUNT // DEVICES_PER_EMAIL // 2}@example.com',
+        'ip': '10.0.1.1',
+        'threshold': now - timedelta(hours=24),
+        'now': now,
+    }
+
+@pytest.mark.parametrize('name', sorted(ACCESS_CHECK_QUERIES))
+def test_access_check_queries_use_indexes(sessions, name):
+    conn, populated = sessions
+    cur = conn.cursor()
+    cur.execute('EXPLAIN (FORMAT JSON) ' + ACCESS_CHECK_QUERIES[name], params())
+    assert_index_scans(cur, populated)
+
+@pytest.mark.parametrize('name, args', [
+    ('select_devices', lambda p: (p['email'], p['threshold'])),
+    ('delete_device_sessions', lambda p: (p['email'], p['ip'])),
+])
+def test_prepared_statements_use_indexes(sessions, load_handler, name, args):
+    conn, populated = sessions
+    module = load_handler('access-check')
+    cur = conn.cursor()
+    cur.execute(f'PREPARE {name} AS {module.STATEMENTS[name]}')
+    try:
+        values = args(params())
+        cur.execute(f"EXPLAIN (FORMAT JSON) EXECUTE {name} ({', '.join(['%s'] * len(values))})", values)
+        assert_index_scans(cur, populated)
+    finally:
+        cur.execute(f'DEALLOCATE {name}')
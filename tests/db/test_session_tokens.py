@@ -0,0 +1,49 @@
+"""access-check: выход с устройства отзывает только его подписанный токен"""
+import json
+
+def check(module, email: str, ip: str, token: str = None) -> dict:
+    params = {'email': email}
+    if token:
+        params['session_token'] = token
+    response = module.handler({
+        'httpMethod': 'GET',
+        'queryStringParameters': params,
+        'headers': {'X-Forwarded-For': ip, 'User-Agent': 'pytest'}
+    }, None)
+    return json.loads(response['body'])
+
+def logout(module, email: str, ip: str) -> None:
+    module.handler({
+        'httpMethod': 'DELETE',
+        'body': json.dumps({'email': email}),
+        'headers': {'X-Forwarded-For': ip, 'User-Agent': 'pytest'}
+    }, None)
+
+def slow_checks(module) -> int:
+    return sum(module.get_statement_stats().get('access_check', {}).values())
+
+def test_logout_revokes_only_that_device(db, load_handler, email, monkeypatch):
+    monkeypatch.setenv('SESSION_TOKEN_SECRET', 'pytest-secret')
+    db.cursor().execute(
+        "INSERT INTO active_access (email, plan_type, max_devices) VALUES (%s, 'year', 3)", (email,)
+    )
+    module = load_handler('access-check')
+    
+    phone = check(module, email, '10.1.0.1')['session_token']
+    laptop = check(module, email, '10.1.0.2')['session_token']
+    assert slow_checks(module) == 2
+    
+    # Токен принимается без access_check, число устройств при этом известно
+    body = check(module, email, '10.1.0.2', laptop)
+    assert body['has_access'] and body['active_devices'] == 2
+    assert slow_checks(module) == 2
+    
+    logout(module, email, '10.1.0.1')
+    
+    body = check(module, email, '10.1.0.2', laptop)
+    assert body['has_access'] and body['active_devices'] == 1
+    assert slow_checks(module) == 2
+    
+    # Токен вышедшего устройства больше не срабатывает — только полная проверка
+    check(module, email, '10.1.0.1', phone)
+    assert slow_checks(module) == 3